@@ -2,6 +2,7 @@
 #include <EEPROM.h>
 
 SimplePacket masterPacket(rs485_tx);
+SimplePacket streamPacket(rs485_tx);
 
 // These are our query commands from the host
 #define SLAVE_CMD_STATUS                80
@@ -34,12 +35,136 @@ SimplePacket masterPacket(rs485_tx);
 #define SLAVE_CMD_SET_MOTOR1_SPEED_MODE 99
 #define SLAVE_CMD_SET_MOTOR1_TUNING     100
 
+#define SLAVE_CMD_GET_TELEMETRY         101
+/*  18 Byte. Everything being polled periodically, in one reply.
+ *  1st - 6th Byte: Same as SLAVE_CMD_STATUS
+ *  7th - 10th Byte: Same as SLAVE_CMD_GET_HEATER1_PVSV
+ *  11th - 14th Byte: Same as SLAVE_CMD_GET_HEATER2_PVSV
+ *  15th - 18th Byte: Same as SLAVE_CMD_GET_MOTOR1_PVSV
+ */
+
+#define SLAVE_CMD_GET_BAUD_RATES        102
+/*  4 Byte for each baud rate supported, in SERIAL_SPEEDS order.
+ */
+#define SLAVE_CMD_SET_BAUD_RATE         103
+/*  Parameter: 4 Byte baud rate.
+ *  The reply is sent at the current baud rate, then the new one is taken on probation.
+ *  Sending the same command again at the new baud rate confirms it,
+ *  otherwise it falls back to SERIAL_SPEED after SERIAL_SPEED_PROBATION ms.
+ */
+#define SLAVE_CMD_ECHO                  104
+/*  Reply with the parameter bytes as they are received. Used to verify the link.
+ */
+#define SLAVE_CMD_STREAM_TELEMETRY      105
+/*  Parameter: 1 Byte sampling interval in ms, 0 to stop.
+ *  Motor 1 PV/SV and heater 1 PV are sampled at the interval, and pushed in batches of STREAM_BATCH_SAMPLES
+ *  without being asked (or when polled, with RS485), as SLAVE_PUSH_TELEMETRY. It stops when the host is gone.
+ */
+#define SLAVE_PUSH_TELEMETRY            106
+/*  Never sent by the host. The tag of the batches pushed while streaming.
+ *  1st Byte: RS485 address
+ *  2nd Byte: Sequence number of the batch, to detect the lost ones
+ *  3rd - 4th Byte: millis() of the first sample, lower 16 bits
+ *  Then 6 Byte for each sample: motor 1 PV, motor 1 SV, heater 1 PV
+ *  With RS485, the batch is not pushed, as it could collide with the other devices on the bus. It waits until the host
+ *  polls with this command, and is sent in place of the reply. The reply has no data if no batch is pending.
+ *  A batch not polled before the next one is full is dropped.
+ */
+
 unsigned long packet_timeout = 0;
 char packet_timeout_enabled = 0;
 
+unsigned long serial_speeds[] = { SERIAL_SPEEDS };
+unsigned long serial_speed = SERIAL_SPEED;
+unsigned long serial_speed_pending = 0;
+unsigned long serial_speed_probation = 0;
+char serial_speed_probation_enabled = 0;
+
+unsigned char stream_interval = 0;
+unsigned long stream_next = 0;
+unsigned char stream_samples = 0;
+unsigned char stream_sequence = 0;
+char stream_pending = 0;
+
+void set_serial_speed(unsigned long speed)
+{
+    // Let the last byte of the reply leave the shift register
+    delay(2);
+    Serial.begin(speed);
+    serial_speed = speed;
+    serial_speed_probation_enabled = 0;
+}
+
+// Go back to the default baud rate, so a restarted host could talk to us again
+void reset_serial_speed()
+{
+    if (serial_speed != SERIAL_SPEED)
+    {
+        set_serial_speed(SERIAL_SPEED);
+    }
+}
+
+void start_stream(unsigned char interval)
+{
+    stream_interval = interval;
+    stream_samples = 0;
+    stream_pending = 0;
+    stream_next = millis();
+}
+
+// Take a sample when it is due, and push the batch once it is full
+void stream_telemetry()
+{
+    if (stream_interval == 0 || (signed long) (millis() - stream_next) < 0) return;
+
+    if (stream_samples == 0)
+    {
+        // The batch not polled for is dropped. The host sees the gap in the sequence numbers.
+        stream_pending = 0;
+        streamPacket.init();
+        streamPacket.add_8(RS485_ADDRESS);
+        streamPacket.add_8(stream_sequence);
+        streamPacket.add_16(stream_next);
+    }
+    stream_next += stream_interval;
+    streamPacket.add_16(motor1.getPV());
+    streamPacket.add_16(motor1.getSV());
+    streamPacket.add_16(heater1.getPV());
+
+    if (++stream_samples == STREAM_BATCH_SAMPLES)
+    {
+        streamPacket.add_8(SLAVE_PUSH_TELEMETRY);
+        stream_samples = 0;
+        stream_sequence++;
+        stream_pending = 1;
+        #if !RS485_ENABLED
+        send_stream();
+        #endif
+    }
+}
+
+void send_stream()
+{
+    if (stream_pending == 0) return;
+    stream_pending = 0;
+    #if RS485_ENABLED
+    digitalWrite(TX_ENABLE_PIN, HIGH);
+    #endif
+    streamPacket.sendReply();
+    #if RS485_ENABLED
+    digitalWrite(TX_ENABLE_PIN, LOW);
+    #endif
+}
+
 // Packet handling
 void process_packets()
 {
+    if (serial_speed_probation_enabled != 0 && (signed long) (millis() - serial_speed_probation) >= 0)
+    {
+        // The new baud rate is not confirmed
+        reset_serial_speed();
+    }
+
     if (packet_timeout_enabled != 0 && (signed long) (millis() - packet_timeout) >= 0)
     {
         // Sliently dropping timeout packet
@@ -88,10 +213,26 @@ void process_packets()
                 masterPacket.add_8(masterPacket.get_8(1));
             }
 
+            #if RS485_ENABLED
+            if (stream_pending != 0 && masterPacket.getResponseCode() == RC_OK && masterPacket.get_8(1) == SLAVE_PUSH_TELEMETRY)
+            {
+                // Polled for the batch, which goes in place of the reply
+                masterPacket.init();
+                send_stream();
+            } else
+            #endif
             // send reply over RS485
             // This includes masterPacket.init();
             send_reply();
 
+            if (serial_speed_pending != 0)
+            {
+                set_serial_speed(serial_speed_pending);
+                serial_speed_pending = 0;
+                serial_speed_probation_enabled = 1;
+                serial_speed_probation = millis() + SERIAL_SPEED_PROBATION;
+            }
+
             return;
         }
 
@@ -122,6 +263,57 @@ void handle_query()
                 masterPacket.add_8(status[i]);
             }
             break;
+        case SLAVE_CMD_GET_TELEMETRY:
+            for (unsigned char i = 0; i < 6; i++)
+            {
+                masterPacket.add_8(status[i]);
+            }
+            masterPacket.add_16(heater1.getPV());
+            masterPacket.add_16(heater1.getSV());
+            masterPacket.add_16(heater2.getPV());
+            masterPacket.add_16(heater2.getSV());
+            masterPacket.add_16(motor1.getPV());
+            masterPacket.add_16(motor1.getSV());
+            break;
+        case SLAVE_CMD_GET_BAUD_RATES:
+            for (unsigned char i = 0; i < sizeof(serial_speeds) / sizeof(serial_speeds[0]); i++)
+            {
+                masterPacket.add_32(serial_speeds[i]);
+            }
+            break;
+        case SLAVE_CMD_SET_BAUD_RATE:
+            {
+                unsigned long speed = masterPacket.get_32(2);
+                unsigned char supported = 0;
+                for (unsigned char i = 0; i < sizeof(serial_speeds) / sizeof(serial_speeds[0]); i++)
+                {
+                    if (serial_speeds[i] == speed) supported = 1;
+                }
+                if (!supported)
+                {
+                    masterPacket.unsupported();
+                } else if (speed == serial_speed)
+                {
+                    // Confirmed
+                    serial_speed_probation_enabled = 0;
+                } else
+                {
+                    serial_speed_pending = speed;
+                }
+            }
+            break;
+        case SLAVE_CMD_ECHO:
+            for (unsigned char i = 2; i < masterPacket.getLength(); i++)
+            {
+                masterPacket.add_8(masterPacket.get_8(i));
+            }
+            break;
+        case SLAVE_CMD_STREAM_TELEMETRY:
+            start_stream(masterPacket.get_8(2));
+            break;
+        case SLAVE_PUSH_TELEMETRY:
+            // Polled for the batch. Nothing else to reply if none is pending.
+            break;
         case SLAVE_CMD_TURN_ON:
             turnOn();
             break;
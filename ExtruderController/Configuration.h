@@ -11,11 +11,16 @@
 
 #define TEMPERATURE_SAMPLES 5
 #define SERIAL_SPEED 38400
+// Baud rates the host could switch to after connecting at SERIAL_SPEED, and the time in ms to confirm the switch
+#define SERIAL_SPEEDS 38400, 57600, 115200
+#define SERIAL_SPEED_PROBATION 500
 
 //the address for commands to listen to
 #define RS485_ADDRESS 0
 #define RS485_ENABLED 0
 #define PACKET_TIMEOUT 100
+// Samples in each batch pushed while streaming the telemetry. 6 bytes each, and the batch must fit in a packet.
+#define STREAM_BATCH_SAMPLES 4
 
 #define RX_ENABLE_PIN 4
 #define TX_ENABLE_PIN 16
@@ -108,11 +108,14 @@ void loop()
     heater2.manage();
     motor1.manage();
     update_status();
+    stream_telemetry();
 
     // If there wasn't any packet from host for a while, shut down the system
     if ((signed long) (millis() - last_packet) > 1000)
     {
         turnOff();
+        reset_serial_speed();
+        start_stream(0);
     }
 }
 
@@ -61,14 +61,22 @@ EMC2 integration scripts
 
 =over
 
+=item C<ExtruderEmulator.py>
+
+An emulator of the Extruder Controller firmware on a pseudo terminal, to run the driver and the benchmark without any hardware.
+
 =item C<mcode-inject.py>
 
-A script being invoked by EMC2 when M1xx User M-Code is being executed. It notifies the driver through HAL.
+A script being invoked by EMC2 when M1xx User M-Code is being executed. It submits the M-Code to the driver through a Unix domain socket, or through HAL if the socket is not available.
 
 =item C<RepRapSerialComm.py>
 
 A module to enable serial port communication with the RepRap/RepStrap extruder controller.
 
+=item C<repstrap-benchmark.py>
+
+A benchmark script measuring the host side cost of the communication module, and the latency and CPU time of the driver against the emulator. No hardware is needed. It exits with 1 if a result is over its limit, e.g. the CRC time per frame or the CPU time of the idle driver.
+
 =item C<repstrap-commtest.py>
 
 A test script to verify the communication and hardware correctness.
@@ -85,14 +93,34 @@ A user space driver to control and communicate with the RepStrap extruder contro
 
 A PYVCP gadget for EMC2's AXIS UI allowing control of the extruder and reporting its status.
 
+=item C<repstrap-preheat.py>
+
+A filter program moving the heater temperature changes (M104) ahead in the GCode output of C<skeinforge2emc.pl>, so the heater is already hot when the extrusion starts.
+
+=item C<repstrap-replay.py>
+
+A script reading the serial communication captured by the driver (C<COMM_CAPTURE>), to print the statistics and the frames, or to benchmark the parser against the real traffic.
+
+=item C<repstrap-selftest.py>
+
+A test script checking the communication module and the driver against the emulator, in situations hard to bring about with the hardware, such as a lost response. No hardware is needed.
+
 =item C<skeinforge2emc.pl>
 
 A filter program to convert Skeinforge GCode output to a more EMC2 friendly input.
 
+=item C<skeinforge2emc-preheat.sh>
+
+A filter program running C<skeinforge2emc.pl> and then C<repstrap-preheat.py>, to be used in place of C<skeinforge2emc.pl>.
+
 =item C<softlink-mcode-inject.sh>
 
 simple shell script to create necessary soft-link to accept M1xx M-Code.
 
+=item C<Telemetry.py>
+
+A module keeping the heater and motor PV/SV history of the driver in fixed memory, at decreasing resolution over time.
+
 =back
 
 =item C</README>
@@ -134,6 +162,10 @@ Edit your EMC2's machine ini (usually in C<~/emc2/config/your-machine/your-machi
     PROGRAM_EXTENSION = .skf Skeinforge Output
     skf = /script/folder/skeinforge2emc.pl
 
+To have the heater preheated ahead of the extrusion, use C<skeinforge2emc-preheat.sh> in place of C<skeinforge2emc.pl>.
+The temperature changes (M104) are then moved ahead by the time the heater takes to heat up,
+so the motion is not stalled waiting for the temperature. Adjust C<HEAT_RATE> in C<repstrap-preheat.py> to your heater.
+
 There should also be a C<POSTGUI_HALFILE> in the C<[HAL]> section. If not, create one:
 
     [HAL]
@@ -159,6 +191,27 @@ Make any correction to the C<COMM_PORT> and C<COMM_BAUDRATE> so to reflect your
 Specifically, the device of your serial port which is hooked to the Extruder Controller.
 
 Usually, the C<COMM_BAUDRATE> value needs not to be modified.
+After connecting at C<COMM_BAUDRATE>, both ends switch to the fastest baud rate up to C<COMM_MAX_BAUDRATE> which passes an echo test, and fall back automatically otherwise. Set C<COMM_MAX_BAUDRATE> to C<None> to stay at C<COMM_BAUDRATE>. A baud rate which fails the test is not tried again. If the firmware does not answer which baud rates it supports, it is asked again every C<RENEGOTIATE_INTERVAL> seconds while the link is healthy. If the link keeps failing at the faster baud rate, the driver reconnects and negotiates a slower one, after waiting for the firmware to fall back to C<COMM_BAUDRATE> on its watchdog (C<FIRMWARE_WATCHDOG>).
+The driver accepts M-Codes on the Unix domain socket C<MAPP_SOCKET>. If you change it, change it in C<mcode-inject.py> as well. Without the socket, C<mcode-inject.py> injects the M-Codes to the C<mapp.*> HAL pins of C<MAPP_COMPONENT> and C<MAPP_DEVICE>, which must be the first port in C<COMM_PORTS> and the first controller in C<COMM_DEVICES>. Up to C<MAPP_QUEUE_SIZE> M-Codes are queued, and C<MAPP_BACKLOG_SIZE> more wait for a slot. Any more is replied with a fault at once.
+
+Several Extruder Controllers (e.g. two extruders and a heated bed) could share one serial port on a RS485 bus.
+Give each firmware its own C<RS485_ADDRESS> in C<Configuration.h>, and list them in C<COMM_DEVICES> as (address, name) pairs.
+The HAL pins and params of each are then prefixed with its name, e.g. C<rs-extruder.bed.heater1.pv>, so edit C<repstrap-extruder.hal> accordingly.
+The controllers take turns on the bus, and each polls at the periods set by its own C<poll.*> params. If the firmware supports the composite telemetry command, every read goes at the shorter of the heater and motor periods, which speed up while heating up or extruding, and C<poll.status-ms> applies to older firmware only. Set C<COMM_RS485> to C<True> when the firmware is built with C<RS485_ENABLED>. The driver then keeps only one request in flight, as the half-duplex bus could not carry a request while a reply is on it.
+The baud rate is not switched when there is more than one, and M-Codes through C<MAPP_SOCKET> go to the first one.
+
+One driver process could also serve several serial ports. List them in C<COMM_PORTS> as (port, name) pairs.
+Each port gets its own HAL component of that name (e.g. C<rs-extruder2.heater1.pv>) with the controllers of C<COMM_DEVICES>,
+and is served and reconnected in its own thread, so a fault on one port does not affect the others.
+Even an unexpected error in the driver stops only its port, which is served again after C<BUS_RESTART_INTERVAL> seconds.
+C<loadusr -Wn> in C<repstrap-extruder.hal> waits for the first one only, and M-Codes through C<MAPP_SOCKET> go to the first port.
+
+A corrupted frame on a noisy line only costs that request, as the driver resynchronizes on the next frame by itself.
+The bus is reset after C<COMM_ERRORS_RESET> failed requests in a row to a controller, and it goes offline with C<fault.communication> after C<COMM_ERRORS_FAULT>.
+Before that, the queries and the absolute set values (C<IDEMPOTENT_COMMANDS>) are retransmitted up to C<COMM_RETRIES> times. A relative move is never sent twice.
+
+A set value (C<SETPOINT_REGISTERS>) written while an older one to the same register is not sent yet replaces it, and a set value equal to the one written already is not sent again,
+so a burst of M-Codes or a slider dragged in pyvcp costs no more than the last value.
 
 Then invoke the C<repstrap-commtest.py> in your consle to see if the communication works. It should print something like this:
 
@@ -237,6 +290,16 @@ Set zero for your print head. And Hit Run!
 
 =back
 
+If the print stutters, the C<stats.*> pins of C<rs-extruder> tell whether the serial link, the firmware or the driver is slow:
+the frame, CRC error, timeout and reset counters, the queue depth, and the round trip, loop iteration and M-Code times of the last second.
+C<kill -USR1> the driver process to print every counter with its distribution to the console.
+C<kill -USR2> it to write the heater and motor history to C<TELEMETRY_EXPORT>: the raw samples of the last 10 minutes, and the 10 seconds and 1 minute averages, minimums and maximums of the last hours. Set C<TELEMETRY_FILE> to keep every raw sample on disk as well.
+
+To judge the motor PID tuning, set C<stream.interval-ms> of C<rs-extruder> to a sampling interval (e.g. 5), and 0 to stop.
+The firmware then samples the motor and heater at that interval and pushes the samples in batches without being asked. An interval too short for the baud rate in use is raised to the shortest one the link carries, which is 5 ms at 38400 and 2 ms at 115200 (see C<STREAM_LINK_SHARE>). On a RS485 bus it sends a batch only when the driver polls for it, so it does not collide with the other controllers.
+After each step of the motor or heater set value, C<motor1.step.*> and C<heater1.step.*> show the overshoot in percent, and the 10% to 90% rise time and the settling time in ms (-1 if not reached).
+Set C<STEP_RESPONSE_FILE> to write the samples of each step to a CSV file for plotting. Use a baud rate of 57600 or above, as the samples take a good share of the link.
+
 =head1 REFERENCES
 
 =over
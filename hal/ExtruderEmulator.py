@@ -0,0 +1,365 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+RepStrap Extruder Controller emulator
+
+This is an emulation of the Extruder Controller firmware protocol (ExtruderController/Communication.pde)
+behind a pseudo terminal, so the driver and the communication module could be run and benchmarked without any hardware.
+
+When invoked directly, it prints the pseudo terminal device and serves until interrupted.
+Set COMM_PORT of the driver to the device to run the driver against it.
+"""
+import sys
+import os
+import pty
+import tty
+import time
+import signal
+import select
+from struct import *
+from RepRapSerialComm import *
+
+__author__ = "Saw Wong (sam@hellosam.net)"
+__date__ = "2009/11/12"
+__license__ = "GPL 3.0"
+
+# The firmware turns itself off if there is no packet for this long, in seconds
+WATCHDOG_TIMEOUT = 1.0
+# The temperature the heaters cool down to
+AMBIENT_TEMPERATURE = 20.0
+# Samples in each batch pushed while streaming, as STREAM_BATCH_SAMPLES in Configuration.h
+STREAM_BATCH_SAMPLES = 4
+# Longest step in seconds the motor is simulated by
+MOTOR_STEP = 0.001
+
+_S16 = Struct('<h')
+
+class ExtruderEmulator:
+    """
+    Emulates the Extruder Controller behind a pseudo terminal.
+
+    Commands 80 to 106 are answered as the firmware does: the response code, the reply data,
+    the command byte echoed as the tag, and the CRC. Packets failed the CRC check are answered with RC_CRC_MISMATCH,
+    and packets for other RS485 addresses are ignored.
+
+    Every byte received or sent takes byte_time seconds on the wire, which is 10 bits at the baud rate in use by default.
+    Each command takes process_time seconds on top of that.
+    The heaters move toward the set value at heat_rate degree per second while the machine is on, and cool down otherwise.
+    The motor speed follows the set value as a second order system of motor_frequency (rad/s) and motor_damping,
+    so its step response overshoots and settles as a PID controlled motor does.
+    While streaming (command 105), the samples are pushed in batches as the firmware does.
+    With rs485, as the firmware built with RS485_ENABLED, a batch is sent only in place of the reply when polled (command 106).
+    The responses to the requests numbered in drop (counted from 0) are not sent, as if they were lost on the wire,
+    and those numbered in corrupt are sent with a wrong CRC.
+
+    The emulator serves in a child process, so it takes no CPU time from the process being measured.
+    """
+    def __init__(self, baudrate = 38400, byte_time = None, process_time = 0.0001, heat_rate = 20.0, address = 0,
+            motor_frequency = 40.0, motor_damping = 0.5, drop = (), corrupt = (), rs485 = False):
+        self.baudrate = baudrate
+        self.byte_time = byte_time
+        self.process_time = process_time
+        self.heat_rate = heat_rate
+        self.motor_frequency = motor_frequency
+        self.motor_damping = motor_damping
+        self.drop = drop
+        self.corrupt = corrupt
+        self.rs485 = rs485
+        self.address = address
+        self.baudrates = [38400, 57600, 115200]
+        self.port = None
+        self._pid = None
+        self._master = None
+        self._slave = None
+
+    def start(self):
+        """
+        Open the pseudo terminal and start serving in a child process. Returns the device to be opened as the serial port.
+        """
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+
+        self._pid = os.fork()
+        if self._pid == 0:
+            try:
+                os.close(self._slave)
+                self.serve()
+            finally:
+                os._exit(0)
+        os.close(self._master)
+        self._master = None
+        return self.port
+
+    def stop(self):
+        """
+        Stop the child process and close the pseudo terminal
+        """
+        if self._pid != None:
+            os.kill(self._pid, signal.SIGTERM)
+            os.waitpid(self._pid, 0)
+            self._pid = None
+        if self._slave != None:
+            os.close(self._slave)
+            self._slave = None
+
+    def serve(self):
+        """
+        Serve the requests on the master side of the pseudo terminal, until it is closed.
+        """
+        self._reset_state()
+        buf = bytearray()
+        while True:
+            timeout = 0.1
+            if self._stream_interval > 0:
+                timeout = min(max(self._stream_next - monotonic(), 0), timeout)
+            r = select.select([self._master], [], [], timeout)[0]
+            now = monotonic()
+            self._stream(now)
+            self._update(now)
+            if now - self._last_packet > WATCHDOG_TIMEOUT:
+                self._turn_off()
+                self._set_baudrate(self.baudrates[0])
+                self._start_stream(0)
+            if len(r) == 0:
+                continue
+
+            try:
+                data = os.read(self._master, 1024)
+            except OSError:
+                return
+            if not data:
+                return
+            buf += data
+
+            while True:
+                pos = buf.find(chr(SimplePacket.START_BYTE))
+                if pos < 0:
+                    del buf[:]
+                    break
+                del buf[:pos]
+                if len(buf) < SimplePacket.HEADER_LENGTH or len(buf) < buf[1] + SimplePacket.HEADER_LENGTH + 1:
+                    break
+                length = buf[1]
+                frame = buf[0:length + SimplePacket.HEADER_LENGTH + 1]
+                del buf[:len(frame)]
+                self._wire(len(frame))
+                self._stream(monotonic())
+                self._handle(frame[SimplePacket.HEADER_LENGTH:-1], frame[-1])
+
+    def _reset_state(self):
+        self.machine_on = 0
+        self.heater_pv = [AMBIENT_TEMPERATURE, AMBIENT_TEMPERATURE]
+        self.heater_sv = [0, 0]
+        self.motor_pv = 0
+        self.motor_sv = 0
+        self._motor_speed = 0.0
+        self._motor_acceleration = 0.0
+        self._start_stream(0)
+        self._last_update = monotonic()
+        self._last_packet = self._last_update
+        self._baudrate_pending = None
+        self._requests = 0
+        self._set_baudrate(self.baudrate)
+
+    def _set_baudrate(self, baudrate):
+        self._serial_speed = baudrate
+        if self.byte_time != None:
+            self._byte_time = self.byte_time
+        else:
+            self._byte_time = 10.0 / baudrate
+
+    def _wire(self, size):
+        """
+        Wait for the bytes to go through the wire
+        """
+        delay = size * self._byte_time
+        if delay > 0:
+            time.sleep(delay)
+
+    def _update(self, now):
+        """
+        Move the heaters and the motor toward the set values
+        """
+        dt = now - self._last_update
+        if dt <= 0:
+            # Updated by a later sample already
+            return
+        self._last_update = now
+        for i in range(2):
+            pv = self.heater_pv[i]
+            if self.machine_on and pv < self.heater_sv[i]:
+                self.heater_pv[i] = min(pv + self.heat_rate * dt, self.heater_sv[i])
+            elif pv > AMBIENT_TEMPERATURE and (not self.machine_on or pv > self.heater_sv[i]):
+                self.heater_pv[i] = max(pv - self.heat_rate / 4 * dt, AMBIENT_TEMPERATURE)
+        sv = 0
+        if self.machine_on:
+            sv = self.motor_sv
+        w = self.motor_frequency
+        while dt > 0:
+            step = min(dt, MOTOR_STEP)
+            dt -= step
+            self._motor_acceleration += (w * w * (sv - self._motor_speed)
+                - 2 * self.motor_damping * w * self._motor_acceleration) * step
+            self._motor_speed += self._motor_acceleration * step
+        self.motor_pv = int(round(self._motor_speed))
+
+    def _start_stream(self, interval):
+        self._stream_interval = interval / 1000.0
+        self._stream_start = monotonic()
+        self._stream_next = self._stream_start
+        self._stream_batch = None
+        self._stream_pending = None
+        self._stream_sequence = 0
+
+    def _stream(self, now):
+        """
+        Take the samples due by now, and push the batches filled, the way stream_telemetry() of the firmware does.
+        With rs485, the batch filled waits to be polled for, and the one not polled for is dropped.
+        """
+        while self._stream_interval > 0 and self._stream_next <= now:
+            self._update(self._stream_next)
+            if self._stream_batch == None:
+                batch = SimplePacket()
+                batch.add_8(SimplePacket.RC_OK)
+                batch.add_8(self.address)
+                batch.add_8(self._stream_sequence)
+                batch.add_16(int(round((self._stream_next - self._stream_start) * 1000)))
+                self._stream_batch = batch
+                self._stream_samples = 0
+            batch = self._stream_batch
+            batch.add_16(self.motor_pv)
+            batch.add_16(self.motor_sv)
+            batch.add_16(int(self.heater_pv[0]))
+            self._stream_next += self._stream_interval
+            self._stream_samples += 1
+            if self._stream_samples == STREAM_BATCH_SAMPLES:
+                batch.add_8(106)
+                if self.rs485:
+                    self._stream_pending = batch
+                else:
+                    self._send(batch)
+                self._stream_batch = None
+                self._stream_sequence = (self._stream_sequence + 1) & 0xff
+
+    def _turn_off(self):
+        self.machine_on = 0
+
+    def _status(self):
+        status = bytearray(6)
+        if self.machine_on:
+            status[0] |= 2
+        for i in range(2):
+            if self.machine_on and self.heater_pv[i] < self.heater_sv[i]:
+                status[5] |= 1 << i
+        return status
+
+    def _handle(self, content, crc):
+        """
+        Answer one request, the way handle_query() of the firmware does
+        """
+        if len(content) < 2 or content[0] != self.address:
+            return
+        self._last_packet = monotonic()
+
+        reply = SimplePacket()
+        if crc != crc_of(content):
+            reply.add_8(SimplePacket.RC_CRC_MISMATCH)
+            self._send(reply)
+            return
+
+        if self.process_time > 0:
+            time.sleep(self.process_time)
+
+        rc = SimplePacket.RC_OK
+        data = bytearray()
+        cmd = content[1]
+        param = content[2:]
+        if cmd == 80:
+            data = self._status()
+        elif cmd == 81:
+            self.machine_on = 1
+        elif cmd == 82:
+            self._turn_off()
+        elif cmd in (91, 93):
+            i = (cmd - 91) / 2
+            data = bytearray(pack('<HH', int(self.heater_pv[i]), self.heater_sv[i] & 0xffff))
+        elif cmd in (92, 94) and len(param) >= 2:
+            self.heater_sv[(cmd - 92) / 2] = _S16.unpack_from(bytes(param))[0]
+        elif cmd == 95:
+            data = bytearray(pack('<HH', self.motor_pv & 0xffff, self.motor_sv & 0xffff))
+        elif cmd in (96, 97) and len(param) >= 2:
+            value = _S16.unpack_from(bytes(param))[0]
+            if value >= -16383 and value < 16383:
+                if cmd == 97:
+                    self.motor_sv = value
+            else:
+                rc = SimplePacket.RC_CMD_UNSUPPORTED
+        elif cmd in (98, 99):
+            pass
+        elif cmd == 101:
+            data = self._status() + bytearray(pack('<HHHHHH',
+                int(self.heater_pv[0]), self.heater_sv[0] & 0xffff, int(self.heater_pv[1]), self.heater_sv[1] & 0xffff,
+                self.motor_pv & 0xffff, self.motor_sv & 0xffff))
+        elif cmd == 102:
+            for baudrate in self.baudrates:
+                data += pack('<I', baudrate)
+        elif cmd == 103 and len(param) >= 4:
+            baudrate = unpack('<I', bytes(param[0:4]))[0]
+            if baudrate not in self.baudrates:
+                rc = SimplePacket.RC_CMD_UNSUPPORTED
+            elif baudrate != self._serial_speed:
+                self._baudrate_pending = baudrate
+        elif cmd == 104:
+            data = param
+        elif cmd == 105 and len(param) >= 1:
+            self._start_stream(param[0])
+        elif cmd == 106:
+            # Polled for the batch. The reply has no data if none is pending.
+            pass
+        else:
+            # This includes 100, which falls through to the default case in the firmware
+            rc = SimplePacket.RC_CMD_UNSUPPORTED
+
+        if cmd == 106 and self._stream_pending != None:
+            # Polled for the batch, which goes in place of the reply
+            reply = self._stream_pending
+            self._stream_pending = None
+        else:
+            reply.add_8(rc)
+            reply.update(data)
+            reply.add_8(cmd)
+        if self._requests in self.corrupt:
+            self._send(reply, True)
+        elif not self._requests in self.drop:
+            self._send(reply)
+        self._requests += 1
+
+        if self._baudrate_pending != None:
+            self._set_baudrate(self._baudrate_pending)
+            self._baudrate_pending = None
+
+    def _send(self, reply, corrupt = False):
+        frame = reply.frame()
+        if corrupt:
+            frame = bytearray(frame)
+            frame[-1] ^= 0xff
+        self._wire(len(frame))
+        os.write(self._master, bytes(frame))
+
+def main(argv=None):
+	"""
+	Serve the driver on a pseudo terminal until interrupted
+	"""
+	emulator = ExtruderEmulator()
+	print "Extruder Controller emulator serving on %s" % emulator.start()
+	try:
+		while True:
+			time.sleep(1)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		emulator.stop()
+
+if __name__ == "__main__":
+	main()
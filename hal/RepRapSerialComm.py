@@ -8,14 +8,83 @@ This is a library for RepRap/RepStrap communication. Not to be invoked directly.
 import sys
 import time
 import os
+import errno
+import select
 import serial
-from datetime import datetime, timedelta 
+from collections import deque
 from struct import *
 
 __author__ = "Saw Wong (sam@hellosam.net)"
 __date__ = "2009/11/12"
 __license__ = "GPL 3.0"
 
+try:
+    from time import monotonic
+except ImportError:
+    import ctypes
+    import ctypes.util
+
+    class _timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    _CLOCK_MONOTONIC = 1
+    _clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1', use_errno = True).clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+    def monotonic():
+        """
+        Returns the time in seconds from a clock which never goes backward.
+        """
+        t = _timespec()
+        if _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return t.tv_sec + t.tv_nsec * 1e-9
+
+def _build_crc_table():
+    """
+    Precompute the CRC of every possible byte value, for the 0x8C polynomial.
+    """
+    table = []
+    for d in range(256):
+        crc = d
+        for i in range(8):
+            if crc & 0x01:
+                crc = (crc >> 1) ^ 0x8C
+            else:
+                crc >>= 1
+        table.append(crc)
+    return table
+
+CRC_TABLE = _build_crc_table()
+
+# Little endian number fields of a packet
+_U8 = Struct('<B')
+_U16 = Struct('<H')
+_U32 = Struct('<I')
+
+def wait_readable(rlist, timeout):
+    """
+    Wait with select until any file in rlist is readable, or the timeout in seconds expires. Returns the readable ones.
+    An empty list is returned if the wait is interrupted by a signal.
+    """
+    try:
+        return select.select(rlist, [], [], timeout)[0]
+    except select.error ,err:
+        if err[0] != errno.EINTR:
+            raise
+        return []
+
+def crc_of(buffer, crc = 0):
+    """
+    Returns the CRC of the whole buffer (str, bytearray or a list of integers).
+    An initial CRC could be given to continue a previous calculation.
+    """
+    table = CRC_TABLE
+    for d in bytearray(buffer):
+        crc = table[crc ^ d]
+    return crc
+
 class RepRapSerialComm:
     """
     Communication class which handles packetize two-way communication over serial port.
@@ -32,48 +101,131 @@ class RepRapSerialComm:
     Byte n+1: CRC
     """
     _read_timeout = 100
+
+    # Number of echo packets which must come back intact at a new baud rate
+    BAUD_ECHO_TESTS = 8
+    # Time in seconds the microcontroller takes to fall back to the default baud rate when a switch is not confirmed
+    BAUD_PROBATION = 0.5
+    # Time in seconds for the microcontroller to give up the invalid bytes pumped by a reset,
+    # and the time reset() spends at most dumping what it still sends afterward
+    RESET_SETTLE_TIME = 0.1
+    RESET_DRAIN_TIMEOUT = 0.1
  
-    def __init__(self, port = "/dev/ttyUSB0", baudrate = 38400):
+    def __init__(self, port = "/dev/ttyUSB0", baudrate = 38400, stats = None):
         """
         Connect to the device through the specific port and at the specific baudrate.
+        The counters are kept in stats (a CommStats), so they could outlive the connection. A new one is created if not given.
         """
         self.ser = None
+        if stats == None:
+            stats = CommStats()
+        self.stats = stats
+        self.capture = None
         self.ser = serial.Serial(port, baudrate, rtscts=0)
-        self._read_state = 0
-        self._read_length_left = 0
-        self._read_packet = None
+        self._parser = FrameParser()
+        self._read_frames = deque()
         self._read_next_timeout = None
+        self.baudrates = None
 
     def reset(self):
         """
-        Reset the state of the bus to a clean state by pumping invalid packets
+        Reset the state of the bus to a clean state by pumping invalid packets. This blocks for RESET_SETTLE_TIME and more.
         """
+        self.start_reset()
+        time.sleep(RepRapSerialComm.RESET_SETTLE_TIME)
+        deadline = monotonic() + RepRapSerialComm.RESET_DRAIN_TIMEOUT
+        while not self.drain_reset(deadline):
+            time.sleep(0.005)
+
+    def start_reset(self):
+        """
+        Start a reset without blocking: drop what is received, and pump invalid packets.
+        Call drain_reset() once RESET_SETTLE_TIME has passed, and again until it returns True.
+        """
+        self.stats.resets += 1
         self.ser.flushInput()
+        self._parser.reset()
+        self._read_frames.clear()
+        self._read_next_timeout = None
         self.ser.write(" " * 64)
 
-        time.sleep(0.1)
-        if self.ser.inWaiting() > 0:
-            # If there are packets in the midstream, dump them.
-            while self.process() == None:
-                pass
+    def drain_reset(self, deadline):
+        """
+        Dump the packets in the midstream. Returns True once nothing more is received, or the deadline (monotonic()) passed,
+        as the other end could keep sending garbage.
+        """
+        if self.ser.inWaiting() > 0 and monotonic() < deadline:
+            self.ser.flushInput()
+            return False
+        self.ser.flushInput()
+        self._parser.reset()
+        self._read_frames.clear()
+        self._read_next_timeout = None
+        return True
              
     def send(self, packet):
-        self.ser.write(pack('B', SimplePacket.START_BYTE))
-        self.ser.write(pack('B', len(packet.buf)))
-        self.ser.write(packet.buf)
-        self.ser.write(pack('B', packet.crc))
+        """
+        Send a packet. The whole frame is written at once.
+        """
+        frame = packet.frame()
+        self.ser.write(frame)
+        if self.capture != None:
+            self.capture.record(WireCapture.SENT, frame)
+        self.stats.frames_sent += 1
+        self.stats.bytes_sent += len(frame)
+
+    def send_many(self, packets):
+        """
+        Send a batch of packets. The frames are concatenated and written at once.
+        """
+        if len(packets) == 0:
+            return
+        buf = bytearray()
+        for packet in packets:
+            buf += packet.frame()
+        self.ser.write(buf)
+        if self.capture != None:
+            self.capture.record(WireCapture.SENT, buf)
+        self.stats.frames_sent += len(packets)
+        self.stats.bytes_sent += len(buf)
  
     def readback(self):
         """
         This should be called whenever packet is expected. This should be used when response is expected from the other end.
         
-        Returns a SimplePacket if a packet (valid or invalid) is read. Returns None otherwise. 
+        Returns a SimplePacket if a packet is read, or one with rc == RC_CRC_MISMATCH if the frame fails the CRC check.
+        Returns None otherwise.
         A packet with rc == RC_NO_RESPONSE will be returned eventually if response is not completed within timeout 100ms.
         """
-        if self._read_next_timeout == None:
-            self._read_next_timeout = datetime.now() + timedelta(milliseconds = RepRapSerialComm._read_timeout)
+        self.expect()
         return self.process()
 
+    def readback_all(self):
+        """
+        Same as readback(), but returns a list of every packet read. The list is empty if there is none.
+        """
+        self.expect()
+        return self.process_all()
+
+    def expect(self):
+        """
+        Start the response timeout, unless it is running already. readback() does this implicitly.
+        """
+        if self._read_next_timeout == None:
+            self._read_next_timeout = monotonic() + RepRapSerialComm._read_timeout / 1000.0
+
+    def read_deadline(self):
+        """
+        Returns the monotonic() time when the response timeout expires, or None if the timeout is not running.
+        """
+        return self._read_next_timeout
+
+    def fileno(self):
+        """
+        Returns the file descriptor of the serial port, so it could be waited with select.
+        """
+        return self.ser.fileno()
+
     def process(self):
         """
         This should be called to receive new packet.
@@ -81,65 +233,245 @@ class RepRapSerialComm:
         This should be used if the other end could send data actively.
         (Normally the microcontroller only responses to command, but never send data on its own)
         
-        Returns a SimplePacket if a packet (valid or invalid) is read. Returns None otherwise.
+        Returns a SimplePacket if a packet is read, or one with rc == RC_CRC_MISMATCH if the frame fails the CRC check.
+        Returns None otherwise.
+        The packet reads from the receiving buffer directly, so it is only valid until the buffer is refilled,
+        which happens once every packet received before had been returned.
         Timeout mechanism will not be force triggered, but a packet with RC_NO_RESPONSE could still be returned if transmission stopped in the middle.
         """
-        while self.ser.inWaiting() > 0:
-            if self._read(unpack('B', self.ser.read(1))[0]):
-                return self._read_packet
-            
-        if self._read_next_timeout != None and datetime.now() > self._read_next_timeout:
-            self._read_state = 0
-            if self._read_packet == None:
-                self._read_packet = SimplePacket()
-            self._read_packet.rc = SimplePacket.RC_NO_RESPONSE
+        if len(self._read_frames) == 0:
+            self._receive()
+        if len(self._read_frames) > 0:
+            return self._read_frames.popleft()
+        return self._check_timeout()
+
+    def process_all(self):
+        """
+        Same as process(), but returns a list of every packet read. The list is empty if there is none.
+        """
+        if len(self._read_frames) == 0:
+            self._receive()
+        if len(self._read_frames) > 0:
+            frames = list(self._read_frames)
+            self._read_frames.clear()
+            return frames
+        p = self._check_timeout()
+        if p != None:
+            return [p]
+        return []
+
+    def _receive(self):
+        """
+        Drain everything available from the serial port in one read, and parse every complete frame into the queue.
+        """
+        waiting = self.ser.inWaiting()
+        if waiting <= 0:
+            return
+
+        data = self.ser.read(min(waiting, self._parser.space()))
+        if self.capture != None:
+            self.capture.record(WireCapture.RECEIVED, data)
+        self.stats.bytes_received += len(data)
+        fresh = self._parser.feed(data)
+        self._parse()
+
+        # Time the partial frame from its start byte
+        if self._parser.partial() >= fresh:
+            self._read_next_timeout = monotonic() + RepRapSerialComm._read_timeout / 1000.0
+
+    def _resync(self):
+        """
+        Give up the partial frame which stopped in the middle, and parse the frames received after it.
+        The timeout starts again for the next partial frame, if there is one.
+        """
+        self._parser.resync()
+        self._read_next_timeout = None
+        self._parse()
+        if self._parser.partial() >= 0:
+            self._read_next_timeout = monotonic() + RepRapSerialComm._read_timeout / 1000.0
+
+    def _parse(self):
+        """
+        Cut every complete frame out of the receiving buffer into the queue
+        """
+        errors = self._parser.crc_errors
+        while True:
+            failed = self._parser.crc_errors
+            p = self._parser.next_frame()
+            if self._parser.crc_errors != failed:
+                # The frames failed the CRC check in a row are taken as one response, which is passed on in its place
+                # with RC_CRC_MISMATCH, so the request fails at once instead of by timeout
+                mismatch = SimplePacket()
+                mismatch.rc = SimplePacket.RC_CRC_MISMATCH
+                self._read_frames.append(mismatch)
+                self._read_next_timeout = None
+            if p == None:
+                break
+            self.stats.frames_received += 1
+            self._read_frames.append(p)
             self._read_next_timeout = None
-            return self._read_packet
+        self.stats.crc_errors += self._parser.crc_errors - errors
 
+    def _check_timeout(self):
+        """
+        Returns a packet with RC_NO_RESPONSE if the timeout is reached, giving up any partial frame. Returns None otherwise.
+        """
+        if self._read_next_timeout != None and monotonic() > self._read_next_timeout:
+            self._resync()
+            self.stats.timeouts += 1
+            p = SimplePacket()
+            p.rc = SimplePacket.RC_NO_RESPONSE
+            return p
         return None
 
-    def _read(self, b):
+    def negotiate(self, max_baudrate = None, address = 0):
         """
-        Process any read byte in the state machine
+        Switch both ends to the fastest baud rate supported by the microcontroller (up to max_baudrate),
+        which passes the CRC-verified echo test.
+
+        Faster baud rates are tried first, and any failure falls back to the current baud rate.
+        Returns the baud rate in use afterward. The baud rates the microcontroller supports are left in baudrates,
+        which is empty if it does not support the switch, or None if it did not answer.
+        This must be called while no request is pending.
         """
-        # Start
-        if self._read_state == 0:
-            if b == SimplePacket.START_BYTE:
-                self._read_next_timeout = datetime.now() + timedelta(milliseconds = RepRapSerialComm._read_timeout)
-                self._read_packet = SimplePacket()
-                self._read_state += 1
+        current = self.ser.baudrate
 
-        # Length
-        elif self._read_state == 1:
-            self._read_length_left = b
-            self._read_state += 1
+        # Get baud rates
+        self.baudrates = None
+        p = SimplePacket()
+        p.add_8(address)
+        p.add_8(102)
+        p = self._exchange(p)
+        if p == None:
+            return current
+        self.baudrates = []
+        if p.get_8(0) == SimplePacket.RC_OK:
+            self.baudrates = [p.get_32(i) for i in range(1, len(p) - 3, 4)]
 
-        # Content
-        elif self._read_state == 2:
-            self._read_packet.add_8(b)
-            self._read_length_left -= 1
+        for baudrate in sorted(self.baudrates, reverse = True):
+            if baudrate <= current or (max_baudrate != None and baudrate > max_baudrate):
+                continue
+            if self._switch_baudrate(baudrate, current, address):
+                return baudrate
+        return current
 
-        # CRC
-        elif self._read_state == 3:
-            if b != self._read_packet.crc:
-                self._read_packet.rc = SimplePacket.RC_CRC_MISMATCH
+    def _switch_baudrate(self, baudrate, fallback, address):
+        """
+        Switch to the baud rate and test it. Returns True if it works.
+        Otherwise both ends are back at the fallback baud rate when this returns.
+        """
+        # Set baud rate
+        p = SimplePacket()
+        p.add_8(address)
+        p.add_8(103)
+        p.add_32(baudrate)
+        ok = self._transact(p) != None
 
-            if len(self._read_packet.buf) > 1:
-                self._read_packet.tag = self._read_packet.buf[-1]
-                self._read_packet.buf = self._read_packet.buf[0:-1]
-            self._read_next_timeout = None
-            self._read_state = 0
-            return True
-        
-        if self._read_state == 2 and self._read_length_left == 0:
-            self._read_state = 3
-        
-        return False
+        if ok:
+            time.sleep(0.01)
+            self._use_baudrate(baudrate)
+            ok = self._echo_test(address, RepRapSerialComm.BAUD_ECHO_TESTS)
+
+        if ok:
+            # Confirm the baud rate by setting it again
+            p = SimplePacket()
+            p.add_8(address)
+            p.add_8(103)
+            p.add_32(baudrate)
+            ok = self._transact(p) != None
+
+        if not ok:
+            # Only the reply could be lost, with the switch taken by the microcontroller. Once the probation is over,
+            # it is at the fallback baud rate, unless it took the confirmation.
+            self._use_baudrate(fallback)
+            time.sleep(RepRapSerialComm.BAUD_PROBATION + 0.1)
+            self.reset()
+            if not self._echo_test(address, 1):
+                self._use_baudrate(baudrate)
+                if self._echo_test(address, 1):
+                    print >> sys.stderr, "Baud rate %d is confirmed, but its reply was lost" % baudrate
+                    return True
+                self._use_baudrate(fallback)
+            print >> sys.stderr, "Baud rate %d failed the test. Falling back to %d" % (baudrate, fallback)
+        return ok
+
+    def _use_baudrate(self, baudrate):
+        """
+        Set the baud rate of this end, and drop what was received at the previous one
+        """
+        self.ser.baudrate = baudrate
+        self.ser.flushInput()
+        self._parser.reset()
+        self._read_frames.clear()
+        self._read_next_timeout = None
+
+    def _echo_test(self, address, count):
+        """
+        Send count echo packets. Returns True if every one comes back intact.
+        """
+        for i in range(count):
+            # Echo, with the start byte and the extreme values in the payload
+            p = SimplePacket()
+            p.add_8(address)
+            p.add_8(104)
+            content = bytearray([SimplePacket.START_BYTE, 0x00, 0xFF, 0x55, 0xAA, i])
+            p.update(content)
+            reply = self._transact(p)
+            if reply == None or bytearray(reply.buf[1:]) != content:
+                return False
+        return True
+
+    def _transact(self, p):
+        """
+        Send a packet and wait for the response.
+        Returns the response if it is valid and the microcontroller accepts the command, None otherwise.
+        """
+        p = self._exchange(p)
+        if p == None or p.get_8(0) != SimplePacket.RC_OK:
+            return None
+        return p
+
+    def _exchange(self, p):
+        """
+        Send a packet and wait for the response, which echoes the command byte.
+        Any other frame received meanwhile, such as a stream batch (106), is skipped.
+        Returns the response if it is valid, whatever its return code, or None if it is lost.
+        """
+        cmd = p.get_8(1)
+        self.send(p)
+        deadline = monotonic() + RepRapSerialComm._read_timeout / 1000.0
+        while True:
+            p = self.readback()
+            if p != None and (p.rc != SimplePacket.RC_OK or p.tag == cmd):
+                break
+            if monotonic() > deadline:
+                self._resync()
+                self.stats.timeouts += 1
+                return None
+        if p.rc != SimplePacket.RC_OK:
+            return None
+        return p
+
+    def start_capture(self, path):
+        """
+        Record everything sent and received to the capture file (see WireCapture). The file is appended if it exists.
+        """
+        self.stop_capture()
+        self.capture = WireCapture(path)
+
+    def stop_capture(self):
+        """
+        Stop recording, and write out the buffered records
+        """
+        if self.capture != None:
+            self.capture.close()
+            self.capture = None
 
     def close(self):
         """
         Shutdown the connection
         """
+        self.stop_capture()
         if self.ser != None:
             self.ser.close()
             self.ser = None
@@ -147,14 +479,508 @@ class RepRapSerialComm:
     def __del__(self):
         self.close()
 
-class SimplePacket:
+class WireCapture(object):
+    """
+    Append-only binary log of the bytes on the wire, for the problems to be reproduced offline with repstrap-replay.py.
+
+    The file starts with MAGIC, followed by the records. Each record is:
+    8 bytes: monotonic() time of the write or read, as a little endian double
+    1 byte: Direction, SENT or RECEIVED
+    2 bytes: Length of the data, little endian
+    n bytes: The data as it is written or read. A write could be several frames,
+             and a read could have partial frames or noise.
+
+    The records are written through a large buffer, so recording costs no system call most of the time.
+    """
+    MAGIC = "RSCAP\x01\n"
+    SENT = 0
+    RECEIVED = 1
+    HEADER = Struct('<dBH')
+
+    def __init__(self, path, buffering = 65536):
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, 'ab', buffering)
+        if new:
+            self._file.write(WireCapture.MAGIC)
+
+    def record(self, direction, data, timestamp = None):
+        """
+        Append a record of the data (str or bytearray)
+        """
+        if timestamp == None:
+            timestamp = monotonic()
+        self._file.write(WireCapture.HEADER.pack(timestamp, direction, len(data)))
+        self._file.write(data)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if self._file != None:
+            self._file.close()
+            self._file = None
+
+class Histogram(object):
+    """
+    Distribution of integer samples (e.g. times in us), cheap enough to be kept all the time.
+
+    Samples are counted in log2 buckets: bucket i counts the samples below 2**i, which are not in bucket i-1.
+    The count, total and maximum are kept for the whole life, and for the interval since take_interval() was last called.
+    """
+    __slots__ = ('count', 'total', 'max', 'buckets', '_count', '_total', '_max')
+
+    BUCKETS = 32
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets = [0] * Histogram.BUCKETS
+        self._count = 0
+        self._total = 0
+        self._max = 0
+
+    def add(self, value):
+        """
+        Count a sample
+        """
+        value = int(value)
+        self.count += 1
+        self.total += value
+        self._count += 1
+        self._total += value
+        if value > self._max:
+            self._max = value
+            if value > self.max:
+                self.max = value
+        self.buckets[min(value.bit_length(), Histogram.BUCKETS - 1)] += 1
+
+    def take_interval(self):
+        """
+        Returns the count, total and maximum of the samples since the last call
+        """
+        interval = (self._count, self._total, self._max)
+        self._count = 0
+        self._total = 0
+        self._max = 0
+        return interval
+
+    def percentile(self, fraction):
+        """
+        Returns the upper bound of the bucket, below which the fraction of the samples are
+        """
+        target = self.count * fraction
+        seen = 0
+        for i in range(Histogram.BUCKETS):
+            seen += self.buckets[i]
+            if seen >= target and seen > 0:
+                return min(2 ** i, self.max)
+        return 0
+
+    def __str__(self):
+        if self.count == 0:
+            return "no sample"
+        return "count %d, avg %d, p50 <= %d, p90 <= %d, p99 <= %d, max %d" % (
+            self.count, self.total / self.count,
+            self.percentile(0.5), self.percentile(0.9), self.percentile(0.99), self.max)
+
+class CommStats(object):
+    """
+    Counters of the communication, kept by RepRapSerialComm
+    """
+    def __init__(self):
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.frames_received = 0
+        self.bytes_received = 0
+        self.crc_errors = 0
+        self.timeouts = 0
+        self.resets = 0
+        self.retransmissions = 0
+        # Writes merged into the one not sent yet, or skipped as the value is written already
+        self.coalesced = 0
+        self.unsolicited = 0
+        # Requests queued or in flight, as of the last flush
+        self.queue_depth = 0
+        self.queue_depths = Histogram()
+        # Round trip time in us, of every command and by command
+        self.rtt = Histogram()
+        self.rtt_by_command = {}
+
+    def add_rtt(self, cmd, us):
+        """
+        Count a round trip time of the command
+        """
+        self.rtt.add(us)
+        histogram = self.rtt_by_command.get(cmd)
+        if histogram == None:
+            histogram = Histogram()
+            self.rtt_by_command[cmd] = histogram
+        histogram.add(us)
+
+    def dump(self, out):
+        """
+        Print every counter to the file
+        """
+        print >> out, "Frames sent: %d (%d bytes), received: %d (%d bytes)" % (
+            self.frames_sent, self.bytes_sent, self.frames_received, self.bytes_received)
+        print >> out, "CRC errors: %d, timeouts: %d, resets: %d, retransmissions: %d, coalesced: %d, unsolicited: %d" % (
+            self.crc_errors, self.timeouts, self.resets, self.retransmissions, self.coalesced, self.unsolicited)
+        print >> out, "Queue depth: %d, %s" % (self.queue_depth, self.queue_depths)
+        print >> out, "Round trip (us): %s" % (self.rtt)
+        for cmd in sorted(self.rtt_by_command.keys()):
+            print >> out, "  Command %d: %s" % (cmd, self.rtt_by_command[cmd])
+
+class PacketError(Exception):
+    """
+    Represents a request which is not completed with a valid response
+    """
+    def __init__(self, rc, msg):
+        self.rc = rc
+        self.msg = msg
+
+    def __str__(self):
+        return "%s (RC: %d)" % (self.msg, self.rc)
+
+class PacketRequest(object):
+    """
+    A request sent through AsyncRepRapSerialComm.
+
+    It is completed either by the response, or by an error such as timeout or CRC mismatch.
+    The callbacks are called upon completion with the request as the argument.
+    """
+    def __init__(self, packet, timeout):
+        self.packet = packet
+        # The microcontroller echoes the command byte as the tag of the response
+        self.tag = packet.get_8(1)
+        self.timeout = timeout
+        self.sent = None
+        self.deadline = None
+        self.size = 0
+        self.reply = None
+        self.rc = None
+        self._callbacks = []
+
+    def done(self):
+        """
+        Returns True if the request is completed
+        """
+        return self.rc != None
+
+    def result(self):
+        """
+        Returns the response packet.
+        Raises PacketError if the request is not completed or completed with error.
+        """
+        if self.rc == None:
+            raise PacketError(SimplePacket.RC_GENERIC_ERROR, "The request is not completed yet")
+        if self.rc != SimplePacket.RC_OK:
+            raise PacketError(self.rc, "The request failed")
+        return self.reply
+
+    def replace(self, packet):
+        """
+        Send the packet instead, if the request is not sent yet. Returns False if it is sent already.
+        """
+        if self.sent != None or self.rc != None:
+            return False
+        self.packet = packet
+        self.tag = packet.get_8(1)
+        return True
+
+    def add_done_callback(self, callback):
+        """
+        Call the callback upon completion. It is called immediately if the request is completed already.
+        """
+        if self.rc != None:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def _complete(self, rc, reply = None):
+        self.rc = rc
+        self.reply = reply
+        callbacks = self._callbacks
+        self._callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+class AsyncRepRapSerialComm(RepRapSerialComm):
+    """
+    Communication class where each request is paired with its response.
+
+    A request is queued by request() and sent by flush(), and it completes when the response arrives or times out.
+    Responses are matched to the oldest request in flight with the same tag (the echoed command byte),
+    so a lost response fails only its own request, by timeout.
+    A request waits while another one with the same tag is in flight, so only requests of different commands are pipelined.
+    Those of the same command go one round trip at a time.
+
+    Requests are pipelined within a window, which is the number of bytes in flight the microcontroller could buffer.
+    Requests beyond the window wait in the queue until responses come back.
+    On a half-duplex RS485 bus, the host must not send while the microcontroller replies, so the window is HALF_DUPLEX_WINDOW:
+    one request is in flight at a time.
+
+    Several microcontrollers could share a RS485 bus, each at its own address (the first byte of the packet).
+    The responses do not carry the address, and only one microcontroller could talk on the bus at a time,
+    so requests in flight are always to a single address. The addresses with queued requests take turns,
+    each sending up to a window of requests in its turn, so a busy one could not starve the others.
+
+    poll() waits for the serial port and dispatches what is received. The caller could wait in its own select loop
+    on fileno() until next_deadline() instead, and call poll(0) afterward.
+
+    Packets not matching any request are passed to the unsolicited callback, if it is set.
+    """
+    # Receiving buffer size of the microcontroller serial port
+    DEFAULT_WINDOW = 128
+    # A window smaller than any request, which lets only one through at a time
+    HALF_DUPLEX_WINDOW = 0
+
+    def __init__(self, port = "/dev/ttyUSB0", baudrate = 38400, window = DEFAULT_WINDOW, stats = None):
+        RepRapSerialComm.__init__(self, port, baudrate, stats)
+        self.window = window
+        self.unsolicited = None
+        self.resetting = False
+        # Address -> queued requests, and the addresses with queued requests in the order of their turns
+        self._outboxes = {}
+        self._turns = deque()
+        self._queued = 0
+        self._inflight = []
+        self._inflight_bytes = 0
+        self._inflight_address = None
+
+    def start_reset(self):
+        """
+        Start a reset. Every pending request is completed with RC_CANCELLED.
+        Until drain_reset() returns True, nothing is sent, and what is received is dropped.
+        """
+        RepRapSerialComm.start_reset(self)
+        self.resetting = True
+        self.cancel_all()
+
+    def drain_reset(self, deadline):
+        if not RepRapSerialComm.drain_reset(self, deadline):
+            return False
+        self.resetting = False
+        return True
+
+    def cancel_all(self):
+        """
+        Complete every pending request with RC_CANCELLED
+        """
+        requests = list(self._inflight)
+        for address in self._turns:
+            requests += self._outboxes[address]
+        self._outboxes = {}
+        self._turns.clear()
+        self._queued = 0
+        self._inflight = []
+        self._inflight_bytes = 0
+        for request in requests:
+            request._complete(SimplePacket.RC_CANCELLED)
+
+    def request(self, packet, callback = None, timeout = None):
+        """
+        Queue a packet to be sent by the next flush(). Returns a PacketRequest.
+        The request times out if the response is not received within timeout (in seconds, 100ms by default) after it is sent.
+        """
+        if timeout == None:
+            timeout = RepRapSerialComm._read_timeout / 1000.0
+        request = PacketRequest(packet, timeout)
+        if callback != None:
+            request.add_done_callback(callback)
+        address = packet.get_8(0)
+        outbox = self._outboxes.get(address)
+        if outbox == None:
+            outbox = deque()
+            self._outboxes[address] = outbox
+            self._turns.append(address)
+        outbox.append(request)
+        self._queued += 1
+        return request
+
+    def pending(self):
+        """
+        Returns the number of requests not completed yet
+        """
+        return self._queued + len(self._inflight)
+
+    def flush(self):
+        """
+        Send the queued requests which fit in the window, in one write.
+        Requests to another address wait until every request in flight is completed, and it is the turn of their address.
+        A request waits as well while another one with the same tag is in flight, as the response could not tell them apart:
+        had the response to the first one been lost, the second one would take the response of the first.
+        Nothing is sent while a reset is in progress.
+        """
+        if self.resetting:
+            return
+        packets = []
+        tags = set([request.tag for request in self._inflight])
+        while len(self._turns) > 0:
+            address = self._turns[0]
+            if len(self._inflight) > 0 and address != self._inflight_address:
+                break
+            outbox = self._outboxes[address]
+            while len(outbox) > 0:
+                if outbox[0].tag in tags:
+                    break
+                size = len(outbox[0].packet) + SimplePacket.HEADER_LENGTH + 1
+                # Always let one request through, or a request larger than the window would never be sent
+                if self._inflight_bytes + size > self.window and len(self._inflight) > 0:
+                    break
+                request = outbox.popleft()
+                tags.add(request.tag)
+                request.size = size
+                self._inflight.append(request)
+                self._inflight_bytes += size
+                packets.append(request.packet)
+            self._inflight_address = address
+            if len(outbox) > 0:
+                # The window is full, or the next request waits for its tag. The address takes its next turn after the others.
+                self._turns.rotate(-1)
+                break
+            del self._outboxes[address]
+            self._turns.popleft()
+        if len(packets) == 0:
+            return
+
+        self._queued -= len(packets)
+        self.stats.queue_depth = len(self._inflight) + self._queued
+        self.stats.queue_depths.add(self.stats.queue_depth)
+        self.send_many(packets)
+        now = monotonic()
+        for request in self._inflight[len(self._inflight) - len(packets):]:
+            request.sent = now
+            request.deadline = now + request.timeout
+
+    def next_deadline(self):
+        """
+        Returns the monotonic() time when the earliest request or partially received frame times out,
+        or None if nothing is being waited.
+        """
+        deadline = self._read_next_timeout
+        for request in self._inflight:
+            if deadline == None or request.deadline < deadline:
+                deadline = request.deadline
+        return deadline
+
+    def poll(self, timeout = 0):
+        """
+        Wait for up to timeout seconds until something is received, then dispatch the responses and timeouts.
+        The response packets read from the receiving buffer directly, so they are only valid until the next poll().
+        """
+        if timeout > 0:
+            wait_readable([self.fileno()], timeout)
+        self.dispatch()
+
+    def dispatch(self):
+        """
+        Complete the requests with the responses received, with RC_CRC_MISMATCH if the response fails the CRC check,
+        or with RC_NO_RESPONSE if they time out.
+        """
+        if self.resetting:
+            self.ser.flushInput()
+            return
+        if len(self._read_frames) == 0:
+            self._receive()
+        now = monotonic()
+        while len(self._read_frames) > 0:
+            p = self._read_frames.popleft()
+            if p.rc == SimplePacket.RC_CRC_MISMATCH and (len(self._inflight) == 0 or (len(self._read_frames) > 0 and
+                    self._read_frames[0].tag in (self._inflight[0].tag, -1))):
+                # The oldest request is answered right after, or none is waiting, so what failed the check was noise
+                continue
+            request, lost = self._match(p)
+            self.stats.timeouts += len(lost)
+            for r in lost:
+                r._complete(SimplePacket.RC_NO_RESPONSE)
+            if request != None:
+                if p.rc == SimplePacket.RC_OK:
+                    self.stats.add_rtt(request.tag, (now - request.sent) * 1e6)
+                request._complete(p.rc, p)
+            else:
+                self.stats.unsolicited += 1
+                if self.unsolicited != None and p.rc == SimplePacket.RC_OK:
+                    self.unsolicited(p)
+
+        if self._read_next_timeout != None and now > self._read_next_timeout:
+            # Give up the frame which stopped in the middle, and look for the frames after it
+            self._resync()
+            if len(self._read_frames) > 0:
+                self.dispatch()
+                return
+
+        expired = [request for request in self._inflight if request.deadline <= now]
+        self.stats.timeouts += len(expired)
+        for request in expired:
+            self._remove(request)
+        for request in expired:
+            request._complete(SimplePacket.RC_NO_RESPONSE)
+
+    def _match(self, p):
+        """
+        Find and remove the oldest request in flight the packet responds to.
+
+        Returns the request (None if there is none), and the list of requests sent before it.
+        The microcontroller answers in order, so the responses of those are lost and they are removed as well.
+        A reply without the tag, which is how the microcontroller answers a request failed the CRC check,
+        could only match the oldest request. So does a response which fails the CRC check here.
+        """
+        for i in range(len(self._inflight)):
+            request = self._inflight[i]
+            if p.tag == request.tag or p.tag == -1:
+                lost = self._inflight[0:i]
+                for r in lost + [request]:
+                    self._remove(r)
+                return request, lost
+        return None, []
+
+    def _remove(self, request):
+        self._inflight.remove(request)
+        self._inflight_bytes -= request.size
+
+    def wait(self, request):
+        """
+        Send any queued request, then block until the request is completed. Returns the response packet.
+        Raises PacketError on timeout or CRC mismatch.
+        """
+        self.flush()
+        while not request.done():
+            deadline = self.next_deadline()
+            if deadline == None:
+                break
+            self.poll(max(deadline - monotonic(), 0.001))
+            # The request could be waiting for another one with the same tag
+            self.flush()
+        return request.result()
+
+    def drain(self):
+        """
+        Send every queued request, then block until all of them are completed, dispatching the responses.
+        """
+        self.flush()
+        while self.pending() > 0:
+            deadline = self.next_deadline()
+            if deadline == None:
+                break
+            self.poll(max(deadline - monotonic(), 0.001))
+            self.flush()
+
+class SimplePacket(object):
     """
     Packet structure used in communication. Numbers are stored in little endianness. 
     
     Functions are provided to serialize and deserialize the numbers, as well as calculating the CRC.
     
     CRC is stored in self.crc, and is updated dynamically when data are appended.
+
+    The packet is kept in a frame buffer preallocated for the largest packet, laid out as it goes on the wire:
+    Byte 0: Start byte
+    Byte 1: Length byte
+    Byte 2..n: Content
     """
+    __slots__ = ('_data', '_length', 'crc', 'rc', 'tag', '_frame')
+
     START_BYTE         = 0xD5
     RC_GENERIC_ERROR   = 0
     RC_OK              = 1
@@ -163,23 +989,80 @@ class SimplePacket:
     RC_PACKET_TOO_BIG  = 4
     RC_CMD_UNSUPPORTED = 5
     RC_NO_RESPONSE     = 10000
+    RC_CANCELLED       = 10001
 
-    def __init__(self):
+    # The largest content the firmware accepts
+    MAX_LENGTH         = 32
+    HEADER_LENGTH      = 2
+
+    def __init__(self, data = None):
         """
-        Create a new packet
+        Create a new packet.
+
+        If data (bytearray or memoryview of a received frame, without the CRC) is given,
+        the packet reads from it directly and no copy is made. Such a packet is only valid until the buffer is reused.
         """
-        self.buf = ""
+        if data is None:
+            self._data = bytearray(SimplePacket.HEADER_LENGTH + SimplePacket.MAX_LENGTH + 1)
+            self._data[0] = SimplePacket.START_BYTE
+            self._length = 0
+        else:
+            self._data = data
+            self._length = len(data) - SimplePacket.HEADER_LENGTH
         self.crc = 0
         self.rc = SimplePacket.RC_OK
         self.tag = -1
+        self._frame = None
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def buf(self):
+        """
+        The content of the packet
+        """
+        return self._data[SimplePacket.HEADER_LENGTH:SimplePacket.HEADER_LENGTH + self._length]
+
+    def frame(self):
+        """
+        Returns the packet framed as it goes on the wire, with the start byte, length byte and CRC in place.
+        """
+        if self._frame is not None:
+            return self._frame
+        end = SimplePacket.HEADER_LENGTH + self._length
+        self._data[1] = self._length
+        self._data[end] = self.crc
+        return self._data[0:end + 1]
+
+    def freeze(self):
+        """
+        Frame the packet once, so it could be sent any number of times without being framed again.
+        Nothing must be appended afterward. Returns the packet itself.
+        """
+        self._frame = bytes(self.frame())
+        return self
+
+    def copy(self):
+        """
+        Returns a new packet with the same content, which could be appended to
+        """
+        p = SimplePacket.__new__(SimplePacket)
+        p._data = bytearray(self._data)
+        p._length = self._length
+        p.crc = self.crc
+        p.rc = SimplePacket.RC_OK
+        p.tag = -1
+        p._frame = None
+        return p
 
     def get_8(self, idx):
         """
         Returns a 8-bits integer from the specific location of packet. 
         Returns 0 if idx is larger than the length.
         """
-        if len(self.buf) > idx:
-            return unpack('B',self.buf[idx])[0]
+        if self._length > idx:
+            return _U8.unpack_from(self._data, SimplePacket.HEADER_LENGTH + idx)[0]
         else:
             return 0
 
@@ -188,6 +1071,8 @@ class SimplePacket:
         Returns a 16-bits integer from the specific location of packet.
         Returns 0 if idx is larger than the length.
         """
+        if self._length >= idx + 2:
+            return _U16.unpack_from(self._data, SimplePacket.HEADER_LENGTH + idx)[0]
         return self.get_8(idx+1)<<8 | self.get_8(idx)
 
     def get_32(self, idx):
@@ -195,36 +1080,163 @@ class SimplePacket:
         Returns a 32-bits integer from the specific location of packet.
         Returns 0 if idx is larger than the length.
         """
+        if self._length >= idx + 4:
+            return _U32.unpack_from(self._data, SimplePacket.HEADER_LENGTH + idx)[0]
         return self.get_16(idx+2)<<16 | self.get_16(idx)
 
     def add_32(self, d):
         """
         Append a 32-bits integer to the end of the packet
         """
-        self.add_16(d & 0xffff)
-        self.add_16((d >> 16) & 0xffff)
+        self._add(_U32, d & 0xffffffff)
 
     def add_16(self, d):
         """
         Append a 16-bits integer to the end of the packet
         """
-        self.add_8(d & 0xff)
-        self.add_8((d >> 8) & 0xff)
+        self._add(_U16, d & 0xffff)
 
     def add_8(self, d):
         """
         Append a 8-bits integer to the end of the packet
         """
-        self.buf += pack('B', d)
-        self._add_crc(d)
+        d &= 0xff
+        if self._length >= SimplePacket.MAX_LENGTH:
+            self.rc = SimplePacket.RC_PACKET_TOO_BIG
+            return
+        self._data[SimplePacket.HEADER_LENGTH + self._length] = d
+        self._length += 1
+        self.crc = CRC_TABLE[self.crc ^ d]
 
-    def _add_crc(self, d):
+    def update(self, buffer):
         """
-        Update the CRC.
+        Append a whole buffer (str or bytearray) to the end of the packet
         """
-        self.crc = self.crc ^ d
-        for i in range(8):
-            if self.crc & 0x01:
-                self.crc = (self.crc >> 1) ^ 0x8C
+        buffer = bytearray(buffer)
+        if self._length + len(buffer) > SimplePacket.MAX_LENGTH:
+            self.rc = SimplePacket.RC_PACKET_TOO_BIG
+            return
+        offset = SimplePacket.HEADER_LENGTH + self._length
+        self._data[offset:offset + len(buffer)] = buffer
+        self._length += len(buffer)
+        self.crc = crc_of(buffer, self.crc)
+
+    def _add(self, field, d):
+        """
+        Append a number in the specific struct format, and update the CRC.
+        """
+        if self._length + field.size > SimplePacket.MAX_LENGTH:
+            self.rc = SimplePacket.RC_PACKET_TOO_BIG
+            return
+        offset = SimplePacket.HEADER_LENGTH + self._length
+        field.pack_into(self._data, offset, d)
+        self._length += field.size
+        crc = self.crc
+        for i in range(offset, offset + field.size):
+            crc = CRC_TABLE[crc ^ self._data[i]]
+        self.crc = crc
+
+class FrameParser(object):
+    """
+    Incremental frame parser working on a receiving buffer.
+
+    Bytes are fed in bulk. Complete frames are cut out of the buffer as SimplePacket,
+    which read from the buffer directly. They are valid until the next feed().
+
+    Only frames passing the CRC check are returned. When a frame fails the check, or its length could not be valid,
+    the start byte is taken as noise and the parser resynchronizes on the next start byte after it,
+    so a corrupted byte costs the frame it hits and nothing after it. The failures are counted in crc_errors.
+    """
+    def __init__(self, size = 1024):
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        self._start_mark = bytearray([SimplePacket.START_BYTE])
+        self._start = 0
+        self._end = 0
+        self.crc_errors = 0
+
+    def reset(self):
+        """
+        Drop everything in the buffer
+        """
+        self._start = 0
+        self._end = 0
+
+    def space(self):
+        """
+        Returns the number of bytes could be fed
+        """
+        return len(self._buf) - (self._end - self._start)
+
+    def feed(self, data):
+        """
+        Append the received bytes to the buffer. Returns the position of the first new byte.
+        """
+        n = len(data)
+        if self._end + n > len(self._buf):
+            # Move the unparsed bytes to the front. The size of the buffer is kept, so views of it stay valid.
+            left = self._end - self._start
+            self._buf[0:left] = self._buf[self._start:self._end]
+            self._start = 0
+            self._end = left
+            if n > len(self._buf) - left:
+                raise ValueError("Receiving buffer overflow")
+        fresh = self._end
+        self._buf[fresh:fresh + n] = data
+        self._end += n
+        return fresh
+
+    def partial(self):
+        """
+        Returns the position of the start byte of a partially received frame. Returns -1 if there is none.
+        """
+        if self._start < self._end:
+            return self._start
+        return -1
+
+    def resync(self):
+        """
+        Give up the partially received frame, which stopped in the middle. Parsing goes on from the next start byte after it.
+        """
+        if self._start < self._end:
+            self._start += 1
+
+    def next_frame(self):
+        """
+        Returns the next complete frame which passes the CRC check as a SimplePacket.
+        Returns None if there is no complete frame yet.
+        """
+        while True:
+            pos = self._buf.find(self._start_mark, self._start, self._end)
+            if pos < 0:
+                # Garbage without any start byte
+                self._start = self._end
+                return None
+            self._start = pos
+
+            if self._end - pos < SimplePacket.HEADER_LENGTH:
+                return None
+            length = self._buf[pos + 1]
+            if length > SimplePacket.MAX_LENGTH:
+                # Not a frame the firmware could send
+                self.crc_errors += 1
+                self._start = pos + 1
+                continue
+            end = pos + SimplePacket.HEADER_LENGTH + length
+            if end >= self._end:
+                return None
+
+            crc = crc_of(self._view[pos + SimplePacket.HEADER_LENGTH:end])
+            if self._buf[end] != crc:
+                self.crc_errors += 1
+                self._start = pos + 1
+                continue
+
+            if length > 1:
+                p = SimplePacket(self._view[pos:end - 1])
+                p.tag = self._buf[end - 1]
             else:
-                self.crc >>= 1
+                p = SimplePacket(self._view[pos:end])
+            p.crc = crc
+            self._start = end + 1
+            return p
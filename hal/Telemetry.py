@@ -0,0 +1,289 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+RepStrap Extruder telemetry history
+
+This is a library keeping the history of the heater and motor PV/SV in fixed memory. Not to be invoked directly.
+
+The samples are kept in tiers of decreasing resolution: the raw samples for minutes, and their average,
+minimum and maximum over longer periods for hours. Each tier is a ring of preallocated arrays,
+so the memory stays constant however long the driver runs.
+
+The step response of a PV to its SV, such as the overshoot and settling time, is measured from the samples
+streamed at a high rate, to judge the PID tuning.
+"""
+import os
+import time
+from array import array
+
+__author__ = "Saw Wong (sam@hellosam.net)"
+__date__ = "2009/11/12"
+__license__ = "GPL 3.0"
+
+class Tier(object):
+    """
+    A ring of rows, each with the time and the value of every channel.
+
+    A raw tier (period 0) keeps every sample added. Otherwise the samples are aggregated over the period,
+    and each row keeps the average, minimum and maximum of every channel.
+    The oldest row is overwritten once the ring is full.
+    """
+    def __init__(self, period, capacity, channels):
+        self.period = period
+        self.capacity = capacity
+        self.channels = channels
+        # Number of rows ever stored. The row i is at the index i % capacity while it is kept.
+        self.total = 0
+        self.times = array('d', [0.0]) * capacity
+        self.avg = array('f', [0.0]) * (capacity * channels)
+        if period > 0:
+            self.min = array('f', [0.0]) * (capacity * channels)
+            self.max = array('f', [0.0]) * (capacity * channels)
+        else:
+            # The sample is the average, minimum and maximum at the same time
+            self.min = self.avg
+            self.max = self.avg
+        self.next = None
+
+        self._count = 0
+        self._start = None
+        self._sum = array('d', [0.0]) * channels
+        self._min = array('f', [0.0]) * channels
+        self._max = array('f', [0.0]) * channels
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+    def add(self, t, avg, low, high):
+        """
+        Add a sample (or an aggregated row of the previous tier) of every channel, at time t
+        """
+        if self.period <= 0:
+            self._store(t, avg, low, high)
+            return
+
+        if self._start != None and t - self._start >= self.period:
+            self._flush()
+        if self._count == 0:
+            self._start = t
+            for i in range(self.channels):
+                self._sum[i] = avg[i]
+                self._min[i] = low[i]
+                self._max[i] = high[i]
+        else:
+            for i in range(self.channels):
+                self._sum[i] += avg[i]
+                if low[i] < self._min[i]:
+                    self._min[i] = low[i]
+                if high[i] > self._max[i]:
+                    self._max[i] = high[i]
+        self._count += 1
+
+    def _flush(self):
+        count = self._count
+        for i in range(self.channels):
+            self._sum[i] /= count
+        self._store(self._start, self._sum, self._min, self._max)
+        self._count = 0
+
+    def _store(self, t, avg, low, high):
+        index = self.total % self.capacity
+        self.times[index] = t
+        base = index * self.channels
+        if self.period > 0:
+            for i in range(self.channels):
+                self.avg[base + i] = avg[i]
+                self.min[base + i] = low[i]
+                self.max[base + i] = high[i]
+        else:
+            self.avg[base:base + self.channels] = avg
+        self.total += 1
+        if self.next != None:
+            self.next.add(t, avg, low, high)
+
+    def rows(self, since = 0):
+        """
+        Iterate the rows kept, from the row numbered since (counted in total), as (time, avg, min, max).
+        The values are array slices of every channel.
+        """
+        first = max(since, self.total - self.capacity)
+        for n in range(first, self.total):
+            index = n % self.capacity
+            base = index * self.channels
+            end = base + self.channels
+            yield self.times[index], self.avg[base:end], self.min[base:end], self.max[base:end]
+
+class Telemetry(object):
+    """
+    History of the channels, sampled at a fixed interval.
+
+    The latest value of each channel is set whenever it is read. sample() adds them all as a row to the raw tier,
+    which feeds the aggregated tiers in turn.
+
+    tiers is a list of (period, duration) in seconds. The first tier should be the raw one, with period 0.
+    """
+    def __init__(self, names, interval, tiers):
+        self.names = names
+        self.interval = interval
+        self.values = array('f', [0.0]) * len(names)
+        self.tiers = []
+        for period, duration in tiers:
+            step = max(period, interval)
+            tier = Tier(period, int(duration / step) + 1, len(names))
+            if len(self.tiers) > 0:
+                self.tiers[-1].next = tier
+            self.tiers.append(tier)
+        self._written = 0
+
+    def set(self, index, value):
+        """
+        Set the latest value of the channel
+        """
+        self.values[index] = value
+
+    def sample(self, t = None):
+        """
+        Add the latest value of every channel to the history. t is the wall clock time, now by default.
+        """
+        if t == None:
+            t = time.time()
+        self.tiers[0].add(t, self.values, self.values, self.values)
+
+    def write_chunk(self, path):
+        """
+        Append the raw samples taken since the last chunk to the file, in CSV.
+        It should be called more often than the duration of the raw tier, or the oldest samples are lost.
+        """
+        raw = self.tiers[0]
+        if raw.total == self._written:
+            return
+        new = not os.path.exists(path)
+        f = open(path, 'a')
+        try:
+            if new:
+                f.write("time," + ",".join(self.names) + "\n")
+            lines = []
+            for t, avg, low, high in raw.rows(self._written):
+                lines.append("%.3f,%s\n" % (t, ",".join(["%g" % v for v in avg])))
+            f.writelines(lines)
+        finally:
+            f.close()
+        self._written = raw.total
+
+    def export(self, path):
+        """
+        Write the whole history to the file in CSV, tier by tier, from the finest
+        """
+        f = open(path, 'w')
+        try:
+            for tier in self.tiers:
+                if tier.period > 0:
+                    f.write("# Every %g seconds\n" % tier.period)
+                    columns = []
+                    for name in self.names:
+                        columns += [name + ".avg", name + ".min", name + ".max"]
+                    f.write("time," + ",".join(columns) + "\n")
+                    for t, avg, low, high in tier.rows():
+                        fields = []
+                        for i in range(len(self.names)):
+                            fields += ["%g" % avg[i], "%g" % low[i], "%g" % high[i]]
+                        f.write("%.3f,%s\n" % (t, ",".join(fields)))
+                else:
+                    f.write("# Raw samples\n")
+                    f.write("time," + ",".join(self.names) + "\n")
+                    for t, avg, low, high in tier.rows():
+                        f.write("%.3f,%s\n" % (t, ",".join(["%g" % v for v in avg])))
+        finally:
+            f.close()
+
+class StepResponse(object):
+    """
+    Measures the response of a PV to each step of its SV.
+
+    A step starts at the first sample with the new SV. Its samples are kept in the arrays times (seconds since the step)
+    and pv, for window seconds or until the next step, then the response is measured:
+    overshoot past the SV in percent of the step, rise time from 10% to 90% of the step, and settling time
+    until the PV stays within band (a fraction of the step) around the SV, in seconds.
+    A time is None if it is not reached. The arrays of the last step are kept until the next one.
+    """
+    def __init__(self, window, band = 0.05):
+        self.window = window
+        self.band = band
+        self.times = array('d')
+        self.pv = array('f')
+        # Steps measured, and the response of the last one
+        self.count = 0
+        self.step_from = 0
+        self.step_to = 0
+        self.overshoot = 0.0
+        self.rise_time = None
+        self.settling_time = None
+        self._sv = None
+        self._start = None
+
+    def add(self, t, sv, pv):
+        """
+        Add a sample at time t in seconds. Returns True if a step is measured upon it.
+        """
+        measured = False
+        if self._sv != None and sv != self._sv:
+            # The step before is cut short
+            measured = self._measure()
+            self.step_from = self._sv
+            self.step_to = sv
+            self._start = t
+            del self.times[:]
+            del self.pv[:]
+        self._sv = sv
+        if self._start == None:
+            return measured
+        self.times.append(t - self._start)
+        self.pv.append(pv)
+        if self.times[-1] >= self.window:
+            measured = self._measure()
+        return measured
+
+    def _measure(self):
+        if self._start == None:
+            return False
+        self._start = None
+        step = float(self.step_to - self.step_from)
+        if step == 0 or len(self.pv) == 0:
+            return False
+
+        # Progress of the PV toward the SV, 0 at the SV before and 1 at the SV after
+        progress = [(pv - self.step_from) / step for pv in self.pv]
+        self.overshoot = max(max(progress) - 1, 0) * 100
+        self.rise_time = None
+        low = self._reached(progress, 0.1)
+        high = self._reached(progress, 0.9)
+        if low != None and high != None:
+            self.rise_time = self.times[high] - self.times[low]
+        self.settling_time = None
+        for i in range(len(progress) - 1, -1, -1):
+            if abs(progress[i] - 1) > self.band:
+                if i + 1 < len(progress):
+                    self.settling_time = self.times[i + 1]
+                break
+        else:
+            self.settling_time = 0.0
+        self.count += 1
+        return True
+
+    def _reached(self, progress, level):
+        for i in range(len(progress)):
+            if progress[i] >= level:
+                return i
+        return None
+
+    def write(self, path):
+        """
+        Write the samples of the last step to the file in CSV
+        """
+        f = open(path, 'w')
+        try:
+            f.write("# Step from %g to %g\n" % (self.step_from, self.step_to))
+            f.write("time,pv\n")
+            f.writelines(["%.4f,%g\n" % (self.times[i], self.pv[i]) for i in range(len(self.times))])
+        finally:
+            f.close()
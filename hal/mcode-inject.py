@@ -5,7 +5,10 @@ RepStrap Extruder MCode Injection
 
 DESCRIPTION
 
-The script should be invoked by EMC2 upon hitting M1xx User M Code. This will inject corresponding value to HAL pin and so that the repstrap-extruder driver could pick up.
+The script should be invoked by EMC2 upon hitting M1xx User M Code. This will submit the M Code to the repstrap-extruder driver through its Unix domain socket,
+and wait until the driver is done with it.
+
+If the socket is not available (e.g. an older driver), the corresponding value is injected to HAL pin instead, so that the driver could pick up.
 
 Please read the README.html usage.
 """
@@ -17,8 +20,18 @@ __license__ = "GPL 3.0"
 import sys
 import re
 import time
+import socket
 from subprocess import *
 
+## Configuration Start ##
+# The Unix domain socket of the repstrap-extruder driver. It must be the same as in repstrap-extruder.py.
+MAPP_SOCKET = "/tmp/rs-extruder.sock"
+# The HAL component and the Extruder the M Codes are injected to through the HAL pins, when the socket is not available.
+# They must be the name of the first port in COMM_PORTS, and of the first Extruder in COMM_DEVICES of repstrap-extruder.py.
+MAPP_COMPONENT = "rs-extruder"
+MAPP_DEVICE = ""
+## Configuration End ##
+
 class Usage(Exception):
     """
     Represents an exception about improper usage of this script
@@ -29,6 +42,7 @@ class Usage(Exception):
 # List of M Code that requires sych, blocking operation
 blocking_mcodes = {
     101: 1, # Extruder on
+    102: 1, # Extruder reverse
     150: 1  # Wait for set temperature
 }
 
@@ -54,27 +68,34 @@ def main(argv=None):
             if not re.match('^[-+]?\d*(\.\d*)?$', argv[2]):
                 raise Usage("The parameter Q is not a float number: " + argv[2])
             
+            reply = submit(mcode, argv[1], argv[2])
+            if reply != None:
+                if not reply.startswith("ok"):
+                    print >> sys.stderr, "M%d is not executed by the extruder driver: %s" % (mcode, reply)
+                return 0
+            
+            # The driver socket is not available. Fall back to the HAL pins.
             # If the previous MCode was not finished, wait!
-            seqid = int(getPin("rs-extruder.mapp.seqid"))
-            done = int(getPin("rs-extruder.mapp.done"))
+            seqid = int(getPin(mappPin("seqid")))
+            done = int(getPin(mappPin("done")))
             
             while seqid != done:
-                done = int(getPin("rs-extruder.mapp.done"))
+                done = int(getPin(mappPin("done")))
                 time.sleep(0.005)
             
             # New sequence ID, and then set the parameters
             seqid += 1
             if seqid > 10000:
                 seqid = 0            
-            setPin("rs-extruder.mapp.mcode", mcode)
-            setPin("rs-extruder.mapp.p", argv[1])
-            setPin("rs-extruder.mapp.q", argv[2])
-            setPin("rs-extruder.mapp.seqid", seqid)
+            setPin(mappPin("mcode"), mcode)
+            setPin(mappPin("p"), argv[1])
+            setPin(mappPin("q"), argv[2])
+            setPin(mappPin("seqid"), seqid)
             
             # If this is a blocking mcode, wait!
             if mcode in blocking_mcodes:
                 while True:
-                    done = int(getPin("rs-extruder.mapp.done"))
+                    done = int(getPin(mappPin("done")))
                     if done == seqid:
                         break
                     time.sleep(0.005)
@@ -86,6 +107,42 @@ def main(argv=None):
             print >> sys.stderr, "\nUsage: " + str(argv[0]) + " ParameterP ParameterQ"
     return 0
 
+def submit(mcode, p, q):
+    """
+    Submit the M Code through the driver socket, and wait for the reply.
+    The driver replies a non-blocking M Code once it is queued, and a blocking M Code once it is done, so it blocks here.
+    Returns the reply, or None if the driver socket could not be connected.
+    """
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            s.connect(MAPP_SOCKET)
+        except socket.error:
+            return None
+        # An empty parameter is 0, as in the HAL pins
+        s.sendall("%d %s %s\n" % (mcode, p or "0", q or "0"))
+        reply = ""
+        try:
+            while reply.find("\n") < 0:
+                data = s.recv(64)
+                if not data:
+                    break
+                reply += data
+        except socket.error ,err:
+            reply = str(err)
+        return reply.strip()
+    finally:
+        s.close()
+
+def mappPin(name):
+    """
+    Returns the name of the mapp.* HAL pin, prefixed as the driver does
+    """
+    prefix = MAPP_COMPONENT + "."
+    if MAPP_DEVICE != "":
+        prefix += MAPP_DEVICE + "."
+    return prefix + "mapp." + name
+
 def getPin(pin):
     return Popen("halcmd getp " + str(pin), stdout=PIPE, shell=True).communicate()[0]
     
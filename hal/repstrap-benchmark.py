@@ -0,0 +1,329 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+RepStrap Extruder Communication Benchmark
+
+DESCRIPTION
+
+This script measures the host side cost of the communication module, so changes to the packet handling could be compared without any hardware attached.
+
+The round trip and driver benchmarks run against the Extruder Controller emulator (ExtruderEmulator.py) on a pseudo terminal.
+They report the round trip latency, the frame rate, the CPU time of the driver and the M-Code dispatch latency.
+
+Benchmarks could be picked by name in the arguments: crc, packet, roundtrip, driver. All of them are run by default.
+The results are checked against the limits below, and the script exits with 1 if any is exceeded, so it could gate a change.
+
+Please read the README.html usage.
+"""
+
+__author__ = "Saw Wong (sam@hellosam.net)"
+__date__ = "2009/11/12"
+__license__ = "GPL 3.0"
+
+import sys
+import os
+import imp
+import time
+import timeit
+import tempfile
+import threading
+from RepRapSerialComm import *
+from ExtruderEmulator import *
+
+# Number of frames to be processed in each benchmark
+FRAMES = 20000
+
+# A typical frame: Heater PV/SV reply with the echoed tag
+SAMPLE_FRAME = "\x01\xc8\x00\xd2\x00\x5b"
+
+# Number of requests in the round trip benchmarks, and M-Codes in the dispatch benchmark
+ROUND_TRIPS = 500
+MCODES = 200
+# Commands queued in turn in the pipelined benchmark. They have different tags, so they could be in flight together.
+PIPELINE_COMMANDS = (80, 91, 93, 95)
+
+# Baud rate the emulator starts at, and the one negotiated afterward, as the driver does
+BAUDRATE = 38400
+MAX_BAUDRATE = 115200
+
+# Seconds the driver runs idle in the driver benchmark
+DRIVER_SECONDS = 5
+
+# Limits of the results, well above what a desktop machine measures. The CRC and the CPU time per frame are in us,
+# the CPU time of the idle driver in ms per second, and the 99th percentile latencies in ms.
+CRC_LIMIT_US = 3.0
+FRAME_CPU_LIMIT_US = 500.0
+ROUNDTRIP_P99_LIMIT_MS = 50.0
+DRIVER_IDLE_LIMIT_MS = 100.0
+MCODE_P99_LIMIT_MS = 10.0
+
+# Names of the results which exceeded their limits
+failures = []
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def bitwise_crc(buffer):
+    """
+    The CRC calculation done bit by bit. This is how the CRC was calculated before the table was introduced.
+    """
+    crc = 0
+    for d in bytearray(buffer):
+        crc = crc ^ d
+        for i in range(8):
+            if crc & 0x01:
+                crc = (crc >> 1) ^ 0x8C
+            else:
+                crc >>= 1
+    return crc
+
+def bench_crc():
+    """
+    Compare the per frame CRC cost between the bitwise loop and the table lookup.
+    """
+    if bitwise_crc(SAMPLE_FRAME) != crc_of(SAMPLE_FRAME):
+        raise SystemExit("CRC table mismatch against the bitwise calculation")
+
+    before = timeit.timeit(lambda: bitwise_crc(SAMPLE_FRAME), number = FRAMES)
+    after = timeit.timeit(lambda: crc_of(SAMPLE_FRAME), number = FRAMES)
+    report("CRC per frame (%d bytes)" % len(SAMPLE_FRAME), before, after)
+    check("CRC per frame", after / FRAMES * 1e6, CRC_LIMIT_US, "us")
+
+def bench_packet():
+    """
+    Compare the per frame cost of building a packet byte by byte against appending it as a whole,
+    and of building the command packets against reusing the cached frames and templates.
+    """
+    def build_bytewise():
+        p = SimplePacket()
+        for d in bytearray(SAMPLE_FRAME):
+            p.add_8(d)
+
+    def build_bulk():
+        p = SimplePacket()
+        p.update(SAMPLE_FRAME)
+
+    before = timeit.timeit(build_bytewise, number = FRAMES)
+    after = timeit.timeit(build_bulk, number = FRAMES)
+    report("SimplePacket build per frame", before, after)
+
+    # A query without parameter, built and framed each time against the one framed once
+    frozen = query(91).freeze()
+    before = timeit.timeit(lambda: query(91).frame(), number = FRAMES)
+    after = timeit.timeit(lambda: frozen.frame(), number = FRAMES)
+    report("Query frame, built against cached", before, after)
+
+    # A set value, built from scratch against copied from the template
+    template = query(92)
+    def build_set():
+        p = query(92)
+        p.add_16(200)
+        p.frame()
+    def build_template():
+        p = template.copy()
+        p.add_16(200)
+        p.frame()
+    before = timeit.timeit(build_set, number = FRAMES)
+    after = timeit.timeit(build_template, number = FRAMES)
+    report("Set value frame, built against template", before, after)
+
+def bench_roundtrip():
+    """
+    Measure the round trip latency of one request at a time, and the frame rate of queued requests, against the emulator.
+    Only requests of different commands are pipelined, so the same command queued is measured apart.
+    """
+    emulator = ExtruderEmulator(BAUDRATE)
+    comm = None
+    try:
+        comm = AsyncRepRapSerialComm(emulator.start(), BAUDRATE)
+        comm.reset()
+        baudrate = comm.negotiate(MAX_BAUDRATE)
+
+        latencies = []
+        for i in range(ROUND_TRIPS):
+            request = comm.request(query(91))
+            start = monotonic()
+            comm.wait(request)
+            latencies.append(monotonic() - start)
+        check("Round trip p99", report_latency("Round trip at %d bps (command 91)" % baudrate, latencies),
+            ROUNDTRIP_P99_LIMIT_MS, "ms")
+
+        # A request waits while another one with the same tag is in flight, so the same command goes one round trip at a time
+        report_rate(comm, "Back to back at %d bps (command 91)" % baudrate, (91,))
+        report_rate(comm, "Pipelined at %d bps (%s)" % (baudrate, ", ".join([str(cmd) for cmd in PIPELINE_COMMANDS])),
+            PIPELINE_COMMANDS)
+    finally:
+        if comm != None:
+            comm.close()
+        emulator.stop()
+
+def report_rate(comm, label, commands):
+    """
+    Queue ROUND_TRIPS requests of the commands in turn, and report the frame rate and CPU time while they are served
+    """
+    requests = [comm.request(query(commands[i % len(commands)])) for i in range(ROUND_TRIPS)]
+    start = monotonic()
+    cpu = cpu_time()
+    while not requests[-1].done():
+        comm.flush()
+        comm.poll(max(comm.next_deadline() - monotonic(), 0.001))
+    elapsed = monotonic() - start
+    cpu = cpu_time() - cpu
+    failed = len([r for r in requests if r.rc != SimplePacket.RC_OK])
+    print "%-40s %8.0f frames/s, %8.2f us CPU per frame, %d failed" % (
+        label, ROUND_TRIPS / elapsed, cpu / ROUND_TRIPS * 1e6, failed)
+    check(label + " CPU per frame", cpu / ROUND_TRIPS * 1e6, FRAME_CPU_LIMIT_US, "us")
+    check(label + " failed requests", failed, 0, "requests")
+
+def bench_driver():
+    """
+    Run the driver against the emulator. Measure its CPU time while idle, and the latency of M-Codes submitted through its socket.
+    """
+    driver = imp.load_source('repstrap_extruder', os.path.join(HERE, 'repstrap-extruder.py'))
+    inject = imp.load_source('mcode_inject', os.path.join(HERE, 'mcode-inject.py'))
+    socket_dir = tempfile.mkdtemp()
+    emulator = ExtruderEmulator(BAUDRATE)
+    server = None
+    thread = None
+    bus = None
+    try:
+        driver.COMM_PORT = emulator.start()
+        driver.COMM_BAUDRATE = BAUDRATE
+        driver.COMM_MAX_BAUDRATE = MAX_BAUDRATE
+        inject.MAPP_SOCKET = os.path.join(socket_dir, 'rs-extruder.sock')
+        server = driver.MCodeServer(inject.MAPP_SOCKET)
+
+        c = BenchComponent()
+        bus = driver.ExtruderBus(c, [driver.Extruder(c)], server)
+        thread = threading.Thread(target = bus.execute)
+        thread.start()
+
+        # Wait for the connection, then enable the machine
+        start = monotonic()
+        while not c['connection']:
+            if monotonic() - start > 5:
+                raise SystemExit("The driver does not connect to the emulator")
+            time.sleep(0.01)
+        c['enable'] = 1
+        c['running'] = 1
+        time.sleep(0.5)
+
+        cpu = cpu_time()
+        time.sleep(DRIVER_SECONDS)
+        cpu = cpu_time() - cpu
+        print "%-40s %8.2f ms CPU per second" % ("Driver idle, machine enabled", cpu / DRIVER_SECONDS * 1e3)
+        check("Driver idle CPU per second", cpu / DRIVER_SECONDS * 1e3, DRIVER_IDLE_LIMIT_MS, "ms")
+
+        # Non-blocking M-Codes are acknowledged once queued
+        latencies = []
+        for i in range(MCODES):
+            start = monotonic()
+            inject.submit(108, "1.5", "0")
+            latencies.append(monotonic() - start)
+        check("M-Code dispatch (M108) p99", report_latency("M-Code dispatch (M108)", latencies), MCODE_P99_LIMIT_MS, "ms")
+
+        # Blocking M-Codes wait for the temperature, which is reached already
+        inject.submit(104, "25", "0")
+        latencies = []
+        for i in range(MCODES / 10):
+            start = monotonic()
+            inject.submit(150, "0", "0")
+            latencies.append(monotonic() - start)
+        check("M-Code dispatch (M150) p99", report_latency("M-Code dispatch (M150, at temperature)", latencies),
+            MCODE_P99_LIMIT_MS, "ms")
+
+        # The counters kept by the driver itself
+        bus.dump_stats(sys.stdout)
+    finally:
+        if bus != None:
+            bus.stop()
+        if thread != None:
+            thread.join()
+        if server != None:
+            server.close()
+        emulator.stop()
+        os.rmdir(socket_dir)
+
+class BenchComponent(dict):
+    """
+    Stands in for the HAL component, so the driver runs without EMC2. Pins are kept in the dict, and read 0 until set.
+    """
+    def __init__(self):
+        dict.__init__(self)
+        # The params main() of the driver sets
+        self['steps_per_mm_cube'] = 4.0
+        self['poll.status-ms'] = 50
+        self['poll.heater-ms'] = 250
+        self['poll.heater-fast-ms'] = 100
+        self['poll.motor-ms'] = 250
+        self['poll.motor-fast-ms'] = 50
+        self['poll.idle-ms'] = 500
+
+    def __missing__(self, name):
+        return 0
+
+def query(cmd):
+    """
+    Returns a packet of the command without parameter
+    """
+    p = SimplePacket()
+    p.add_8(0)
+    p.add_8(cmd)
+    return p
+
+def cpu_time():
+    """
+    Returns the user and system CPU time of this process in seconds
+    """
+    t = os.times()
+    return t[0] + t[1]
+
+def report(name, before, after):
+    print "%-40s %8.2f us -> %8.2f us (x%.1f)" % (
+        name, before / FRAMES * 1e6, after / FRAMES * 1e6, before / after)
+
+def report_latency(name, latencies):
+    """
+    Print the percentiles of the latencies in seconds. Returns the 99th percentile in ms.
+    """
+    latencies = sorted(latencies)
+    def percentile(fraction):
+        return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)] * 1e3
+    print "%-40s p50 %7.3f ms, p90 %7.3f ms, p99 %7.3f ms, max %7.3f ms" % (
+        name, percentile(0.5), percentile(0.9), percentile(0.99), latencies[-1] * 1e3)
+    return percentile(0.99)
+
+def check(name, value, limit, unit):
+    """
+    Record the result as failed if it exceeds the limit
+    """
+    if value > limit:
+        print >> sys.stderr, "FAIL: %s is %.2f %s, over the limit of %.2f %s" % (name, value, unit, limit, unit)
+        failures.append(name)
+
+# Benchmarks by name, in the order they are run
+BENCHMARKS = [
+    ('crc', bench_crc),
+    ('packet', bench_packet),
+    ('roundtrip', bench_roundtrip),
+    ('driver', bench_driver)
+]
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    names = [name for name, bench in BENCHMARKS]
+    for name in argv[1:]:
+        if name not in names:
+            print >> sys.stderr, "Unknown benchmark: " + name
+            print >> sys.stderr, "\nUsage: " + str(argv[0]) + " [" + "|".join(names) + "]..."
+            return 1
+    for name, bench in BENCHMARKS:
+        if len(argv) <= 1 or name in argv[1:]:
+            bench()
+    if len(failures) > 0:
+        print >> sys.stderr, "%d result(s) over the limits" % len(failures)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
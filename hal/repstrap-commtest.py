@@ -18,6 +18,9 @@ __license__ = "GPL 3.0"
 # You should change the following variable to reflect your Serial Port setup
 COMM_PORT = "/dev/ttyUSB0"
 COMM_BAUDRATE = 38400
+# The fastest baud rate to switch to after connecting at COMM_BAUDRATE, if the firmware supports it.
+# Set to None to stay at COMM_BAUDRATE.
+COMM_MAX_BAUDRATE = 115200
 ## Configuration End ##
 
 import sys
@@ -31,6 +34,10 @@ def main(argv=None):
 
     print "Flushing communicaton channel..."
     comm.reset()
+
+    if COMM_MAX_BAUDRATE != None:
+        print "Negotiating baud rate..."
+        print "Communicating at baud rate: " + str(comm.negotiate(COMM_MAX_BAUDRATE))
     
     print "Querying for Heater 1 temperature (Command 91)..."
     p = SimplePacket()
@@ -21,16 +21,28 @@ The user-space driver does the followings:
 * Reading status from the extruder hardware periodically, report to HAL pins
 * Monitor spindle and other HAL pins, and control the extruder accordingly
 
-These are achieved through a polling loop.
+These are achieved through an event loop, waiting on the serial port and a heap of scheduled queries.
 
 For a complete system design diagram, please read the README.html.
 """
 
 import sys
-import hal
+import os
 import math
-from datetime import datetime, timedelta 
+import heapq
+import signal
+import socket
+import threading
+import traceback
+from array import array
 from RepRapSerialComm import *
+from Telemetry import *
+
+try:
+    import hal
+except ImportError:
+    # Only main() needs the EMC2 HAL. The Extruder could be driven by another component, as in repstrap-benchmark.py
+    hal = None
 
 __author__ = "Saw Wong (sam@hellosam.net)"
 __date__ = "2009/11/12"
@@ -40,11 +52,661 @@ __license__ = "GPL 3.0"
 # You should change the following variable to reflect your Serial Port setup
 COMM_PORT = "/dev/ttyUSB0"
 COMM_BAUDRATE = 38400
+# The fastest baud rate to switch to after connecting at COMM_BAUDRATE, if the firmware supports it.
+# Set to None to stay at COMM_BAUDRATE.
+COMM_MAX_BAUDRATE = 115200
+# The Extruder Controllers on the RS485 bus, as (address, name). The address is RS485_ADDRESS in the firmware Configuration.h.
+# The HAL pins of each one are prefixed with its name, e.g. rs-extruder.bed.heater1.pv, or not prefixed if the name is empty.
+# e.g. [(0, "left"), (1, "right"), (2, "bed")]
+COMM_DEVICES = [(0, "")]
+# Set to True if the firmware is built with RS485_ENABLED. Only one request is in flight at a time then, and the batches
+# of streamed samples are sent only when polled, so nothing collides on the half-duplex bus.
+COMM_RS485 = False
+# The serial ports served by this process, as (port, HAL component name). Each one has the Extruder Controllers in COMM_DEVICES
+# and its own HAL component, and is served and reconnected on its own, so a fault on one port does not affect the others.
+# e.g. [("/dev/ttyUSB0", "rs-extruder"), ("/dev/ttyUSB1", "rs-extruder2")]
+COMM_PORTS = [(COMM_PORT, "rs-extruder")]
+# The Unix domain socket where mcode-inject.py submits M-Codes. It must be the same as in mcode-inject.py.
+# Set to None to accept M-Codes through the mapp.* HAL pins only.
+MAPP_SOCKET = "/tmp/rs-extruder.sock"
+# Record the serial communication to this file, to be inspected with repstrap-replay.py. e.g. "/tmp/rs-extruder.cap"
+# Set to None to disable it.
+COMM_CAPTURE = None
+# Append the raw heater and motor samples to this CSV file every TELEMETRY_CHUNK_INTERVAL. Set to None to disable it.
+TELEMETRY_FILE = None
+# The whole telemetry history is written to this CSV file upon kill -USR2
+TELEMETRY_EXPORT = "/tmp/rs-extruder-history.csv"
+# Write the samples of each step measured while streaming to this CSV file, with the channel name inserted,
+# e.g. "/tmp/rs-extruder-step.csv" for /tmp/rs-extruder-step.motor1.csv. Set to None to disable it.
+STEP_RESPONSE_FILE = None
 ## Configuration End ##
 
+# Interval in seconds of scanning the HAL pins, while the machine is enabled and disabled
+PIN_SCAN_INTERVAL = 0.005
+PIN_SCAN_IDLE_INTERVAL = 0.05
+
+# The firmware turns off and falls back to COMM_BAUDRATE if there is no packet for this long, in seconds
+FIRMWARE_WATCHDOG = 1.0
+# Interval in seconds of asking again to switch the baud rate, and of probing the telemetry command,
+# when the firmware did not answer on connecting
+RENEGOTIATE_INTERVAL = 60.0
+TELEMETRY_PROBE_INTERVAL = 5.0
+# Seconds before a bus stopped by an unexpected error is served again
+BUS_RESTART_INTERVAL = 5.0
+
+# Limits in ms of the polling periods set by the poll.* HAL params
+POLL_MIN_MS = 10
+POLL_MAX_MS = 500
+
+# Failed requests in a row to an Extruder before the bus is reset, and before the Extruder is taken offline.
+# Fewer failures only cost the requests, as the parser resynchronizes on the next frame by itself.
+COMM_ERRORS_RESET = 3
+COMM_ERRORS_FAULT = 6
+
+# Commands without parameter. Their packets are framed once and reused.
+CONSTANT_COMMANDS = (80, 81, 82, 91, 93, 95, 101, 106)
+# Commands which only read, and leave the state of the Extruder Controller alone
+QUERY_COMMANDS = frozenset([80, 91, 93, 95, 101, 106])
+# The register written by each absolute set value command. A newer write to a register replaces the one
+# not sent yet, and a write of the value written already is skipped. 97 (speed) and 98 (PWM) both drive motor1.
+SETPOINT_REGISTERS = {92: 'heater1.sv', 94: 'heater2.sv', 97: 'motor1', 98: 'motor1', 100: 'motor1.tuning', 105: 'stream'}
+
+# Commands which could be sent again without changing the result: the queries and the absolute set values.
+# They are retransmitted up to COMM_RETRIES times upon timeout or CRC error, after COMM_RETRY_BACKOFF seconds
+# doubled on each retry, before the error is counted. The others (e.g. 96, the relative motor move) are never
+# retransmitted, unless the firmware reports it has dropped the request.
+IDEMPOTENT_COMMANDS = QUERY_COMMANDS | frozenset(SETPOINT_REGISTERS.keys())
+COMM_RETRIES = 2
+COMM_RETRY_BACKOFF = 0.005
+
+# Interval in seconds of publishing the stats.* HAL pins
+STATS_INTERVAL = 1.0
+
+# Channels of the telemetry history, the interval in seconds they are sampled,
+# and the tiers of the history as (period, duration) in seconds: raw samples for 10 minutes,
+# 10 seconds aggregates for 6 hours, and 1 minute aggregates for 3 days.
+TELEMETRY_CHANNELS = ('heater1.pv', 'heater1.sv', 'heater2.pv', 'heater2.sv', 'motor1.pv', 'motor1.sv')
+TELEMETRY_INTERVAL = 0.1
+TELEMETRY_TIERS = [(0, 600), (10, 6 * 3600), (60, 72 * 3600)]
+TELEMETRY_CHUNK_INTERVAL = 60
+
+# The tag of the batches of samples the firmware pushes while streaming (command 105), and the bytes before the samples:
+# response code, address, sequence number and the time of the first sample in ms
+STREAM_PUSH_TAG = 106
+STREAM_HEADER_LENGTH = 5
+# Samples in each batch, as STREAM_BATCH_SAMPLES in the firmware Configuration.h.
+# With COMM_RS485, the batches are polled for (command 106) twice in the time to fill one.
+STREAM_BATCH_SAMPLES = 4
+# The share of the link the streamed batches could take at most. A shorter interval is raised to fit it, as the firmware
+# would otherwise stall its control loop on the serial writes.
+STREAM_LINK_SHARE = 0.5
+# Seconds of the response kept after each step of motor1 and heater1 SV, and the band around the SV it settles in,
+# as a fraction of the step
+MOTOR_STEP_WINDOW = 2.0
+HEATER_STEP_WINDOW = 300.0
+STEP_SETTLING_BAND = 0.05
+
+# Number of M-Codes could be queued. A non-blocking M-Code is acknowledged as soon as it has a slot in the queue.
+MAPP_QUEUE_SIZE = 16
+# Number of M-Codes could wait for a slot besides. More are dropped at once, as on fault.
+MAPP_BACKLOG_SIZE = 64
+# M-Codes acknowledged only when they are done. They are the blocking M-Codes of mcode-inject.py.
+MAPP_BLOCKING_MCODES = (101, 102, 150)
+
+class TimerHeap:
+    """
+    Tasks scheduled to run at a monotonic() time, kept in a heap ordered by the time.
+    A task is called with the current time, and could reschedule itself.
+    """
+    def __init__(self):
+        self._heap = []
+        self._seq = 0
+
+    def schedule(self, when, task):
+        """
+        Schedule the task to run at the specific time
+        """
+        # The sequence number keeps tasks of the same time in order, and never compares the tasks
+        self._seq += 1
+        heapq.heappush(self._heap, (when, self._seq, task))
+
+    def next_deadline(self):
+        """
+        Returns the time of the earliest task. Returns None if there is none.
+        """
+        if len(self._heap) == 0:
+            return None
+        return self._heap[0][0]
+
+    def run_due(self, now):
+        """
+        Run every task which is due at the specific time
+        """
+        while len(self._heap) > 0 and self._heap[0][0] <= now:
+            when, seq, task = heapq.heappop(self._heap)
+            task(now)
+
+class PinHandle:
+    """
+    Handle of a HAL pin, for the HAL binding which does not provide pin objects.
+    The pin is accessed through the component by name.
+    """
+    def __init__(self, c, name):
+        self.c = c
+        self.name = name
+
+    def get(self):
+        return self.c[self.name]
+
+    def set(self, value):
+        self.c[self.name] = value
+
+class PinCache:
+    """
+    Cached handles of the HAL pins named with a prefix, and the values last set to them.
+    """
+    def __init__(self, c, prefix = ""):
+        self.c = c
+        self.prefix = prefix
+        self._handles = {}
+        self._values = {}
+
+    def pin(self, name):
+        """
+        Returns the cached handle of the pin
+        """
+        handle = self._handles.get(name)
+        if handle == None:
+            if hasattr(self.c, 'getpin'):
+                handle = self.c.getpin(self.prefix + name)
+            else:
+                handle = PinHandle(self.c, self.prefix + name)
+            self._handles[name] = handle
+        return handle
+
+    def get(self, name):
+        """
+        Returns the value of the pin
+        """
+        return self.pin(name).get()
+
+    def set(self, name, value):
+        """
+        Set the output pin, only if the value is changed since it was last set
+        """
+        if self._values.get(name, None) != value:
+            self.pin(name).set(value)
+            self._values[name] = value
+
+    def forget(self):
+        """
+        Forget the values last set, as the pins could be set outside
+        """
+        self._values = {}
+
+class MCodeRequest:
+    """
+    A M-Code queued in the driver, with the sequence ID given by the driver.
+    done(request) is called once, when the M-Code is acknowledged, or dropped on fault (with ok set to False).
+    """
+    def __init__(self, seqid, mcode, p, q, done):
+        self.seqid = seqid
+        self.mcode = mcode
+        self.p = p
+        self.q = q
+        self.ok = None
+        self.submitted = monotonic()
+        self._done = done
+
+    def acknowledge(self, ok):
+        """
+        Call the done callback, unless it was acknowledged already
+        """
+        if self.ok == None:
+            self.ok = ok
+            self._done(self)
+
+class MCodeServer:
+    """
+    Unix domain socket server where mcode-inject.py submits M-Codes.
+
+    A client sends one line "mcode p q", and is replied with "ok seqid" when the M-Code is acknowledged,
+    or "fault seqid" when it is dropped because the extruder is not working. The connection is closed afterward.
+    """
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            # Left by a previous run
+            os.unlink(path)
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(path)
+        self._listener.listen(16)
+        self._listener.setblocking(0)
+        # File descriptor -> [socket, received bytes]
+        self._clients = {}
+
+    def filenos(self):
+        """
+        Returns the file descriptors to be waited with select, for the listener and the connected clients
+        """
+        return [self._listener.fileno()] + self._clients.keys()
+
+    def process(self, readable, handler):
+        """
+        Accept the new clients and read from those in the readable list of file descriptors.
+        The handler is called for each M-Code received, as handler(mcode, p, q, done).
+        done(request) must be called with the MCodeRequest to reply the client once the M-Code is acknowledged or dropped.
+        """
+        if self._listener.fileno() in readable:
+            while True:
+                try:
+                    client = self._listener.accept()[0]
+                except socket.error:
+                    break
+                client.setblocking(0)
+                self._clients[client.fileno()] = [client, ""]
+
+        for fd in readable:
+            entry = self._clients.get(fd)
+            if entry == None:
+                continue
+            try:
+                data = entry[0].recv(256)
+            except socket.error:
+                continue
+            if not data:
+                # The client gave up before sending a complete M-Code
+                self._close(fd)
+                continue
+            entry[1] += data
+            if entry[1].find("\n") < 0:
+                continue
+
+            client = entry[0]
+            del self._clients[fd]
+            try:
+                fields = entry[1].split()
+                mcode = int(fields[0])
+                p = float(fields[1])
+                q = float(fields[2])
+            except (ValueError, IndexError):
+                self._reply(client, "error")
+                continue
+            handler(mcode, p, q, self._replier(client))
+
+    def _replier(self, client):
+        def done(request):
+            if request.ok:
+                self._reply(client, "ok %d" % request.seqid)
+            else:
+                self._reply(client, "fault %d" % request.seqid)
+        return done
+
+    def _reply(self, client, message):
+        try:
+            client.send(message + "\n")
+        except socket.error:
+            # The client has gone away
+            pass
+        client.close()
+
+    def _close(self, fd):
+        self._clients[fd][0].close()
+        del self._clients[fd]
+
+    def close(self):
+        """
+        Close every connection, and remove the socket
+        """
+        for fd in self._clients.keys():
+            self._close(fd)
+        if self._listener != None:
+            self._listener.close()
+            self._listener = None
+            os.unlink(self.path)
+
+class ExtruderBus:
+    """
+    The serial port to the Extruder Controllers, and the event loop driving them.
+
+    Several Extruder Controllers could share a RS485 bus, each at its own address and with its own HAL pins.
+    AsyncRepRapSerialComm lets them take turns on the bus, and each one polls at the periods set by its own poll.* params.
+    The performance counters are of the whole bus, except the M-Code times which are of each Extruder.
+    M-Codes submitted through the socket go to the first Extruder.
+
+    Each serial port has its own bus, named after its HAL component. The port is COMM_PORT if not given.
+    run() serves the port until stop() is called, so several ports could be served by one process, a thread each.
+    """
+    def __init__(self, hal_component, extruders, mcode_server = None, port = None, name = "rs-extruder"):
+        self.c = hal_component
+        self.extruders = extruders
+        self.mcode_server = mcode_server
+        self.port = port
+        self.name = name
+        self.pins = PinCache(hal_component)
+        for extruder in extruders:
+            extruder.bus = self
+        self.comm = None
+        self.timers = TimerHeap()
+        self._stopping = False
+        self._reconnecting = False
+        self._reset_pending = False
+        self._after_reset = []
+        # The baud rate in use, and the fastest one to negotiate. It is lowered when the link fails at a faster one.
+        self.baudrate = COMM_BAUDRATE
+        self.max_baudrate = COMM_MAX_BAUDRATE
+
+        # Performance counters. They are kept across the connections.
+        self.stats = CommStats()
+        # Time in us spent in each loop iteration, except the wait
+        self.loop_time = Histogram()
+
+    def execute(self):    
+        """
+        Start the main process loop.
+        This will return only when error (Communication, Exception, etc) is encountered, or stop() is called.
+        """
+        self.comm = None
+        self._reconnecting = False
+        try:            
+            port = self.port
+            if port == None:
+                port = COMM_PORT
+            self.baudrate = COMM_BAUDRATE
+            window = AsyncRepRapSerialComm.DEFAULT_WINDOW
+            if COMM_RS485:
+                # The requests would collide with the replies on the half-duplex bus
+                window = AsyncRepRapSerialComm.HALF_DUPLEX_WINDOW
+            self.comm = AsyncRepRapSerialComm(port = port, baudrate = COMM_BAUDRATE, window = window, stats = self.stats)
+            self.comm.unsolicited = self._unsolicited
+            if COMM_CAPTURE != None:
+                self.comm.start_capture(self.path_of(COMM_CAPTURE))
+            self.comm.reset()            
+            p = self.comm.readback()
+            # Every Extruder Controller on the bus must switch at once, so the baud rate is negotiated only if there is one
+            if self._negotiable():
+                self._negotiate()
+
+            now = monotonic()
+            self.timers = TimerHeap()
+            self._reset_pending = False
+            self._after_reset = []
+            self.pins.forget()
+            self.timers.schedule(now + STATS_INTERVAL, self._publish_stats)
+            if self._negotiable():
+                # The firmware did not answer, maybe for a noise. Try again later.
+                self.timers.schedule(now + RENEGOTIATE_INTERVAL, self._renegotiate)
+            for extruder in self.extruders:
+                extruder.attach(self, now)
+
+            while not self._stopping and not self._reconnecting:
+                # Sleep until a packet or a M-Code arrives, a response times out or a scheduled task is due
+                deadline = self.timers.next_deadline()
+                read_deadline = self.comm.next_deadline()
+                if read_deadline != None and read_deadline < deadline:
+                    deadline = read_deadline
+                rlist = [self.comm.fileno()]
+                if self.mcode_server != None:
+                    rlist += self.mcode_server.filenos()
+                readable = wait_readable(rlist, max(deadline - monotonic(), 0))
+                start = monotonic()
+                self.comm.poll(0)
+
+                if self.mcode_server != None:
+                    self.mcode_server.process(readable, self.extruders[0]._mapp_submit)
+                self.timers.run_due(monotonic())
+                
+                # Flush everything queued in this iteration
+                self.comm.flush()
+                self.loop_time.add((monotonic() - start) * 1e6)
+
+            if not self._reconnecting:
+                self._turn_off()
+        except KeyboardInterrupt:    
+            if self.comm != None:
+                self._turn_off()
+                raise SystemExit
+        finally:
+            for extruder in self.extruders:
+                extruder.detach()
+            if self.comm != None:
+                self.comm.close()
+                self.comm = None
+
+    def reset_later(self, after = None):
+        """
+        Reset the bus once the responses being dispatched are handled, as the reset cancels every pending request.
+        after() is called once it is reset. Asked several times meanwhile, the bus is reset once.
+        """
+        if after != None:
+            self._after_reset.append(after)
+        if not self._reset_pending:
+            self._reset_pending = True
+            self.timers.schedule(monotonic(), self._reset)
+
+    def _reset(self, now):
+        """
+        Scheduled task: reset the bus as asked by reset_later().
+        The reset takes its steps from the timer heap, so it does not block the other Extruders meanwhile.
+        """
+        # This cancels every request on the bus, and holds the new ones until the reset is done
+        self.comm.start_reset()
+        deadline = now + RepRapSerialComm.RESET_SETTLE_TIME + RepRapSerialComm.RESET_DRAIN_TIMEOUT
+        def drain(now):
+            if not self.comm.drain_reset(deadline):
+                self.timers.schedule(now + 0.005, drain)
+                return
+            after = self._after_reset
+            self._reset_pending = False
+            self._after_reset = []
+            for f in after:
+                f()
+        self.timers.schedule(now + RepRapSerialComm.RESET_SETTLE_TIME, drain)
+
+    def _negotiable(self):
+        """
+        Returns True if the link could be switched to a faster baud rate.
+        Every Extruder Controller on the bus must switch at once, so the baud rate is negotiated only if there is one.
+        """
+        return self.max_baudrate != None and self.baudrate < self.max_baudrate and len(self.extruders) == 1
+
+    def _negotiate(self):
+        """
+        Switch to the fastest baud rate which works. Once the firmware answered which baud rates it supports,
+        the faster ones are not tried again, as the firmware does not support them, or they failed the test.
+        """
+        self.baudrate = self.comm.negotiate(self.max_baudrate, self.extruders[0].address)
+        if self.comm.baudrates != None:
+            self.max_baudrate = self.baudrate
+
+    def _renegotiate(self, now):
+        """
+        Scheduled task: ask the firmware again to switch to a faster baud rate, once the link is healthy
+        """
+        if not self._negotiable():
+            return
+        if max([extruder.comm_errors for extruder in self.extruders]) == 0:
+            self.comm.drain()
+            self._negotiate()
+        if self._negotiable():
+            self.timers.schedule(monotonic() + RENEGOTIATE_INTERVAL, self._renegotiate)
+
+    def fall_back(self):
+        """
+        The link keeps failing. If it is at a negotiated baud rate, reconnect and negotiate a slower one.
+        """
+        if self.baudrate <= COMM_BAUDRATE:
+            return
+        print >> sys.stderr, "The link fails at %d. Reconnecting at a slower baud rate" % self.baudrate
+        self.max_baudrate = self.baudrate - 1
+        self._reconnecting = True
+
+    def _unsolicited(self, p):
+        """
+        Pass a batch of streamed samples to the Extruder which pushed it, by the address in the batch
+        """
+        if p.tag != STREAM_PUSH_TAG or len(p) < STREAM_HEADER_LENGTH:
+            return
+        address = p.get_8(1)
+        for extruder in self.extruders:
+            if extruder.address == address:
+                extruder._rb_stream(p)
+
+    def run(self):
+        """
+        Serve the port until stop() is called, reconnecting whenever the connection fails
+        """
+        while not self._stopping:
+            try:
+                self.execute()
+            except IOError:
+                pass
+            except OSError:
+                pass
+            except  serial.serialutil.SerialException:
+                pass
+            finally:
+                self._disconnected()
+
+    def serve(self):
+        """
+        Thread target: run() until stop() is called.
+        An unexpected error stops only this bus. It is reported, the Extruders are signalled offline,
+        and the bus is served again after BUS_RESTART_INTERVAL seconds.
+        """
+        while not self._stopping:
+            try:
+                self.run()
+            except Exception:
+                print >> sys.stderr, "Unexpected error on the port %s. Serving it again in %g seconds" % (
+                    self.name, BUS_RESTART_INTERVAL)
+                traceback.print_exc()
+                self._disconnected()
+                time.sleep(BUS_RESTART_INTERVAL)
+
+    def stop(self):
+        """
+        Make execute() and run() return after the current loop iteration. It could be called from another thread.
+        """
+        self._stopping = True
+
+    def _turn_off(self):
+        """
+        Turn off every Extruder Controller on the bus
+        """
+        for extruder in self.extruders:
+            try:
+                self.comm.wait(self.comm.request(extruder._command(82)))
+            except PacketError:
+                pass
+
+    def _disconnected(self):
+        """
+        Signal the fault on the HAL pins of every Extruder, and drop the M-Codes arrived meanwhile.
+        If the link was at a negotiated baud rate, wait for the firmware watchdog to fall back to COMM_BAUDRATE,
+        which the link is reopened at.
+        """
+        for extruder in self.extruders:
+            prefix = extruder.prefix
+            self.c[prefix + 'connection'] = 0
+            self.c[prefix + 'fault.communication'] = 1
+            self.c[prefix + 'estop'] = 1
+            self.c[prefix + 'online'] = 0
+        time.sleep(0.05)
+        for extruder in self.extruders:
+            prefix = extruder.prefix
+            self.c[prefix + 'estop'] = 0
+            self.c[prefix + 'mapp.done'] = self.c[prefix + 'mapp.seqid']
+        self.reject_mcodes()
+        time.sleep(0.05)
+        if self.baudrate > COMM_BAUDRATE:
+            time.sleep(FIRMWARE_WATCHDOG)
+            self.baudrate = COMM_BAUDRATE
+
+    def path_of(self, path, extruder = None):
+        """
+        Returns the file path for this bus, or the Extruder on it, with the names inserted before the extension.
+        The name of the bus is not inserted if it is the only one served, as named in COMM_PORTS.
+        """
+        names = []
+        if len(COMM_PORTS) > 1:
+            names.append(self.name)
+        if extruder != None and extruder.name != "":
+            names.append(extruder.name)
+        if len(names) == 0:
+            return path
+        root, ext = os.path.splitext(path)
+        return root + "." + ".".join(names) + ext
+
+    def reject_mcodes(self):
+        """
+        Drop the M-Codes submitted through the socket while the extruder is not connected.
+        """
+        if self.mcode_server != None:
+            readable = wait_readable(self.mcode_server.filenos(), 0)
+            def reject(mcode, p, q, done):
+                MCodeRequest(0, mcode, p, q, done).acknowledge(False)
+            self.mcode_server.process(readable, reject)
+
+    def _publish_stats(self, now):
+        """
+        Scheduled task: publish the performance counters to the stats.* HAL pins.
+        The times are the average and maximum over the last interval, in ms.
+        """
+        stats = self.stats
+        self.pins.set('stats.frames-sent', stats.frames_sent)
+        self.pins.set('stats.frames-received', stats.frames_received)
+        self.pins.set('stats.crc-errors', stats.crc_errors)
+        self.pins.set('stats.timeouts', stats.timeouts)
+        self.pins.set('stats.resets', stats.resets)
+        self.pins.set('stats.retransmissions', stats.retransmissions)
+        self.pins.set('stats.coalesced', stats.coalesced)
+        self.pins.set('stats.queue-depth', stats.queue_depth)
+        self.pins.set('stats.queue-depth-max', stats.queue_depths.max)
+        times = [(self.pins, 'rtt', stats.rtt), (self.pins, 'loop', self.loop_time)]
+        times += [(extruder.pins, 'mcode', extruder.mcode_time) for extruder in self.extruders]
+        for pins, name, histogram in times:
+            count, total, peak = histogram.take_interval()
+            if count > 0:
+                pins.set('stats.' + name + '-ms', total / count / 1000.0)
+            pins.set('stats.' + name + '-max-ms', peak / 1000.0)
+        self.timers.schedule(now + STATS_INTERVAL, self._publish_stats)
+
+    def export_telemetry(self, path = TELEMETRY_EXPORT):
+        """
+        Write the whole telemetry history of every Extruder to the file
+        """
+        for extruder in self.extruders:
+            extruder.export_telemetry(self.path_of(path, extruder))
+
+    def dump_stats(self, out = sys.stderr):
+        """
+        Print every performance counter, with the distributions
+        """
+        print >> out, "=== %s stats ===" % (self.name)
+        self.stats.dump(out)
+        print >> out, "Loop iteration (us): %s" % (self.loop_time)
+        for extruder in self.extruders:
+            print >> out, "M-Code submit to acknowledge at address %d (us): %s" % (extruder.address, extruder.mcode_time)
+        out.flush()
+
+    def __del__(self):
+        if self.comm != None:
+            self.comm.close()
+            self.comm = None
+
 class Extruder:
-    def __init__(self, hal_component):
+    """
+    An Extruder Controller at a RS485 address, attached to an ExtruderBus while it is connected.
+    Its HAL pins and params are named with the name as the prefix, e.g. name.heater1.pv, or without prefix if the name is empty.
+    """
+    def __init__(self, hal_component, address = 0, name = ""):
         self.c = hal_component            
+        self.address = address
+        self.name = name
+        self.prefix = ""
+        if name != "":
+            self.prefix = name + "."
         self._trigger_dict = {
             'heater1.set-sv': self._trigger_heater1_sv,
             'heater2.set-sv': self._trigger_heater2_sv,
@@ -58,12 +720,53 @@ class Extruder:
             'motor1.pwm.f-fast': self._trigger_motor1_pwm,
             'motor1.tuning.trigger': self._trigger_motor1_tuning,
             'mapp.seqid': self._trigger_mapp,
-            'running':self._trigger_running
+            'running':self._trigger_running,
+            'stream.interval-ms': self._trigger_stream
         }
-        self._trigger_state = {}
+        self._trigger_keys = []
+        self._trigger_handles = []
+        self._trigger_state = []
+        self.pins = PinCache(hal_component, self.prefix)
         
+        self.bus = None
         self.comm = None
-        self.readback_queue = []
+        self.timers = TimerHeap()
+        self.telemetry_supported = False
+        # Failed requests in a row
+        self.comm_errors = 0
+        # Packets of the commands without parameter, framed once, and templates of the others
+        self._templates = {}
+        self._commands = {}
+        for cmd in CONSTANT_COMMANDS:
+            self._commands[cmd] = self._packet(cmd).freeze()
+        # The write request to each register not sent yet, the write requests to each register not completed yet,
+        # the content last requested to be written to each register, and the content the firmware acknowledged
+        self._unsent_writes = {}
+        self._pending_writes = {}
+        self._requested = {}
+        self._written = {}
+
+        # Time in us from a M-Code is submitted until it is acknowledged
+        self.mcode_time = Histogram()
+
+        # History of the PV/SV, kept across the connections
+        self.telemetry = Telemetry(TELEMETRY_CHANNELS, TELEMETRY_INTERVAL, TELEMETRY_TIERS)
+
+        # Step responses measured from the streamed samples
+        self.motor1_step = StepResponse(MOTOR_STEP_WINDOW, STEP_SETTLING_BAND)
+        self.heater1_step = StepResponse(HEATER_STEP_WINDOW, STEP_SETTLING_BAND)
+        self.stream_samples = 0
+        self.stream_lost = 0
+        self._stream_interval = 0
+        self._stream_polling = False
+        self._stream_sequence = None
+        self._stream_ms = None
+        self._stream_clock = 0.0
+
+        # M-Codes waiting to be executed, and the one being executed
+        self._mapp_queue = deque()
+        self._mapp_current = None
+        self._mapp_seqid = 0
 
         self.estop_state = 0
         self.enable_state = 0
@@ -73,223 +776,480 @@ class Extruder:
         self.mcode_heater1_sv = 0;
         self.mcode_motor1_speed = 0;
     
-    def execute(self):    
+    def attach(self, bus, now):
         """
-        Start the main process loop.
-        This will return only when error (Communication, Exception, etc) is encountered.
+        Start talking through the bus which is just connected, and schedule the tasks
         """
-        next_status_read = datetime.now();
-        next_temp_read = datetime.now();
-        next_motor_read = datetime.now();
-        self.readback_queue = []
+        self.bus = bus
+        self.comm = bus.comm
+        self.timers = bus.timers
+        self.comm_errors = 0
+        self._unsent_writes.clear()
+        self._pending_writes.clear()
+        self._requested.clear()
+        self._written.clear()
+        # The firmware stops streaming when the host is gone. It is started again by the trigger.
+        self._stream_interval = 0
+        self._stream_polling = False
         self._init_trigger_state()
-        
+        # The pins could be set outside between the connections
+        self.pins.forget()
+        supported = self._probe_telemetry()
+        self.telemetry_supported = supported == True
+        self._telemetry_probed = supported != None
+
+        self.timers.schedule(now, self._scan_pins)
+        self.timers.schedule(now + TELEMETRY_INTERVAL, self._sample_telemetry)
+        if TELEMETRY_FILE != None:
+            self.timers.schedule(now + TELEMETRY_CHUNK_INTERVAL, self._write_telemetry)
+        if self.telemetry_supported:
+            self.timers.schedule(now, self._poll_telemetry)
+        else:
+            self.timers.schedule(now, self._poll_status)
+            self.timers.schedule(now, self._poll_heater)
+            self.timers.schedule(now, self._poll_motor)
+            if supported == None:
+                # The probe got no answer. Probe again once the link is healthy.
+                self.timers.schedule(now + TELEMETRY_PROBE_INTERVAL, self._reprobe_telemetry)
+
+    def detach(self):
+        """
+        Stop talking through the bus which is disconnected. The M-Codes waiting for the extruder are dropped.
+        """
+        self._mapp_release()
         self.comm = None
-        try:            
-            self.comm = RepRapSerialComm(port = COMM_PORT, baudrate = COMM_BAUDRATE)
-            self.comm.reset()            
-            p = self.comm.readback()
 
-            while True:
-                time.sleep(0.005)
-
-                # Process any packets
-                if len(self.readback_queue) > 0:
-                    p = self.comm.readback()
-                    if p != None:
-                        if p.rc != SimplePacket.RC_OK:                        
-                            print >> sys.stderr, "Extruder communication error: RC: %d" % (p.rc)
-                            self.c['fault.communication'] = 1
-                            self.c['connection'] = 0
-                            self.c['estop'] = 1
-                            self.c['online'] = 0     
-                            self.extruder_ready_check = 0
-                            self.extruder_state = 0
-                            self.c['mapp.done'] = self.c['mapp.seqid']
-                            
-                            self.comm.reset()
-                            self.readback_queue = []
-                            
-                            # Turn Off
-                            p = SimplePacket()
-                            p.add_8(0)
-                            p.add_8(82)
-                            self.comm.send(p)
-                            self.readback_queue.append(self._rb_dummy)                        
-                        else:
-                            self.c['connection'] = 1
-                            (self.readback_queue[0])(p)
-                            del self.readback_queue[0]
-                
-                if len(self.readback_queue) > 20:
-                    raise SystemExit("The readback queue is too long. Suggesting microcontroller overflow or other bus problem")
-                
-                # Enable
-                if self.enable_state != self.c['enable']:
-                    self.enable_state = self.c['enable']
-                    p = SimplePacket()
-                    p.add_8(0)
-                    if self.enable_state:
-                        p.add_8(81)
-                    else:                    
-                        self.extruder_ready_check = 0
-                        self.extruder_state = 0
-                        self.c['mapp.done'] = self.c['mapp.mcode']
-                        p.add_8(82)
-                    self.comm.send(p)
-                    self.readback_queue.append(self._rb_enable)
-
-                # Check button trigger
-                self._check_trigger()
-                
-                # Read Status
-                if datetime.now() > next_status_read:
-                    next_status_read = datetime.now() + timedelta(milliseconds = 50);
-                    p = SimplePacket()
-                    p.add_8(0)
-                    p.add_8(80)
-                    self.comm.send(p)
-                    self.readback_queue.append(self._rb_status)
-                    
-                # Read Heater PV/SV
-                if datetime.now() > next_temp_read:
-                    next_temp_read = datetime.now() + timedelta(milliseconds = 250);
-                    p = SimplePacket()
-                    p.add_8(0)
-                    p.add_8(91)
-                    self.comm.send(p)
-                    self.readback_queue.append(self._rb_heater1_pvsv)
-                    p = SimplePacket()
-                    p.add_8(0)
-                    p.add_8(93)
-                    self.comm.send(p)
-                    self.readback_queue.append(self._rb_heater2_pvsv)
-                    
-                # Read Motor PV/SV
-                if datetime.now() > next_motor_read:
-                    next_motor_read = datetime.now() + timedelta(milliseconds = 50);
-                    p = SimplePacket()
-                    p.add_8(0)
-                    p.add_8(95)
-                    self.comm.send(p)
-                    self.readback_queue.append(self._rb_motor1_pvsv)
+    def _packet(self, cmd):
+        """
+        Returns a new packet of the command to this Extruder, copied from the template with the address and command
+        in place, so only the parameters are appended and added to the CRC.
+        """
+        template = self._templates.get(cmd)
+        if template == None:
+            template = SimplePacket()
+            template.add_8(self.address)
+            template.add_8(cmd)
+            self._templates[cmd] = template
+        return template.copy()
 
-        except KeyboardInterrupt:    
-            if self.comm != None:
-                p = SimplePacket()
-                p.add_8(0)
-                p.add_8(82)
-                self.comm.send(p)
-                self.comm.readback()
-                raise SystemExit
-        finally:
-            if self.comm != None:
-                self.comm.close()
-                self.comm = None
+    def _command(self, cmd):
+        """
+        Returns the packet of the command without parameter to this Extruder, framed once when this Extruder
+        is created. It is shared by every request of the command, so nothing must be appended to it.
+        """
+        return self._commands[cmd]
+
+    def _send(self, p, rb, retries = 0):
+        """
+        Queue a packet to be sent at the end of this loop iteration, and the handler for its response.
+        retries is the number of times it has been retransmitted.
+        A write to a register is merged into the write not sent yet, keeping its handler, or skipped if the firmware
+        acknowledged the value already and no other write to the register is pending.
+        """
+        cmd = p.get_8(1)
+        register = SETPOINT_REGISTERS.get(cmd)
+        if register != None:
+            if retries == 0 and self._coalesce(register, p):
+                self.comm.stats.coalesced += 1
+                return
+        elif not cmd in QUERY_COMMANDS:
+            # It could change the registers, so the writes after it are neither merged with those before, nor skipped
+            self._unsent_writes.clear()
+            self._written.clear()
+        def done(request):
+            if register != None:
+                self._pending_writes.get(register, set()).discard(request)
+            self._on_response(request, rb, retries)
+        request = self.comm.request(p, done)
+        if register != None:
+            self._pending_writes.setdefault(register, set()).add(request)
+            if retries == 0:
+                self._unsent_writes[register] = request
+                self._requested[register] = bytes(p.buf)
+
+    def _coalesce(self, register, p):
+        """
+        Merge the write into the write to the same register not sent yet, or skip it if the value is acknowledged already.
+        Returns False if it has to be sent.
+        """
+        content = bytes(p.buf)
+        if self._written.get(register) == content and len(self._pending_writes.get(register, ())) == 0:
+            self._requested[register] = content
+            return True
+        request = self._unsent_writes.get(register)
+        if request != None and request.replace(p):
+            self._requested[register] = content
+            return True
+        return False
+
+    def _retransmit(self, request, rb, retries):
+        """
+        Send the failed request again after the backoff, if it is safe to. Returns False if it is not retransmitted.
+        """
+        if retries >= COMM_RETRIES:
+            return False
+        p = request.packet
+        dropped = request.rc == SimplePacket.RC_OK
+        if not dropped and not p.get_8(1) in IDEMPOTENT_COMMANDS:
+            # It could have been executed, with the response lost
+            return False
+        comm = self.comm
+        register = SETPOINT_REGISTERS.get(p.get_8(1))
+        content = bytes(p.buf)
+        def resend(now):
+            # Not after the bus is reset or disconnected
+            if self.comm is not comm or comm.stats.resets != resets:
+                return
+            # Nor after a newer value is requested, which it would overwrite
+            if register != None and self._requested.get(register) != content:
+                return
+            comm.stats.retransmissions += 1
+            self._send(p, rb, retries + 1)
+        resets = comm.stats.resets
+        self.timers.schedule(monotonic() + COMM_RETRY_BACKOFF * (2 ** retries), resend)
+        return True
+
+    def _on_response(self, request, rb, retries = 0):
+        """
+        Pass the response to the handler, or retransmit the request, or count the communication error.
+        The recovery escalates only when the errors persist: the bus is reset after COMM_ERRORS_RESET failures in a row,
+        and the Extruder goes offline after COMM_ERRORS_FAULT.
+        """
+        rc = request.rc
+        if rc == SimplePacket.RC_CANCELLED:
+            self._forget_write(request.packet)
+            return
+        if rc == SimplePacket.RC_OK and request.reply.get_8(0) in (SimplePacket.RC_CRC_MISMATCH, SimplePacket.RC_BUFFER_OVERFLOW):
+            # The request was corrupted on the way to the microcontroller
+            rc = request.reply.get_8(0)
+        if rc != SimplePacket.RC_OK:
+            self._forget_write(request.packet)
+            if self._retransmit(request, rb, retries):
+                return
+            self.comm_errors += 1
+            if self.comm_errors == COMM_ERRORS_RESET:
+                print >> sys.stderr, "Extruder communication error at address %d: RC: %d. Resetting the bus" % (
+                    self.address, rc)
+                self.bus.reset_later()
+            elif self.comm_errors >= COMM_ERRORS_FAULT:
+                print >> sys.stderr, "Extruder communication error at address %d: RC: %d. Going offline" % (
+                    self.address, rc)
+                self.comm_errors = 0
+                self._go_offline()
+            return
+        self.comm_errors = 0
+        self._set('connection', 1)
+        if request.reply.get_8(0) == SimplePacket.RC_OK:
+            self._acknowledge_write(request.packet)
+        rb(request.reply)
+
+    def _acknowledge_write(self, p):
+        """
+        The firmware acknowledged the write, so the same value is skipped next time
+        """
+        register = SETPOINT_REGISTERS.get(p.get_8(1))
+        if register != None:
+            self._written[register] = bytes(p.buf)
+
+    def _forget_write(self, p):
+        """
+        The write failed, and it could have been executed or not. The value of the register is unknown.
+        """
+        register = SETPOINT_REGISTERS.get(p.get_8(1))
+        if register != None and register in self._written:
+            del self._written[register]
+
+    def _go_offline(self):
+        """
+        Signal the communication fault, reset the bus and turn off the Extruder
+        """
+        self._set('fault.communication', 1)
+        self._set('connection', 0)
+        self._set('estop', 1)
+        self._set('online', 0)
+        self.extruder_ready_check = 0
+        self.extruder_state = 0
+        self._mapp_release()
+        # Reconnect at a slower baud rate, if the link is at a negotiated one
+        self.bus.fall_back()
+        
+        # Turn Off, once the bus is reset
+        def turn_off():
+            p = self._command(82)
+            self._send(p, self._rb_dummy)
+        self.bus.reset_later(turn_off)
+
+    def _sample_telemetry(self, now):
+        """
+        Scheduled task: add the latest PV/SV to the telemetry history
+        """
+        self.telemetry.sample()
+        self.timers.schedule(now + TELEMETRY_INTERVAL, self._sample_telemetry)
+
+    def _write_telemetry(self, now):
+        """
+        Scheduled task: append the raw telemetry samples to the file
+        """
+        try:
+            self.telemetry.write_chunk(self.bus.path_of(TELEMETRY_FILE, self))
+        except IOError ,err:
+            print >> sys.stderr, "Could not write the telemetry: " + str(err)
+        self.timers.schedule(now + TELEMETRY_CHUNK_INTERVAL, self._write_telemetry)
+
+    def export_telemetry(self, path = TELEMETRY_EXPORT):
+        """
+        Write the whole telemetry history to the file
+        """
+        try:
+            self.telemetry.export(path)
+            print >> sys.stderr, "Telemetry history is written to " + path
+        except IOError ,err:
+            print >> sys.stderr, "Could not write the telemetry history: " + str(err)
+
+    def _scan_pins(self, now):
+        """
+        Scheduled task: look for the enable and trigger pin changes.
+        HAL could not notify pin changes, so they are scanned, less often while the machine is disabled.
+        """
+        # Enable
+        enable = self._get('enable')
+        if self.enable_state != enable:
+            self.enable_state = enable
+            if self.enable_state:
+                p = self._command(81)
+            else:                    
+                self.extruder_ready_check = 0
+                self.extruder_state = 0
+                self._mapp_release()
+                p = self._command(82)
+            self._send(p, self._rb_enable)
+
+        # Check button trigger
+        self._check_trigger()
+
+        if self.enable_state:
+            self.timers.schedule(now + PIN_SCAN_INTERVAL, self._scan_pins)
+        else:
+            self.timers.schedule(now + PIN_SCAN_IDLE_INTERVAL, self._scan_pins)
+
+    def _poll_status(self, now):
+        """
+        Scheduled task: read status
+        """
+        if self.telemetry_supported:
+            return
+        p = self._command(80)
+        self._send(p, self._rb_status)
+        self.timers.schedule(now + self._poll_period('poll.status-ms'), self._poll_status)
+
+    def _poll_heater(self, now):
+        """
+        Scheduled task: read heater PV/SV
+        """
+        if self.telemetry_supported:
+            return
+        p = self._command(91)
+        self._send(p, self._rb_heater1_pvsv)
+        p = self._command(93)
+        self._send(p, self._rb_heater2_pvsv)
+        self.timers.schedule(now + self._poll_period('poll.heater-ms', 'poll.heater-fast-ms', self._heater_active()), self._poll_heater)
+
+    def _poll_motor(self, now):
+        """
+        Scheduled task: read motor PV/SV
+        """
+        if self.telemetry_supported:
+            return
+        p = self._command(95)
+        self._send(p, self._rb_motor1_pvsv)
+        self.timers.schedule(now + self._poll_period('poll.motor-ms', 'poll.motor-fast-ms', self._motor_active()), self._poll_motor)
+
+    def _poll_telemetry(self, now):
+        """
+        Scheduled task: read status, heater PV/SV and motor PV/SV in one round trip, at the shorter of the heater and
+        motor periods, so it speeds up while heating up or extruding. The status rides along, and its period applies
+        to the reads one by one only.
+        """
+        p = self._command(101)
+        self._send(p, self._rb_telemetry)
+        self.timers.schedule(now + min(
+            self._poll_period('poll.heater-ms', 'poll.heater-fast-ms', self._heater_active()),
+            self._poll_period('poll.motor-ms', 'poll.motor-fast-ms', self._motor_active())
+            ), self._poll_telemetry)
+
+    def _probe_telemetry(self):
+        """
+        Returns True if the firmware supports the composite telemetry command (101), or None if it does not answer.
+        Older firmware answers it with RC_CMD_UNSUPPORTED, then the queries are sent one by one.
+        """
+        p = self._command(101)
+        try:
+            return self.comm.wait(self.comm.request(p)).get_8(0) == SimplePacket.RC_OK
+        except PacketError:
+            return None
+
+    def _reprobe_telemetry(self, now):
+        """
+        Scheduled task: probe the telemetry command again while the link is healthy, until the firmware answers it
+        """
+        if self._telemetry_probed:
+            return
+        if self.comm_errors == 0:
+            self._send(self._command(101), self._rb_probe_telemetry)
+        self.timers.schedule(now + TELEMETRY_PROBE_INTERVAL, self._reprobe_telemetry)
+
+    def _rb_probe_telemetry(self, p):
+        if self._telemetry_probed:
+            return
+        self._telemetry_probed = True
+        if p.get_8(0) == SimplePacket.RC_OK:
+            # The composite command takes over from the queries sent one by one
+            self.telemetry_supported = True
+            self._rb_telemetry(p)
+            self.timers.schedule(monotonic(), self._poll_telemetry)
+
+    def _poll_period(self, base, fast = None, active = False):
+        """
+        Returns the polling period in seconds, from the HAL params in ms.
+        The fast rate is used when active, and the idle rate is used when the machine is disabled.
+        """
+        if not self.enable_state:
+            ms = self._param('poll.idle-ms')
+        elif active:
+            ms = self._param(fast)
+        else:
+            ms = self._param(base)
+        # The firmware turns off by itself if there is no packet for 1 second
+        return min(max(ms, POLL_MIN_MS), POLL_MAX_MS) / 1000.0
+
+    def _heater_active(self):
+        """
+        Returns True while a heater is heating toward the set value, or a M-Code is waiting for the temperature
+        """
+        if self.extruder_ready_check > 0:
+            return True
+        for heater in ('heater1', 'heater2'):
+            if self._get(heater + '.sv') > 0 and abs(self._get(heater + '.pv') - self._get(heater + '.sv')) > 5:
+                return True
+        return False
+
+    def _motor_active(self):
+        """
+        Returns True while the motor is extruding or being driven by hand
+        """
+        if self.extruder_state or self._get('motor1.spindle.on'):
+            return True
+        for pwm in ('motor1.pwm.r-fast', 'motor1.pwm.r-slow', 'motor1.pwm.f-slow', 'motor1.pwm.f-fast'):
+            if self._get(pwm):
+                return True
+        return False
 
     def _init_trigger_state(self):
         """
-        Setup the trigger dictionary
+        Setup the trigger pin handles and their last seen values
         """
-        for key in self._trigger_dict.keys():
-            self._trigger_state[key] = 0    
+        self._trigger_keys = self._trigger_dict.keys()
+        self._trigger_handles = [self._pin(key) for key in self._trigger_keys]
+        self._trigger_state = [0] * len(self._trigger_keys)
     
     def _check_trigger(self):
         """
         Look for any pin changes we are interested in and trigger the handlers
         """
-        for key in self._trigger_dict.keys():       
-            if self._trigger_state[key] != self.c[key]:
-                self._trigger_state[key] = self.c[key]
-                self._trigger_dict[key](name = key, value = self._trigger_state[key])
-            
-    def __del__(self):
-        if self.comm != None:
-            self.comm.close()
-            self.comm = None
+        # Take a snapshot of every pin, and compare them all at once
+        values = [handle.get() for handle in self._trigger_handles]
+        if values == self._trigger_state:
+            return
+        for i in range(len(values)):
+            if self._trigger_state[i] != values[i]:
+                self._trigger_state[i] = values[i]
+                key = self._trigger_keys[i]
+                self._trigger_dict[key](name = key, value = values[i])
+
+    def _pin(self, name):
+        """
+        Returns the cached handle of the pin
+        """
+        return self.pins.pin(name)
+
+    def _get(self, name):
+        """
+        Returns the value of the pin
+        """
+        return self.pins.get(name)
+
+    def _set(self, name, value):
+        """
+        Set the output pin, only if the value is changed since it was last set
+        """
+        self.pins.set(name, value)
+
+    def _param(self, name):
+        """
+        Returns the value of the HAL param
+        """
+        return self.c[self.prefix + name]
             
     def _extruder_ready_poll(self):
         """
         Check if the temperature reached the set value, and signal the motor movement accordingly.
         """
-        if self.extruder_ready_check > 0 and self.c['heater1.pv'] >= self.mcode_heater1_sv - 5:
+        if self.extruder_ready_check > 0 and self._get('heater1.pv') >= self.mcode_heater1_sv - 5:
         	if self.extruder_ready_check != 150:
-		        p = SimplePacket()
-		        p.add_8(0)
-		        p.add_8(97)
+		        p = self._packet(97)
 		        if self.extruder_ready_check == 101:
 		            p.add_16(self.mcode_motor1_speed)
 		        else:
 		            p.add_16(-self.mcode_motor1_speed)
-		        self.comm.send(p)
-		        self.readback_queue.append(self._rb_dummy) 
+		        self._send(p, self._rb_dummy)
 
 		        self.extruder_state = self.extruder_ready_check           
-	        self.c['mapp.done'] = self.c['mapp.seqid']
 	        self.extruder_ready_check = 0
+	        self._mapp_complete(True)
+	        self._mapp_run()
                              
     def _trigger_heater1_sv(self, name, value):
-        p = SimplePacket()
-        p.add_8(0)
-        p.add_8(92)
+        p = self._packet(92)
         p.add_16(value)
-        self.comm.send(p)
-        self.readback_queue.append(self._rb_dummy)
+        self._send(p, self._rb_dummy)
 
     def _trigger_heater2_sv(self, name, value):
-        p = SimplePacket()
-        p.add_8(0)
-        p.add_8(94)
+        p = self._packet(94)
         p.add_16(value)
-        self.comm.send(p)
-        self.readback_queue.append(self._rb_dummy)
+        self._send(p, self._rb_dummy)
 
     def _trigger_motor1_rel_pos(self, name, value):
         if not value:
             return
-        p = SimplePacket()
-        p.add_8(0)
-        p.add_8(96)
-        p.add_16(self.c['motor1.rel-pos'])
-        self.comm.send(p)
-        self.readback_queue.append(self._rb_dummy)       
+        p = self._packet(96)
+        p.add_16(self._get('motor1.rel-pos'))
+        self._send(p, self._rb_dummy)
         
     def _trigger_motor1_speed(self, name, value):
         if not value:
             return
-        p = SimplePacket()
-        p.add_8(0)
-        p.add_8(97)
-        p.add_16(self.c['motor1.speed'])
-        self.comm.send(p)
-        self.readback_queue.append(self._rb_dummy)        
+        p = self._packet(97)
+        p.add_16(self._get('motor1.speed'))
+        self._send(p, self._rb_dummy)
 
     def _trigger_motor1_spindle(self, name, value):        
         if not value:
 	        self.mcode_motor1_speed = 0
         else:
-	        self.mcode_motor1_speed = int(self.c['motor1.spindle'] * self.c['steps_per_mm_cube'] * 2**8)
-        p = SimplePacket()
-        p.add_8(0)
-        p.add_8(97)
+	        self.mcode_motor1_speed = int(self._get('motor1.spindle') * self._param('steps_per_mm_cube') * 2**8)
+        p = self._packet(97)
         p.add_16(self.mcode_motor1_speed)
-        self.comm.send(p)
-        self.readback_queue.append(self._rb_dummy)        
+        self._send(p, self._rb_dummy)
         
     def _trigger_motor1_mmcube(self, name, value):
         if not value:
             return
-        p = SimplePacket()
-        p.add_8(0)
-        p.add_8(97)
-        p.add_16(int(self.c['motor1.mmcube'] * self.c['steps_per_mm_cube'] * 2**8))
-        self.comm.send(p)
-        self.readback_queue.append(self._rb_dummy)        
+        p = self._packet(97)
+        p.add_16(int(self._get('motor1.mmcube') * self._param('steps_per_mm_cube') * 2**8))
+        self._send(p, self._rb_dummy)
         
     def _trigger_motor1_pwm(self, name, value):
-        p = SimplePacket()
-        p.add_8(0)
-        p.add_8(98)
+        p = self._packet(98)
         p.add_8(name.find('f-') >= 0)
         if not value:        
             p.add_8(0)
@@ -298,62 +1258,153 @@ class Extruder:
                 p.add_8(192)
             else:
                 p.add_8(128)
-        self.comm.send(p)
-        self.readback_queue.append(self._rb_dummy)
+        self._send(p, self._rb_dummy)
         
     def _trigger_motor1_tuning(self, name, value):
         if not value:
             return
-        p = SimplePacket()
-        p.add_8(0)
-        p.add_8(100)
-        if self.c['motor1.tuning.p'] > 0: 
-            p.add_16(int(2**abs(self.c['motor1.tuning.p'])))
+        p = self._packet(100)
+        if self._get('motor1.tuning.p') > 0: 
+            p.add_16(int(2**abs(self._get('motor1.tuning.p'))))
             pass
-        elif self.c['motor1.tuning.p'] < 0:
-            p.add_16(-int(2**abs(self.c['motor1.tuning.p'])))
+        elif self._get('motor1.tuning.p') < 0:
+            p.add_16(-int(2**abs(self._get('motor1.tuning.p'))))
         else:
             p.add_16(0)
             
         
-        if self.c['motor1.tuning.i'] > 0: 
-            p.add_16(int(2**abs(self.c['motor1.tuning.i'])))
-        elif self.c['motor1.tuning.i'] < 0:
-            p.add_16(-int(2**abs(self.c['motor1.tuning.i'])))
+        if self._get('motor1.tuning.i') > 0: 
+            p.add_16(int(2**abs(self._get('motor1.tuning.i'))))
+        elif self._get('motor1.tuning.i') < 0:
+            p.add_16(-int(2**abs(self._get('motor1.tuning.i'))))
         else:
             p.add_16(0)
             
-        if self.c['motor1.tuning.d'] > 0: 
-            p.add_16(int(2**abs(self.c['motor1.tuning.d'])))
-        elif self.c['motor1.tuning.d'] < 0:
-            p.add_16(-int(2**abs(self.c['motor1.tuning.d'])))
+        if self._get('motor1.tuning.d') > 0: 
+            p.add_16(int(2**abs(self._get('motor1.tuning.d'))))
+        elif self._get('motor1.tuning.d') < 0:
+            p.add_16(-int(2**abs(self._get('motor1.tuning.d'))))
         else:
             p.add_16(0)
             
-        if self.c['motor1.tuning.iLimit'] > 0: 
-            p.add_16(int(2**abs(self.c['motor1.tuning.iLimit'])))
-        elif self.c['motor1.tuning.iLimit'] < 0:
-            p.add_16(-int(2**abs(self.c['motor1.tuning.iLimit'])))
+        if self._get('motor1.tuning.iLimit') > 0: 
+            p.add_16(int(2**abs(self._get('motor1.tuning.iLimit'))))
+        elif self._get('motor1.tuning.iLimit') < 0:
+            p.add_16(-int(2**abs(self._get('motor1.tuning.iLimit'))))
         else:
             p.add_16(0)
             
-        p.add_8(self.c['motor1.tuning.deadband'])
-        p.add_8(self.c['motor1.tuning.minOutput'])
+        p.add_8(self._get('motor1.tuning.deadband'))
+        p.add_8(self._get('motor1.tuning.minOutput'))
         
-        self.comm.send(p)
-        self.readback_queue.append(self._rb_dummy)        
+        self._send(p, self._rb_dummy)
+
+    def _trigger_stream(self, name, value):
+        """
+        Start streaming the samples at the interval in ms, or stop it with 0
+        """
+        interval = max(min(int(value), 255), 0)
+        shortest = self._stream_min_interval()
+        if interval > 0 and interval < shortest:
+            print >> sys.stderr, "Stream interval %d ms is too short for %d baud. Using %d ms" % (
+                interval, self.bus.baudrate, shortest)
+            interval = shortest
+        self._stream_interval = interval / 1000.0
+        self._stream_sequence = None
+        self._stream_ms = None
+        p = self._packet(105)
+        p.add_8(interval)
+        self._send(p, self._rb_dummy)
+        if COMM_RS485 and interval > 0 and not self._stream_polling:
+            self._stream_polling = True
+            self.timers.schedule(monotonic(), self._poll_stream)
+
+    def _stream_min_interval(self):
+        """
+        Returns the shortest stream interval in ms the link carries at the baud rate in use, within STREAM_LINK_SHARE
+        """
+        # Start byte, length, header, samples, tag and CRC, at 10 bits per byte
+        bits = (SimplePacket.HEADER_LENGTH + STREAM_HEADER_LENGTH + STREAM_BATCH_SAMPLES * 6 + 2) * 10
+        return int(math.ceil(bits * 1000.0 / self.bus.baudrate / STREAM_LINK_SHARE / STREAM_BATCH_SAMPLES))
+
+    def _poll_stream(self, now):
+        """
+        Scheduled task: poll for the batch of streamed samples, which the firmware sends only when asked on the RS485 bus
+        """
+        if self._stream_interval <= 0:
+            self._stream_polling = False
+            return
+        p = self._command(STREAM_PUSH_TAG)
+        self._send(p, self._rb_poll_stream)
+        self.timers.schedule(now + self._stream_interval * STREAM_BATCH_SAMPLES / 2, self._poll_stream)
 
     def _mapp_heater1_set_sv(self):
-        p = SimplePacket()
-        p.add_8(0)
-        p.add_8(92)
+        p = self._packet(92)
         p.add_16(self.mcode_heater1_sv)
-        self.comm.send(p)
-        self.readback_queue.append(self._rb_dummy)
+        self._send(p, self._rb_dummy)
 
     def _trigger_mapp(self, name, value):
+        """
+        A M-Code submitted through the mapp.* HAL pins. mapp.done is set to the seqid when it is acknowledged.
+        """
         seqid = value
-        mcode = self.c['mapp.mcode']
+        def done(request):
+            self._set('mapp.done', seqid)
+        self._mapp_submit(self._get('mapp.mcode'), self._get('mapp.p'), self._get('mapp.q'), done)
+
+    def _mapp_submit(self, mcode, p, q, done):
+        """
+        Queue a M-Code. done(request) is called when it is acknowledged, or dropped on fault.
+        Non-blocking M-Codes are acknowledged once they have a slot in the queue, and blocking ones when they are done.
+        M-Codes are executed one after another in order, so those arrived during a blocking M-Code wait for it.
+        It is dropped at once if both the queue and the backlog are full.
+        """
+        if len(self._mapp_queue) >= MAPP_QUEUE_SIZE + MAPP_BACKLOG_SIZE:
+            MCodeRequest(0, mcode, p, q, done).acknowledge(False)
+            return
+        self._mapp_seqid += 1
+        if self._mapp_seqid > 10000:
+            self._mapp_seqid = 0
+        def acknowledged(request):
+            self.mcode_time.add((monotonic() - request.submitted) * 1e6)
+            done(request)
+        self._mapp_queue.append(MCodeRequest(self._mapp_seqid, mcode, p, q, acknowledged))
+        self._mapp_run()
+
+    def _mapp_run(self):
+        """
+        Execute the queued M-Codes until a blocking one is reached, and acknowledge the non-blocking ones in the queue
+        """
+        while self._mapp_current == None and len(self._mapp_queue) > 0:
+            request = self._mapp_queue.popleft()
+            self._mapp_current = request
+            self._mapp_execute(request.mcode, request.p, request.q)
+
+        for i in range(min(len(self._mapp_queue), MAPP_QUEUE_SIZE)):
+            request = self._mapp_queue[i]
+            if request.mcode not in MAPP_BLOCKING_MCODES:
+                request.acknowledge(True)
+        self._set('mapp.queued', len(self._mapp_queue) + (self._mapp_current != None))
+
+    def _mapp_complete(self, ok):
+        """
+        Signal the completion of the M-Code being executed
+        """
+        request = self._mapp_current
+        self._mapp_current = None
+        if request != None:
+            request.acknowledge(ok)
+
+    def _mapp_release(self):
+        """
+        Drop the M-Code being executed and every queued one, so nothing waits for the extruder which went offline
+        """
+        self._mapp_complete(False)
+        while len(self._mapp_queue) > 0:
+            self._mapp_queue.popleft().acknowledge(False)
+        self._set('mapp.queued', 0)
+
+    def _mapp_execute(self, mcode, param_p, param_q):
         if mcode == 101:
             # Extruder Heatup + Forward            
             self._mapp_heater1_set_sv()
@@ -367,21 +1418,18 @@ class Extruder:
         elif mcode == 103:
             # Extruder Heatup + Motor Off
             self._mapp_heater1_set_sv()
-            p = SimplePacket()
-            p.add_8(0)
-            p.add_8(97)
+            p = self._packet(97)
             p.add_8(0)
             p.add_8(0)
-            self.comm.send(p)
-            self.readback_queue.append(self._rb_dummy)
+            self._send(p, self._rb_dummy)
             self.extruder_state = 0
             
-            self.c['mapp.done'] = seqid    
+            self._mapp_complete(True)
         elif mcode == 104:
             # Set extruder temp
-            self.mcode_heater1_sv = int(self.c['mapp.p'])
+            self.mcode_heater1_sv = int(param_p)
             self._mapp_heater1_set_sv()
-            self.c['mapp.done'] = seqid
+            self._mapp_complete(True)
             
         # 105: Get temperature: Do nothing
         # 106: TODO FAN ON
@@ -390,8 +1438,8 @@ class Extruder:
         elif mcode == 108:
             # Set future extruder speed
             # Won't take effect until next M101/M102
-            self.mcode_motor1_speed = int(self.c['mapp.p'] * self.c['steps_per_mm_cube'] * 2**8);
-            self.c['mapp.done'] = seqid
+            self.mcode_motor1_speed = int(param_p * self._param('steps_per_mm_cube') * 2**8);
+            self._mapp_complete(True)
             
         elif mcode == 150:
             # Wait for temperature to reach the set value
@@ -401,160 +1449,314 @@ class Extruder:
         
         else:
             # Release all unknown MCode
-            self.c['mapp.done'] = seqid
-                        
-        # self.readback_queue.append(lambda p: _rb_mcode(seqid))
+            self._mapp_complete(True)
     
     def _trigger_running(self, name, value):
         if not value:
-            p = SimplePacket()
-            p.add_8(0)
-            p.add_8(98) # Use PWM instead of SPEED. PWM=0 frees the motor1. SPEED=0 keeps motor locked at position
+            p = self._packet(98) # Use PWM instead of SPEED. PWM=0 frees the motor1. SPEED=0 keeps motor locked at position
             p.add_8(0)
             p.add_8(0)
-            self.comm.send(p)
-            self.readback_queue.append(self._rb_dummy)
+            self._send(p, self._rb_dummy)
         elif self.extruder_state and self.mcode_motor1_speed != 0:
             self._mapp_heater1_set_sv()
-            p = SimplePacket()
-            p.add_8(0)
-            p.add_8(97)
+            p = self._packet(97)
             if self.extruder_state == 101:
                 p.add_16(self.mcode_motor1_speed)
             else:
                 p.add_16(-self.mcode_motor1_speed)
-            self.comm.send(p)
-            self.readback_queue.append(self._rb_dummy)            
+            self._send(p, self._rb_dummy)
 
     def _rb_mcode(self, p, seqid):
         # Not used yet
-        self.c['mapp.done'] = seqid
+        self._set('mapp.done', seqid)
     
     def _rb_dummy(self, p):
         pass
         
-    def _rb_status(self, p):        
-        new_estop_state = p.get_8(1) & 1
+    def _rb_status(self, p, offset = 1):
+        new_estop_state = p.get_8(offset) & 1
         if new_estop_state and not self.estop_state:
-            self.c['estop'] = 1
+            self._set('estop', 1)
         else:
-            self.c['estop'] = 0
+            self._set('estop', 0)
         self.estop_state = new_estop_state
         
-        self.c['online'] = p.get_8(1) & 2
-        self.c['fault.thermistor-disc'] = p.get_8(2) != 0
-        self.c['fault.heater-response'] = p.get_8(3) != 0
-        self.c['fault.motor-jammed'] = p.get_8(4) != 0
-        self.c['fault.no-plastic'] = p.get_8(5) != 0
-
-        self.c['heater1.on'] = (p.get_8(6) & 1) != 0
-        self.c['heater2.on'] = (p.get_8(6) & 2) != 0
+        self._set('online', p.get_8(offset) & 2)
+        if not p.get_8(offset) & 2:
+            # The firmware turned off, by the watchdog, a fault or a restart, which resets the values written
+            self._written.clear()
+        self._set('fault.thermistor-disc', p.get_8(offset + 1) != 0)
+        self._set('fault.heater-response', p.get_8(offset + 2) != 0)
+        self._set('fault.motor-jammed', p.get_8(offset + 3) != 0)
+        self._set('fault.no-plastic', p.get_8(offset + 4) != 0)
+
+        self._set('heater1.on', (p.get_8(offset + 5) & 1) != 0)
+        self._set('heater2.on', (p.get_8(offset + 5) & 2) != 0)
         
     def _rb_enable(self, p):
-        self.c['fault.communication'] = 0
+        self._set('fault.communication', 0)
         self.estop_state = 0
                     
-    def _rb_heater1_pvsv(self, p):
-        self.c['heater1.pv'] = p.get_16(1)
-        self.c['heater1.sv'] = p.get_16(3)
+    def _rb_heater1_pvsv(self, p, offset = 1):
+        pv = p.get_16(offset)
+        sv = p.get_16(offset + 2)
+        self._set('heater1.pv', pv)
+        self._set('heater1.sv', sv)
+        self.telemetry.set(0, pv)
+        self.telemetry.set(1, sv)
         self._extruder_ready_poll()
 
-    def _rb_heater2_pvsv(self, p):
-        self.c['heater2.pv'] = p.get_16(1)
-        self.c['heater2.sv'] = p.get_16(3)
+    def _rb_heater2_pvsv(self, p, offset = 1):
+        pv = p.get_16(offset)
+        sv = p.get_16(offset + 2)
+        self._set('heater2.pv', pv)
+        self._set('heater2.sv', sv)
+        self.telemetry.set(2, pv)
+        self.telemetry.set(3, sv)
         self._extruder_ready_poll()
         
-    def _rb_motor1_pvsv(self, p):
-        self.c['motor1.pv'] = p.get_16(1)
-        self.c['motor1.sv'] = p.get_16(3)
+    def _rb_motor1_pvsv(self, p, offset = 1):
+        pv = p.get_16(offset)
+        sv = p.get_16(offset + 2)
+        self._set('motor1.pv', pv)
+        self._set('motor1.sv', sv)
+        self.telemetry.set(4, pv)
+        self.telemetry.set(5, sv)
 
+    def _rb_telemetry(self, p):
+        self._rb_status(p, 1)
+        self._rb_heater1_pvsv(p, 7)
+        self._rb_heater2_pvsv(p, 11)
+        self._rb_motor1_pvsv(p, 15)
 
-def main():
+    def _rb_poll_stream(self, p):
+        if p.get_8(0) == SimplePacket.RC_OK and len(p) >= STREAM_HEADER_LENGTH:
+            self._rb_stream(p)
+
+    def _rb_stream(self, p):
+        """
+        A batch of samples pushed or polled for while streaming. The samples of motor1 PV/SV and heater1 PV are decoded into arrays,
+        and fed to the step response measurements at the stream interval.
+        """
+        if self._stream_interval <= 0:
+            # Pushed before the stop took effect
+            return
+        sequence = p.get_8(2)
+        if self._stream_sequence != None:
+            self.stream_lost += (sequence - self._stream_sequence - 1) & 0xff
+        self._stream_sequence = sequence
+        ms = p.get_16(3)
+        if self._stream_ms != None:
+            self._stream_clock += ((ms - self._stream_ms) & 0xffff) / 1000.0
+        self._stream_ms = ms
+
+        data = bytearray(p.buf[STREAM_HEADER_LENGTH:])
+        samples = array('h')
+        samples.fromstring(str(data[0:len(data) / 6 * 6]))
+        if sys.byteorder != 'little':
+            samples.byteswap()
+        motor1_pv = samples[0::3]
+        motor1_sv = samples[1::3]
+        heater1_pv = samples[2::3]
+        heater1_sv = self._get('heater1.sv')
+        for i in range(len(motor1_pv)):
+            t = self._stream_clock + i * self._stream_interval
+            if self.motor1_step.add(t, motor1_sv[i], motor1_pv[i]):
+                self._publish_step('motor1', self.motor1_step)
+            if self.heater1_step.add(t, heater1_sv, heater1_pv[i]):
+                self._publish_step('heater1', self.heater1_step)
+        self.stream_samples += len(motor1_pv)
+        self._set('stream.samples', self.stream_samples)
+        self._set('stream.lost', self.stream_lost)
+
+        if len(motor1_pv) > 0:
+            # The pin is unsigned, as _rb_motor1_pvsv() decodes it. The samples stay signed for the measurements.
+            self._set('motor1.pv', motor1_pv[-1] & 0xffff)
+            self._set('heater1.pv', heater1_pv[-1])
+            self.telemetry.set(0, heater1_pv[-1])
+            self.telemetry.set(4, motor1_pv[-1])
+
+    def _publish_step(self, name, step):
+        """
+        Publish the step response just measured to the HAL pins, with the times in ms or -1 if not reached
+        """
+        def ms(t):
+            if t == None:
+                return -1
+            return t * 1000.0
+        self._set(name + '.step.count', step.count)
+        self._set(name + '.step.overshoot', step.overshoot)
+        self._set(name + '.step.rise-ms', ms(step.rise_time))
+        self._set(name + '.step.settling-ms', ms(step.settling_time))
+        if STEP_RESPONSE_FILE != None:
+            path, ext = os.path.splitext(self.bus.path_of(STEP_RESPONSE_FILE, self))
+            try:
+                step.write(path + "." + name + ext)
+            except IOError ,err:
+                print >> sys.stderr, "Could not write the step response: " + str(err)
+
+
+def new_extruder_pins(c, prefix):
 	"""
-	Program entry point. Setting up HAL pins and construct the Extruder instance.
+	Setting up the HAL pins and params of an Extruder, named with the prefix
 	"""
-	c = hal.component("rs-extruder")
-	c.newpin("connection", hal.HAL_BIT, hal.HAL_OUT)
-	c.newpin("online", hal.HAL_BIT, hal.HAL_OUT)
-	c.newpin("estop", hal.HAL_BIT, hal.HAL_OUT)
-	c.newpin("enable", hal.HAL_BIT, hal.HAL_IN)
-	c.newpin("running", hal.HAL_BIT, hal.HAL_IN)
+	c.newpin(prefix + "connection", hal.HAL_BIT, hal.HAL_OUT)
+	c.newpin(prefix + "online", hal.HAL_BIT, hal.HAL_OUT)
+	c.newpin(prefix + "estop", hal.HAL_BIT, hal.HAL_OUT)
+	c.newpin(prefix + "enable", hal.HAL_BIT, hal.HAL_IN)
+	c.newpin(prefix + "running", hal.HAL_BIT, hal.HAL_IN)
+
+	c.newparam(prefix + "steps_per_mm_cube", hal.HAL_FLOAT, hal.HAL_RW)
+	c[prefix + 'steps_per_mm_cube'] = 4.0 # Some random default. Don't rely on this.
 
-	c.newparam("steps_per_mm_cube", hal.HAL_FLOAT, hal.HAL_RW)
-	c['steps_per_mm_cube'] = 4.0 # Some random default. Don't rely on this.
+	# Polling periods in ms. The fast ones apply while heating up or extruding, the idle one while disabled.
+	# If the firmware supports the composite telemetry command, every read goes at the shorter of the heater and motor periods,
+	# and the status period applies to older firmware only.
+	c.newparam(prefix + "poll.status-ms", hal.HAL_U32, hal.HAL_RW)
+	c[prefix + 'poll.status-ms'] = 50
+	c.newparam(prefix + "poll.heater-ms", hal.HAL_U32, hal.HAL_RW)
+	c[prefix + 'poll.heater-ms'] = 250
+	c.newparam(prefix + "poll.heater-fast-ms", hal.HAL_U32, hal.HAL_RW)
+	c[prefix + 'poll.heater-fast-ms'] = 100
+	c.newparam(prefix + "poll.motor-ms", hal.HAL_U32, hal.HAL_RW)
+	c[prefix + 'poll.motor-ms'] = 250
+	c.newparam(prefix + "poll.motor-fast-ms", hal.HAL_U32, hal.HAL_RW)
+	c[prefix + 'poll.motor-fast-ms'] = 50
+	c.newparam(prefix + "poll.idle-ms", hal.HAL_U32, hal.HAL_RW)
+	c[prefix + 'poll.idle-ms'] = 500
 
 	# TODO: Support PWM driver
-	c.newpin("fault.communication", hal.HAL_BIT, hal.HAL_OUT)
-	c.newpin("fault.thermistor-disc", hal.HAL_BIT, hal.HAL_OUT)
-	c.newpin("fault.heater-response", hal.HAL_BIT, hal.HAL_OUT)
-	c.newpin("fault.motor-jammed", hal.HAL_BIT, hal.HAL_OUT)
-	c.newpin("fault.no-plastic", hal.HAL_BIT, hal.HAL_OUT)
-
-	c.newpin("heater1.pv", hal.HAL_FLOAT, hal.HAL_OUT)
-	c.newpin("heater1.sv", hal.HAL_FLOAT, hal.HAL_OUT)
-	c.newpin("heater1.set-sv", hal.HAL_S32, hal.HAL_IN)
-	c.newpin("heater1.on", hal.HAL_BIT, hal.HAL_OUT)
-
-	c.newpin("heater2.pv", hal.HAL_FLOAT, hal.HAL_OUT)
-	c.newpin("heater2.sv", hal.HAL_FLOAT, hal.HAL_OUT)
-	c.newpin("heater2.set-sv", hal.HAL_S32, hal.HAL_IN)
-	c.newpin("heater2.on", hal.HAL_BIT, hal.HAL_OUT)
-
-	c.newpin("motor1.pv", hal.HAL_U32, hal.HAL_OUT)
-	c.newpin("motor1.sv", hal.HAL_U32, hal.HAL_OUT)
-	c.newpin("motor1.rel-pos", hal.HAL_S32, hal.HAL_IN)
-	c.newpin("motor1.rel-pos.trigger", hal.HAL_BIT, hal.HAL_IN)
-	c.newpin("motor1.speed", hal.HAL_S32, hal.HAL_IN)
-	c.newpin("motor1.speed.trigger", hal.HAL_BIT, hal.HAL_IN)
-	c.newpin("motor1.mmcube", hal.HAL_FLOAT, hal.HAL_IN)
-	c.newpin("motor1.mmcube.trigger", hal.HAL_BIT, hal.HAL_IN)
-	c.newpin("motor1.pwm.r-fast", hal.HAL_BIT, hal.HAL_IN)
-	c.newpin("motor1.pwm.r-slow", hal.HAL_BIT, hal.HAL_IN)
-	c.newpin("motor1.pwm.f-slow", hal.HAL_BIT, hal.HAL_IN)
-	c.newpin("motor1.pwm.f-fast", hal.HAL_BIT, hal.HAL_IN)
-
-	c.newpin("motor1.spindle", hal.HAL_FLOAT, hal.HAL_IN)
-	c.newpin("motor1.spindle.on", hal.HAL_BIT, hal.HAL_IN)
-
-	c.newpin("motor1.tuning.trigger", hal.HAL_BIT, hal.HAL_IN)
-	c.newpin("motor1.tuning.p", hal.HAL_FLOAT, hal.HAL_IN)
-	c.newpin("motor1.tuning.i", hal.HAL_FLOAT, hal.HAL_IN)
-	c.newpin("motor1.tuning.d", hal.HAL_FLOAT, hal.HAL_IN)
-	c.newpin("motor1.tuning.iLimit", hal.HAL_FLOAT, hal.HAL_IN)
-	c.newpin("motor1.tuning.deadband", hal.HAL_S32, hal.HAL_IN)
-	c.newpin("motor1.tuning.minOutput", hal.HAL_S32, hal.HAL_IN)
-
-	c.newpin("mapp.mcode", hal.HAL_S32, hal.HAL_IN)
-	c.newpin("mapp.p", hal.HAL_FLOAT, hal.HAL_IN)
-	c.newpin("mapp.q", hal.HAL_FLOAT, hal.HAL_IN)
-	c.newpin("mapp.seqid", hal.HAL_S32, hal.HAL_IN)
-	c.newpin("mapp.done", hal.HAL_S32, hal.HAL_OUT)
-
-	c.ready()
-
-	extruder = Extruder(c)
+	c.newpin(prefix + "fault.communication", hal.HAL_BIT, hal.HAL_OUT)
+	c.newpin(prefix + "fault.thermistor-disc", hal.HAL_BIT, hal.HAL_OUT)
+	c.newpin(prefix + "fault.heater-response", hal.HAL_BIT, hal.HAL_OUT)
+	c.newpin(prefix + "fault.motor-jammed", hal.HAL_BIT, hal.HAL_OUT)
+	c.newpin(prefix + "fault.no-plastic", hal.HAL_BIT, hal.HAL_OUT)
+
+	c.newpin(prefix + "heater1.pv", hal.HAL_FLOAT, hal.HAL_OUT)
+	c.newpin(prefix + "heater1.sv", hal.HAL_FLOAT, hal.HAL_OUT)
+	c.newpin(prefix + "heater1.set-sv", hal.HAL_S32, hal.HAL_IN)
+	c.newpin(prefix + "heater1.on", hal.HAL_BIT, hal.HAL_OUT)
+
+	c.newpin(prefix + "heater2.pv", hal.HAL_FLOAT, hal.HAL_OUT)
+	c.newpin(prefix + "heater2.sv", hal.HAL_FLOAT, hal.HAL_OUT)
+	c.newpin(prefix + "heater2.set-sv", hal.HAL_S32, hal.HAL_IN)
+	c.newpin(prefix + "heater2.on", hal.HAL_BIT, hal.HAL_OUT)
+
+	c.newpin(prefix + "motor1.pv", hal.HAL_U32, hal.HAL_OUT)
+	c.newpin(prefix + "motor1.sv", hal.HAL_U32, hal.HAL_OUT)
+	c.newpin(prefix + "motor1.rel-pos", hal.HAL_S32, hal.HAL_IN)
+	c.newpin(prefix + "motor1.rel-pos.trigger", hal.HAL_BIT, hal.HAL_IN)
+	c.newpin(prefix + "motor1.speed", hal.HAL_S32, hal.HAL_IN)
+	c.newpin(prefix + "motor1.speed.trigger", hal.HAL_BIT, hal.HAL_IN)
+	c.newpin(prefix + "motor1.mmcube", hal.HAL_FLOAT, hal.HAL_IN)
+	c.newpin(prefix + "motor1.mmcube.trigger", hal.HAL_BIT, hal.HAL_IN)
+	c.newpin(prefix + "motor1.pwm.r-fast", hal.HAL_BIT, hal.HAL_IN)
+	c.newpin(prefix + "motor1.pwm.r-slow", hal.HAL_BIT, hal.HAL_IN)
+	c.newpin(prefix + "motor1.pwm.f-slow", hal.HAL_BIT, hal.HAL_IN)
+	c.newpin(prefix + "motor1.pwm.f-fast", hal.HAL_BIT, hal.HAL_IN)
+
+	c.newpin(prefix + "motor1.spindle", hal.HAL_FLOAT, hal.HAL_IN)
+	c.newpin(prefix + "motor1.spindle.on", hal.HAL_BIT, hal.HAL_IN)
+
+	c.newpin(prefix + "motor1.tuning.trigger", hal.HAL_BIT, hal.HAL_IN)
+	c.newpin(prefix + "motor1.tuning.p", hal.HAL_FLOAT, hal.HAL_IN)
+	c.newpin(prefix + "motor1.tuning.i", hal.HAL_FLOAT, hal.HAL_IN)
+	c.newpin(prefix + "motor1.tuning.d", hal.HAL_FLOAT, hal.HAL_IN)
+	c.newpin(prefix + "motor1.tuning.iLimit", hal.HAL_FLOAT, hal.HAL_IN)
+	c.newpin(prefix + "motor1.tuning.deadband", hal.HAL_S32, hal.HAL_IN)
+	c.newpin(prefix + "motor1.tuning.minOutput", hal.HAL_S32, hal.HAL_IN)
+
+	# Streaming the samples at a high rate, and the step responses measured from them
+	c.newpin(prefix + "stream.interval-ms", hal.HAL_S32, hal.HAL_IN)
+	c.newpin(prefix + "stream.samples", hal.HAL_U32, hal.HAL_OUT)
+	c.newpin(prefix + "stream.lost", hal.HAL_U32, hal.HAL_OUT)
+	for name in ("motor1", "heater1"):
+		c.newpin(prefix + name + ".step.count", hal.HAL_U32, hal.HAL_OUT)
+		c.newpin(prefix + name + ".step.overshoot", hal.HAL_FLOAT, hal.HAL_OUT)
+		c.newpin(prefix + name + ".step.rise-ms", hal.HAL_FLOAT, hal.HAL_OUT)
+		c.newpin(prefix + name + ".step.settling-ms", hal.HAL_FLOAT, hal.HAL_OUT)
+
+	c.newpin(prefix + "mapp.mcode", hal.HAL_S32, hal.HAL_IN)
+	c.newpin(prefix + "mapp.p", hal.HAL_FLOAT, hal.HAL_IN)
+	c.newpin(prefix + "mapp.q", hal.HAL_FLOAT, hal.HAL_IN)
+	c.newpin(prefix + "mapp.seqid", hal.HAL_S32, hal.HAL_IN)
+	c.newpin(prefix + "mapp.done", hal.HAL_S32, hal.HAL_OUT)
+	c.newpin(prefix + "mapp.queued", hal.HAL_S32, hal.HAL_OUT)
+
+	# Time from a M-Code is submitted until it is acknowledged, average and maximum over the last second
+	c.newpin(prefix + "stats.mcode-ms", hal.HAL_FLOAT, hal.HAL_OUT)
+	c.newpin(prefix + "stats.mcode-max-ms", hal.HAL_FLOAT, hal.HAL_OUT)
+
+def main():
+	"""
+	Program entry point. Setting up HAL pins and construct the Extruder instances on the bus of each port.
+	"""
+	buses = []
+	mcode_server = None
+	for port, name in COMM_PORTS:
+		c = hal.component(name)
+		extruders = []
+		for address, device_name in COMM_DEVICES:
+			extruder = Extruder(c, address, device_name)
+			new_extruder_pins(c, extruder.prefix)
+			extruders.append(extruder)
+
+		# Performance counters. The times are the average and maximum over the last second.
+		c.newpin("stats.frames-sent", hal.HAL_U32, hal.HAL_OUT)
+		c.newpin("stats.frames-received", hal.HAL_U32, hal.HAL_OUT)
+		c.newpin("stats.crc-errors", hal.HAL_U32, hal.HAL_OUT)
+		c.newpin("stats.timeouts", hal.HAL_U32, hal.HAL_OUT)
+		c.newpin("stats.resets", hal.HAL_U32, hal.HAL_OUT)
+		c.newpin("stats.retransmissions", hal.HAL_U32, hal.HAL_OUT)
+		c.newpin("stats.coalesced", hal.HAL_U32, hal.HAL_OUT)
+		c.newpin("stats.queue-depth", hal.HAL_S32, hal.HAL_OUT)
+		c.newpin("stats.queue-depth-max", hal.HAL_S32, hal.HAL_OUT)
+		c.newpin("stats.rtt-ms", hal.HAL_FLOAT, hal.HAL_OUT)
+		c.newpin("stats.rtt-max-ms", hal.HAL_FLOAT, hal.HAL_OUT)
+		c.newpin("stats.loop-ms", hal.HAL_FLOAT, hal.HAL_OUT)
+		c.newpin("stats.loop-max-ms", hal.HAL_FLOAT, hal.HAL_OUT)
+
+		c.ready()
+		buses.append(ExtruderBus(c, extruders, None, port, name))
+
+	# M-Codes through the socket go to the first port
+	if MAPP_SOCKET != None:
+		try:
+			mcode_server = MCodeServer(MAPP_SOCKET)
+			buses[0].mcode_server = mcode_server
+		except socket.error ,err:
+			print >> sys.stderr, "M-Code socket is not available, using the HAL pins only: " + str(err)
+
+	# kill -USR1 dumps the performance counters
+	signal.signal(signal.SIGUSR1, lambda signum, frame: [bus.dump_stats() for bus in buses])
+	# kill -USR2 writes the telemetry history to TELEMETRY_EXPORT
+	signal.signal(signal.SIGUSR2, lambda signum, frame: [bus.export_telemetry() for bus in buses])
+
+	# Each port is served in its own thread, so a port connecting or failing does not hold up the others.
+	# The signals are handled in this thread.
+	threads = []
 	try:
+		for bus in buses:
+			thread = threading.Thread(target = bus.serve, name = bus.name)
+			thread.daemon = True
+			thread.start()
+			threads.append(thread)
 		while True:
-		    try:
-		        extruder.execute()
-		    except IOError:
-		        pass
-		    except OSError:
-		        pass
-		    except  serial.serialutil.SerialException:
-		        pass
-		    finally:
-		        c['connection'] = 0
-		        c['fault.communication'] = 1
-		        c['estop'] = 1
-		        c['online'] = 0
-		        time.sleep(0.05)
-		        c['estop'] = 0
-		        c['mapp.done'] = c['mapp.seqid']
-		        time.sleep(0.05)
-		        
+			time.sleep(1)
+			for thread in threads[:]:
+				if not thread.is_alive():
+					# Only this port is left stopped. The others are served on.
+					print >> sys.stderr, "The port %s is not served anymore" % (thread.name)
+					threads.remove(thread)
 	except KeyboardInterrupt:
+		for bus in buses:
+			bus.stop()
+		for thread in threads:
+			thread.join()
 		raise SystemExit    
+	finally:
+		if mcode_server != None:
+			mcode_server.close()
 
 if __name__ == "__main__":
 	main()
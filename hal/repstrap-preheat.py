@@ -0,0 +1,220 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+RepStrap Extruder Preheat Planner
+
+DESCRIPTION
+
+A filter program to move the heater set value changes (M104) ahead in the GCode, by the time the heater takes to
+reach the new temperature. So the heater is already at the temperature when the M150 (or M101) is reached,
+and the motion is not stalled waiting for it.
+
+The GCode is read from the file given in the argument, or STDIN, and written to STDOUT.
+It is expected to be the output of skeinforge2emc.pl. The time of each line is estimated from the moves and the feed rate,
+and only a window of lines are kept, so the memory needed does not grow with the file.
+
+A M104 raising the temperature is moved back to the latest point which leaves enough time, that is
+(new temperature - current temperature) / rate + margin seconds of moves before it.
+It is never moved before another M104, M150, M101 or M102, as those would wait for the wrong temperature.
+The original M104 is left as a comment.
+
+Please read the README.html usage.
+"""
+
+__author__ = "Saw Wong (sam@hellosam.net)"
+__date__ = "2009/11/12"
+__license__ = "GPL 3.0"
+
+import re
+import sys
+import math
+import fileinput
+from collections import deque
+from optparse import OptionParser
+
+# Heat up rate of the heater in degree per second. It is better to be underestimated.
+HEAT_RATE = 1.0
+# Seconds added to the heat up time, for the temperature to settle
+MARGIN = 10.0
+# Longest time in seconds a M104 could be moved ahead, which is the window of lines kept
+WINDOW = 600.0
+# Most lines kept in the window, even if they take no time
+WINDOW_LINES = 100000
+# The temperature of the heater before the first M104
+AMBIENT_TEMPERATURE = 20.0
+# Feed rate in unit per minute assumed for G0 rapid moves, and before any F word
+RAPID_FEED = 3000.0
+
+_comment = re.compile(r'\([^)]*\)|;.*$')
+_word = re.compile(r'([A-Z])\s*([-+]?[0-9]*\.?[0-9]*)')
+_set_temperature = re.compile(r'^M104\s+[PS]\s*([-+]?[0-9]*\.?[0-9]+)')
+_barrier = re.compile(r'^M1(01|02|50)\b')
+
+class MotionClock:
+    """
+    Estimates the time each GCode line takes, from the distance moved and the feed rate.
+    Acceleration is ignored, so moves are estimated shorter than they are, which only preheats earlier.
+    """
+    def __init__(self):
+        self.position = {'X': 0.0, 'Y': 0.0, 'Z': 0.0}
+        self.feed = RAPID_FEED
+        self.motion = 0
+        self.absolute = True
+
+    def duration(self, line):
+        """
+        Returns the seconds the line is estimated to take, and update the modal state.
+        """
+        words = _word.findall(_comment.sub('', line.upper()))
+        if len(words) == 0:
+            return 0.0
+
+        target = dict(self.position)
+        moved = False
+        dwell = 0.0
+        motion = self.motion
+        for letter, value in words:
+            try:
+                number = float(value)
+            except ValueError:
+                continue
+            if letter == 'G':
+                if number in (0, 1, 2, 3):
+                    motion = int(number)
+                elif number == 4:
+                    motion = 4
+                elif number == 90:
+                    self.absolute = True
+                elif number == 91:
+                    self.absolute = False
+            elif letter == 'F' and number > 0:
+                self.feed = number
+            elif letter in target:
+                if self.absolute:
+                    target[letter] = number
+                else:
+                    target[letter] += number
+                moved = True
+            elif letter == 'P' and motion == 4:
+                dwell = number
+
+        if motion == 4:
+            # Dwell is not modal
+            return dwell
+        self.motion = motion
+        if not moved:
+            return 0.0
+
+        distance = math.sqrt(sum([(target[axis] - self.position[axis]) ** 2 for axis in target]))
+        self.position = target
+        if motion == 0:
+            return distance / RAPID_FEED * 60
+        # Arcs are estimated by the chord, which is shorter
+        return distance / self.feed * 60
+
+class PreheatPlanner:
+    """
+    Streams the GCode lines through a window, and moves the M104 raising the temperature ahead.
+    """
+    def __init__(self, out, rate = HEAT_RATE, margin = MARGIN, window = WINDOW):
+        self.out = out
+        self.rate = rate
+        self.margin = margin
+        self.window = window
+        self.clock = MotionClock()
+        self.temperature = AMBIENT_TEMPERATURE
+        # Lines since the last barrier, as (line, seconds), and their total seconds
+        self._lines = deque()
+        self._seconds = 0.0
+
+    def feed(self, line):
+        """
+        Process one line. Lines are written out once they are out of the window.
+        """
+        code = _comment.sub('', line).strip().upper()
+        m = _set_temperature.match(code)
+        if m != None:
+            self._set_temperature(line, float(m.group(1)))
+            return
+        if _barrier.match(code):
+            self._flush(0)
+            self.out.write(line)
+            return
+
+        seconds = self.clock.duration(line)
+        self._lines.append((line, seconds))
+        self._seconds += seconds
+        # Keep no more than the window
+        self._flush(self.window, WINDOW_LINES)
+
+    def close(self):
+        """
+        Write out every line left
+        """
+        self._flush(0)
+
+    def _set_temperature(self, line, temperature):
+        ahead = 0
+        if temperature > self.temperature:
+            # The latest point leaving enough time, or as early as possible
+            self._flush((temperature - self.temperature) / self.rate + self.margin)
+            ahead = self._seconds
+        if ahead > 0:
+            self.out.write("M104 P%g\n" % temperature)
+            self._flush(0)
+            self.out.write("(M104 P%g is moved %.0f seconds ahead)\n" % (temperature, ahead))
+        else:
+            # Cooling down, or no move to go ahead of
+            self._flush(0)
+            self.out.write(line)
+        self.temperature = temperature
+
+    def _flush(self, seconds, lines = WINDOW_LINES):
+        """
+        Write out the oldest lines, as long as the lines left still take the seconds, or are more than the number of lines.
+        """
+        while len(self._lines) > 0 and (seconds <= 0 or self._seconds - self._lines[0][1] >= seconds
+                or len(self._lines) > lines):
+            line, duration = self._lines.popleft()
+            self._seconds -= duration
+            self.out.write(line)
+        if len(self._lines) == 0:
+            # Drop the rounding errors
+            self._seconds = 0.0
+
+class Usage(Exception):
+    """
+    Represents an exception about improper usage of this script
+    """
+    def __init__(self, msg):
+        self.msg = msg
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    parser = OptionParser(usage = "%prog [options] [gcode-file]")
+    parser.add_option("-r", "--rate", type = "float", default = HEAT_RATE,
+        help = "heat up rate of the heater in degree per second [default: %default]")
+    parser.add_option("-m", "--margin", type = "float", default = MARGIN,
+        help = "seconds added to the heat up time [default: %default]")
+    parser.add_option("-w", "--window", type = "float", default = WINDOW,
+        help = "longest seconds a M104 is moved ahead [default: %default]")
+    options, args = parser.parse_args(argv[1:])
+    try:
+        if options.rate <= 0:
+            raise Usage("The rate must be positive")
+        planner = PreheatPlanner(sys.stdout, options.rate, options.margin, options.window)
+        try:
+            for line in fileinput.input(args):
+                planner.feed(line)
+        except IOError ,err:
+            raise Usage("Could not read the GCode: " + str(err))
+        planner.close()
+    except Usage ,err:
+        print >> sys.stderr, str(err.msg)
+        parser.print_usage(sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,232 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+RepStrap Extruder Communication Replay
+
+DESCRIPTION
+
+This script reads a capture file recorded by the driver (see COMM_CAPTURE in repstrap-extruder.py),
+so the communication problems in the field could be studied offline.
+
+Usage: repstrap-replay.py [stats|dump|parse] capture-file
+
+stats: Print the counts of the frames, the errors, and the round trip time of each command (default)
+dump: Print every frame with its time
+parse: Feed the received bytes through the frame parser repeatedly, and report its speed against the real traffic
+
+Please read the README.html usage.
+"""
+
+__author__ = "Saw Wong (sam@hellosam.net)"
+__date__ = "2009/11/12"
+__license__ = "GPL 3.0"
+
+import sys
+import mmap
+from RepRapSerialComm import *
+
+# Number of times the received bytes are parsed in the parse mode
+PARSE_ROUNDS = 10
+# Tags of the packets the firmware pushes without being asked, such as the streamed samples
+PUSH_TAGS = (106,)
+
+class Usage(Exception):
+    """
+    Represents an exception about improper usage of this script
+    """
+    def __init__(self, msg):
+        self.msg = msg
+
+def records(buf):
+    """
+    Iterate the records of the capture in the buffer, as (time, direction, offset, length) of the data.
+    """
+    if buf[0:len(WireCapture.MAGIC)] != WireCapture.MAGIC:
+        raise Usage("Not a capture file")
+    offset = len(WireCapture.MAGIC)
+    while offset + WireCapture.HEADER.size <= len(buf):
+        timestamp, direction, length = WireCapture.HEADER.unpack_from(buf, offset)
+        offset += WireCapture.HEADER.size
+        if offset + length > len(buf):
+            # Truncated by a crash
+            break
+        yield timestamp, direction, offset, length
+        offset += length
+
+def command_of(p):
+    """
+    Returns the command byte of a sent packet. The parser takes the last byte as the tag, which is the command byte
+    of a packet without parameter.
+    """
+    if len(p) >= 2:
+        return p.get_8(1)
+    return p.tag
+
+def bytes_of(p):
+    """
+    Returns the content of the packet in hex, including the tag
+    """
+    content = bytearray(p.buf)
+    if p.tag >= 0:
+        content.append(p.tag)
+    return " ".join(["%02x" % d for d in content])
+
+def stats(buf):
+    """
+    Print the counts of the frames and the errors, and the round trip time of each command.
+    Responses are matched to the oldest command sent with the same tag, as AsyncRepRapSerialComm does.
+    """
+    parsers = { WireCapture.SENT: FrameParser(), WireCapture.RECEIVED: FrameParser() }
+    data_bytes = { WireCapture.SENT: 0, WireCapture.RECEIVED: 0 }
+    sent = {}
+    received = 0
+    pushed = 0
+    rejected = 0
+    lost = 0
+    unmatched = 0
+    rtt = {}
+    inflight = []
+    first = None
+    last = None
+
+    for timestamp, direction, offset, length in records(buf):
+        if first == None:
+            first = timestamp
+        last = timestamp
+        data_bytes[direction] += length
+        parser = parsers[direction]
+        parser.feed(buf[offset:offset + length])
+        while True:
+            p = parser.next_frame()
+            if p == None:
+                break
+            if direction == WireCapture.SENT:
+                cmd = command_of(p)
+                sent[cmd] = sent.get(cmd, 0) + 1
+                inflight.append((cmd, timestamp))
+                continue
+
+            received += 1
+            if p.tag in PUSH_TAGS:
+                pushed += 1
+                continue
+            if p.get_8(0) != SimplePacket.RC_OK:
+                rejected += 1
+            for i in range(len(inflight)):
+                cmd, sent_time = inflight[i]
+                if p.tag == cmd or p.tag == -1:
+                    lost += i
+                    del inflight[0:i + 1]
+                    if not cmd in rtt:
+                        rtt[cmd] = Histogram()
+                    rtt[cmd].add((timestamp - sent_time) * 1e6)
+                    break
+            else:
+                unmatched += 1
+
+    if first == None:
+        print "The capture is empty"
+        return
+    span = max(last - first, 1e-6)
+    print "Captured: %.3f s" % span
+    print "Sent: %d frames, %d bytes (%.0f bytes/s)" % (
+        sum(sent.values()), data_bytes[WireCapture.SENT], data_bytes[WireCapture.SENT] / span)
+    print "Received: %d frames (%d pushed), %d bytes (%.0f bytes/s)" % (
+        received, pushed, data_bytes[WireCapture.RECEIVED], data_bytes[WireCapture.RECEIVED] / span)
+    print "CRC errors: %d, rejected by the firmware: %d, lost responses: %d, unmatched responses: %d, unanswered: %d" % (
+        parsers[WireCapture.RECEIVED].crc_errors, rejected, lost, unmatched, len(inflight))
+    print "Round trip (us):"
+    for cmd in sorted(sent.keys()):
+        histogram = rtt.get(cmd, Histogram())
+        print "  Command %d: sent %d, %s" % (cmd, sent[cmd], histogram)
+
+def dump(buf):
+    """
+    Print every frame with its time relative to the start of the capture
+    """
+    parsers = { WireCapture.SENT: FrameParser(), WireCapture.RECEIVED: FrameParser() }
+    first = None
+    for timestamp, direction, offset, length in records(buf):
+        if first == None:
+            first = timestamp
+        parser = parsers[direction]
+        parser.feed(buf[offset:offset + length])
+        while True:
+            errors = parser.crc_errors
+            p = parser.next_frame()
+            if parser.crc_errors > errors:
+                # The parser has resynchronized past the bad frames, before the next good one
+                arrow = "<<"
+                if direction == WireCapture.SENT:
+                    arrow = ">>"
+                print "%12.6f %s CRC mismatch: %d start bytes skipped" % (timestamp - first, arrow, parser.crc_errors - errors)
+            if p == None:
+                break
+            if direction == WireCapture.SENT:
+                print "%12.6f >> Command %3d: %s" % (timestamp - first, command_of(p), bytes_of(p))
+            elif p.tag in PUSH_TAGS:
+                print "%12.6f <<  Pushed %3d: %s" % (timestamp - first, p.tag, bytes_of(p))
+            else:
+                print "%12.6f <<     Tag %3d: %s" % (timestamp - first, p.tag, bytes_of(p))
+
+def parse(buf):
+    """
+    Feed the received bytes through the frame parser, in the chunks as they were read, and time it
+    """
+    chunks = [buf[offset:offset + length] for timestamp, direction, offset, length in records(buf)
+        if direction == WireCapture.RECEIVED]
+    frames = 0
+    start = monotonic()
+    for i in range(PARSE_ROUNDS):
+        parser = FrameParser()
+        for chunk in chunks:
+            parser.feed(chunk)
+            while parser.next_frame() != None:
+                frames += 1
+    elapsed = monotonic() - start
+    if frames == 0:
+        print "No frame is received in the capture"
+        return
+    print "Parsed %d frames in %d chunks, %d times: %.2f us per frame, %.0f frames/s" % (
+        frames / PARSE_ROUNDS, len(chunks), PARSE_ROUNDS, elapsed / frames * 1e6, frames / elapsed)
+
+MODES = {
+    'stats': stats,
+    'dump': dump,
+    'parse': parse
+}
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    try:
+        if len(argv) == 2:
+            mode = 'stats'
+            path = argv[1]
+        elif len(argv) == 3 and argv[1] in MODES:
+            mode = argv[1]
+            path = argv[2]
+        else:
+            raise Usage("Incorrect arguments")
+
+        try:
+            f = open(path, 'rb')
+        except IOError ,err:
+            raise Usage("Could not open the capture file: " + str(err))
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        except ValueError:
+            raise Usage("The capture file is empty: " + path)
+        try:
+            MODES[mode](buf)
+        finally:
+            buf.close()
+            f.close()
+    except Usage ,err:
+        print >> sys.stderr, str(err.msg)
+        print >> sys.stderr, "\nUsage: " + str(argv[0]) + " [stats|dump|parse] capture-file"
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,202 @@
+#!/usr/bin/python
+# encoding: utf-8
+"""
+RepStrap Extruder Self Test
+
+DESCRIPTION
+
+This script checks the communication module and the driver against the Extruder Controller emulator,
+in the situations which are hard to bring about with the real hardware, such as a lost response.
+No hardware is needed.
+
+Usage: repstrap-selftest.py [test-name...]
+
+Tests could be picked by name in the arguments. All of them are run by default.
+Prints the result of each test, and exits with 1 if any of them fails.
+"""
+
+__author__ = "Saw Wong (sam@hellosam.net)"
+__date__ = "2009/11/12"
+__license__ = "GPL 3.0"
+
+import os
+import sys
+import imp
+import time
+import tempfile
+import threading
+import traceback
+from RepRapSerialComm import *
+from ExtruderEmulator import *
+
+# Baud rate the emulator and the tests talk at
+BAUDRATE = 38400
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+class Failure(Exception):
+    """
+    Represents a check failed in a test
+    """
+    def __init__(self, msg):
+        self.msg = msg
+
+def check(condition, msg):
+    """
+    Fail the test with the message if the condition is not met
+    """
+    if not condition:
+        raise Failure(msg)
+
+def echo(value):
+    """
+    Returns an echo packet (command 104) carrying the value, so its response could be told from the others
+    """
+    p = SimplePacket()
+    p.add_8(0)
+    p.add_8(104)
+    p.add_8(value)
+    return p
+
+def test_lost_response():
+    """
+    The response to one of the pipelined requests with the same tag is lost.
+    It must time out alone, and every request after it must get its own response.
+    """
+    emulator = ExtruderEmulator(BAUDRATE, drop = (2,))
+    comm = None
+    try:
+        comm = AsyncRepRapSerialComm(emulator.start(), BAUDRATE)
+        comm.reset()
+        requests = [comm.request(echo(i)) for i in range(6)]
+        for request in requests:
+            try:
+                comm.wait(request)
+            except PacketError:
+                pass
+        for i in range(len(requests)):
+            request = requests[i]
+            if i == 2:
+                check(request.rc == SimplePacket.RC_NO_RESPONSE, "The lost response completed request %d" % i)
+            else:
+                check(request.rc == SimplePacket.RC_OK, "Request %d failed with RC %d" % (i, request.rc))
+                check(request.reply.get_8(1) == i, "Request %d got the response of request %d" % (i, request.reply.get_8(1)))
+    finally:
+        if comm != None:
+            comm.close()
+        emulator.stop()
+
+def test_corrupt_response():
+    """
+    The response to one of the pipelined requests fails the CRC check.
+    That request must fail at once with RC_CRC_MISMATCH, not by timeout, and the others must get their own responses.
+    """
+    emulator = ExtruderEmulator(BAUDRATE, corrupt = (2,))
+    comm = None
+    try:
+        comm = AsyncRepRapSerialComm(emulator.start(), BAUDRATE)
+        comm.reset()
+        requests = [comm.request(echo(i)) for i in range(6)]
+        start = monotonic()
+        try:
+            comm.wait(requests[2])
+        except PacketError:
+            pass
+        elapsed = monotonic() - start
+        for request in requests:
+            try:
+                comm.wait(request)
+            except PacketError:
+                pass
+        check(requests[2].rc == SimplePacket.RC_CRC_MISMATCH, "The corrupt response completed request 2 with RC %d" % requests[2].rc)
+        check(elapsed < RepRapSerialComm._read_timeout / 1000.0, "Request 2 failed after %d ms" % (elapsed * 1000))
+        for i in (0, 1, 3, 4, 5):
+            check(requests[i].rc == SimplePacket.RC_OK, "Request %d failed with RC %d" % (i, requests[i].rc))
+            check(requests[i].reply.get_8(1) == i, "Request %d got the response of request %d" % (i, requests[i].reply.get_8(1)))
+    finally:
+        if comm != None:
+            comm.close()
+        emulator.stop()
+
+def test_queued_reverse():
+    """
+    M102 queued behind M150 must be acknowledged only when the temperature is reached, as M101 is
+    """
+    driver = imp.load_source('repstrap_extruder', os.path.join(HERE, 'repstrap-extruder.py'))
+    inject = imp.load_source('mcode_inject', os.path.join(HERE, 'mcode-inject.py'))
+    bench = imp.load_source('repstrap_benchmark', os.path.join(HERE, 'repstrap-benchmark.py'))
+    socket_dir = tempfile.mkdtemp()
+    emulator = ExtruderEmulator(BAUDRATE, heat_rate = 100.0)
+    server = None
+    thread = None
+    bus = None
+    try:
+        driver.COMM_PORT = emulator.start()
+        driver.COMM_BAUDRATE = BAUDRATE
+        driver.COMM_MAX_BAUDRATE = None
+        inject.MAPP_SOCKET = os.path.join(socket_dir, 'rs-extruder.sock')
+        server = driver.MCodeServer(inject.MAPP_SOCKET)
+        c = bench.BenchComponent()
+        bus = driver.ExtruderBus(c, [driver.Extruder(c)], server)
+        thread = threading.Thread(target = bus.execute)
+        thread.start()
+        start = monotonic()
+        while not c['connection']:
+            check(monotonic() - start < 5, "The driver does not connect to the emulator")
+            time.sleep(0.01)
+        c['enable'] = 1
+        time.sleep(0.2)
+
+        check(inject.submit(104, "60", "0").startswith("ok"), "M104 is not executed")
+        waiting = threading.Thread(target = inject.submit, args = (150, "0", "0"))
+        waiting.start()
+        time.sleep(0.05)
+        check(inject.submit(102, "0", "0").startswith("ok"), "M102 is not executed")
+        pv = c['heater1.pv']
+        waiting.join()
+        check(pv >= 55, "M102 is acknowledged at %d degree, before the temperature is reached" % pv)
+    finally:
+        if bus != None:
+            bus.stop()
+        if thread != None:
+            thread.join()
+        if server != None:
+            server.close()
+        emulator.stop()
+        os.rmdir(socket_dir)
+
+# Tests by name, in the order they are run
+TESTS = [
+    ('lost-response', test_lost_response),
+    ('corrupt-response', test_corrupt_response),
+    ('queued-reverse', test_queued_reverse)
+]
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    names = argv[1:]
+    for name in names:
+        if not name in dict(TESTS):
+            print >> sys.stderr, "Unknown test: " + name
+            print >> sys.stderr, "Usage: " + argv[0] + " [" + "|".join([n for n, test in TESTS]) + "...]"
+            return 1
+    failed = 0
+    for name, test in TESTS:
+        if len(names) > 0 and not name in names:
+            continue
+        try:
+            test()
+            print "%-30s OK" % name
+        except Failure ,err:
+            print "%-30s FAILED: %s" % (name, err.msg)
+            failed += 1
+        except Exception:
+            print "%-30s ERROR" % name
+            traceback.print_exc()
+            failed += 1
+    if failed > 0:
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,6 @@
+#!/bin/sh
+# Filter the Skeinforge GCode through skeinforge2emc.pl and then repstrap-preheat.py, so the heater is preheated ahead.
+# Use it in place of skeinforge2emc.pl in the [FILTER] of the EMC2 ini.
+
+DIR=`dirname "$0"`
+"$DIR/skeinforge2emc.pl" "$@" | "$DIR/repstrap-preheat.py"